@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+End-to-end throughput benchmark of the scan paths against the fake SANE
+backend. Each scenario runs in its own process, so peak RSS is its own.
+
+    python benchmarks/bench_scan.py --pages 40 --dpi 300 --save baseline.json
+    python benchmarks/bench_scan.py --pages 40 --dpi 300 --compare baseline.json
+"""
+
+import argparse
+import builtins
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shlex
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The fake SANE backend of the tests, not part of the package
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import fake_sane  # noqa: E402
+
+DEVICE = 'fake:scanner0'
+
+# name: (scan arguments, ADF stacks, prompts answered before CTRL+D)
+SCENARIOS = {
+    'single': (['-m', 'join'], None, None),
+    'adf': (['-a'], 1, 0),
+    'duplex': (['-a', '-d'], 2, 1),
+    'multidoc-join': (['-a', '-m', 'join'], None, None),
+    'multidoc-split': (['-a', '-m', 'split'], None, None),
+}
+
+# Metrics compared against a baseline and whether higher is better
+REGRESSION_METRICS = {
+    'pages_per_minute': True,
+    'peak_rss_mb': False,
+    'output_bytes': False,
+}
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _scenario_plan(name, pages, docs):
+    """ADF stack size and the number of prompts answered for `name`."""
+    scan_args, stacks, prompts = SCENARIOS[name]
+    if name == 'single':
+        # One page per flatbed scan, Enter for each but the last
+        return scan_args, 1, pages - 1
+    if name.startswith('multidoc'):
+        return scan_args, max(1, pages // docs), docs - 1
+    return scan_args, max(1, pages // stacks), prompts
+
+
+def run_scenario(name, options, results):
+    """Runs one scenario, meant to be the target of a fresh process."""
+    scan_args, stack_size, prompts = _scenario_plan(name, options['pages'], options['docs'])
+    backend = fake_sane.install(pages_per_minute=options['ppm'], stack_size=stack_size)
+
+    from pypdf import PdfReader
+    from simple_cmd_scan import scan_controller
+    from simple_cmd_scan.__main__ import AppStarter
+
+    stored = []
+    add_image = scan_controller.ScanJob.add_image
+
+    def timed_add_image(job, im):
+        add_image(job, im)
+        stored.append(time.monotonic())
+
+    answers = iter([''] * prompts)
+
+    def answer_prompt(prompt=''):
+        try:
+            return next(answers)
+        except StopIteration:
+            raise EOFError
+
+    scan_controller.ScanJob.add_image = timed_add_image
+    builtins.input = answer_prompt
+
+    with tempfile.TemporaryDirectory(prefix='bench_scan_') as output_dir:
+        argv = ['simple-cmd-scan', '-s', DEVICE, '-o', output_dir, '-r', str(options['dpi']), '--device-cache-ttl', '0',
+                # Unique names, so split documents within the same minute don't overwrite each other
+                '-n', 'bench_%H%M%S_%f', '-c', options['color_mode']] + scan_args + shlex.split(options['scan_args'])
+        args = AppStarter.parse_arguments(argv)
+
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ret = scan_controller.SimpleCmdScan(args).run()
+        elapsed = time.monotonic() - start
+
+        outputs = [os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.endswith('.pdf')]
+        num_pages = backend.pages_scanned
+        # Pages in the output, not just stored, so pages lost when writing a PDF show up
+        pages_written = sum(len(PdfReader(f).pages) for f in outputs)
+        latencies = [done - delivered for delivered, done in zip(backend.delivered, stored)]
+        results.put({
+            'scenario': name,
+            'ret': ret,
+            'pages': num_pages,
+            'pages_written': pages_written,
+            'documents': len(outputs),
+            'seconds': round(elapsed, 3),
+            'pages_per_minute': round(num_pages / elapsed * 60, 1),
+            'latency_p50_ms': round(_percentile(latencies, 50) * 1000, 1),
+            'latency_p95_ms': round(_percentile(latencies, 95) * 1000, 1),
+            'finalize_ms': round((start + elapsed - backend.delivered[-1]) * 1000, 1) if backend.delivered else 0,
+            'peak_rss_mb': round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024, 1),
+            'output_bytes': sum(os.path.getsize(f) for f in outputs),
+        })
+
+
+def run_benchmarks(scenarios, options):
+    # Forked, so encoder worker processes inherit the fake backend. The parent has not imported any scan code yet.
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    for name in scenarios:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_scenario, args=(name, options, queue), name=name)
+        p.start()
+        p.join()
+        if queue.empty():
+            # Crashed, the traceback is on stderr
+            results.append({'scenario': name, 'ret': p.exitcode or 1})
+            continue
+        results.append(queue.get())
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    columns = ['scenario', 'pages', 'pages_written', 'documents', 'pages_per_minute', 'latency_p50_ms',
+               'latency_p95_ms', 'finalize_ms', 'peak_rss_mb', 'output_bytes']
+    widths = [max(len(c), *(len(str(r.get(c, '-'))) for r in results)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)), file=out)
+    for r in results:
+        print("  ".join(str(r.get(c, '-')).ljust(w) for c, w in zip(columns, widths)), file=out)
+
+
+def find_regressions(results, baseline, tolerance):
+    """Metrics worse than in `baseline` by more than `tolerance` (fraction)."""
+    previous = {r['scenario']: r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get(r['scenario'])
+        if not old or r['ret'] != 0:
+            continue
+        for metric, higher_is_better in REGRESSION_METRICS.items():
+            if not old.get(metric):
+                continue
+            change = (r[metric] - old[metric]) / old[metric]
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{r['scenario']}: {metric} {old[metric]} -> {r[metric]} ({change:+.0%})")
+    return regressions
+
+
+def parse_arguments(argv):
+    options = argparse.ArgumentParser(description="Benchmark the scan paths against a fake SANE backend.")
+    options.add_argument("scenario", nargs='*',
+                         help=f"Scenarios to run: {', '.join(SCENARIOS)}. Default is all.")
+    options.add_argument("--pages", type=int, default=10, help="Pages scanned per scenario. Default is 10.")
+    options.add_argument("--docs", type=int, default=4, help="Documents for the multidoc scenarios. Default is 4.")
+    options.add_argument("--dpi", type=int, default=300, help="Scan resolution. Default is 300.")
+    options.add_argument("--color-mode", choices=['color', 'grayscale', 'bw'], default='color',
+                         help="Color mode of the pages. Default is color.")
+    options.add_argument("--ppm", type=float, default=0,
+                         help="Feed rate of the fake scanner in pages per minute. Default 0 feeds as fast as "
+                         "possible, measuring the capacity of the pipeline.")
+    options.add_argument("--scan-args", default="",
+                         help="Additional simple-cmd-scan arguments, e.g. \"--compression medium -w 4\".")
+    options.add_argument("--save", help="Write the results to this JSON file.")
+    options.add_argument("--compare", help="Compare to the results in this JSON file, exit 1 on regressions.")
+    options.add_argument("--tolerance", type=float, default=0.15,
+                         help="Fraction a metric may get worse before it counts as regression. Default is 0.15.")
+    args = options.parse_args(argv)
+    unknown = [s for s in args.scenario if s not in SCENARIOS]
+    if unknown:
+        options.error(f"Unknown scenarios: {', '.join(unknown)}")
+    return args
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_arguments(argv)
+    options = {k: getattr(args, k) for k in ('pages', 'docs', 'dpi', 'color_mode', 'ppm', 'scan_args')}
+    results = run_benchmarks(args.scenario or list(SCENARIOS), options)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2)
+
+    failed = [r['scenario'] for r in results if r['ret'] != 0]
+    if failed:
+        print(f"Scenarios failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    lost = [f"{r['scenario']} ({r['pages_written']} of {r['pages']})" for r in results
+            if r['pages_written'] != r['pages']]
+    if lost:
+        print(f"Pages scanned but not written: {', '.join(lost)}", file=sys.stderr)
+        return 1
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['options'] != options:
+            print("Warning: baseline was recorded with different options", file=sys.stderr)
+        regressions = find_regressions(results, baseline['results'], args.tolerance)
+        for r in regressions:
+            print(f"Regression: {r}", file=sys.stderr)
+        return regressions and 1 or 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,13 +25,17 @@ def read(fname):
 
 requirements = [
     'python-decouple~=3.8',
-    'pypdf~=4.3.1',
     'Pillow~=10.4.0',
     'python-sane~=2.9.1',
 ]
 
 extras_require = {
+    'imaging': [
+        'numpy>=1.21',
+    ],
     'dev': [
+        'numpy>=1.21',
+        'pypdf~=4.3.1',
         'pytest~=8.3.2',
         'pytest-mock~=3.14.0',
     ],
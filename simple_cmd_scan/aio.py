@@ -0,0 +1,204 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from .arguments import parse_arguments
+from .logger import log
+from .page_store import PageStore
+from .scan_controller import SimpleCmdScan
+from .utils import test_write_to_folder
+
+# SANE is initialized once per process, for all devices opened through this API
+_sane_lock = threading.Lock()
+_sane_users = 0
+
+
+class ScanError(Exception):
+    """A scanner could not be opened. `ret` is the SimpleCmdScan return code."""
+
+    def __init__(self, msg, ret=SimpleCmdScan.RET_ERR) -> None:
+        super().__init__(msg)
+        self.ret = ret
+
+
+class AsyncScanner:
+    """
+    Asyncio API to drive a scanner from a service, without prompts or output
+    on the terminal:
+
+        scanner = await AsyncScanner.open(['-s', 'escl:http://10.0.0.9', '-a', '-c', 'grayscale'])
+        try:
+            job = scanner.new_job()
+            async for data in scanner.pages():
+                job.add_image(data)
+            path = await scanner.create_pdf(job)
+        finally:
+            await scanner.close()
+
+    `options` are the command line options or the arguments parsed from
+    them. Blocking SANE calls of a device run on a thread of its own, pages
+    are encoded in the pool of the controller (or a shared `encoder`), so
+    one event loop can serve several devices and jobs. For duplex scans,
+    scan the front and back sides into two jobs and merge them with
+    `ScanJob.merge_back_images`.
+    """
+
+    def __init__(self, options, encoder=None) -> None:
+        if isinstance(options, (list, tuple)):
+            options = parse_arguments(['simple-cmd-scan', *options])
+        self.controller = SimpleCmdScan(options)
+        self.controller.quiet_mode = True
+        self.shared_encoder = encoder
+        # SANE handles must not be used from several threads at once
+        self.device_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sane_device")
+        self.temp_dir = None
+        self.sane_acquired = False
+
+    @staticmethod
+    async def open(options, encoder=None):
+        """Initialize SANE if needed and open the scanner with the settings of `options`."""
+        scanner = AsyncScanner(options, encoder)
+        try:
+            await scanner._call(scanner._open)
+        except BaseException:
+            await scanner.close()
+            raise
+        return scanner
+
+    def _open(self):
+        global _sane_users
+        if not test_write_to_folder(self.controller.output_dir):
+            raise ScanError(f"No write access to output folder: {self.controller.output_dir}")
+        with _sane_lock:
+            if not _sane_users and not self.controller._init_sane():
+                raise ScanError("Unable to initialize SANE")
+            _sane_users += 1
+        self.sane_acquired = True
+
+        ret = self.controller.open_scanner()
+        if ret != SimpleCmdScan.RET_OK:
+            raise ScanError(f"Unable to open scanner {self.controller.scan_device or ''}".rstrip(), ret)
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="simple_cmd_scan_")
+        self.controller.page_store = PageStore(self.temp_dir.name, self.controller.memory_budget)
+        if self.shared_encoder:
+            self.controller.encoder = self.shared_encoder
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.device_executor, fn, *args)
+
+    @property
+    def metrics(self):
+        return self.controller.metrics
+
+    def new_job(self):
+        """A ScanJob to add pages to, its pages are kept in the page store of this scanner."""
+        return self.controller._new_job(default_complete=True)
+
+    async def _frames(self):
+        scanner = self.controller.scanner
+        if not self.controller.adf_scan:
+            with self.metrics.stage('acquire'):
+                im = await self._call(scanner.scan)
+            yield im
+            return
+
+        frames = await self._call(scanner.multi_scan)
+        while True:
+            with self.metrics.stage('acquire'):
+                im = await self._call(next, frames, None)
+            if im is None:
+                return
+            yield im
+
+    async def pages(self):
+        """
+        Scan one page, or all pages in the feeder with the ADF, and yield the
+        encoded data of each in feed order. Dropped blank pages are yielded as
+        None, separator sheets as SeparatorPage. Pages are encoded while the next ones are scanned. A scanner
+        error is raised after the pages scanned before it.
+        """
+        encoder = self.controller.get_encoder()
+        loop = asyncio.get_running_loop()
+        pending = collections.deque()
+        error = None
+        idx = 0
+        try:
+            async for im in self._frames():
+                idx += 1
+                # Pages of this scanner are yielded while waiting for a free slot
+                while len(pending) >= encoder.max_pending:
+                    yield await self._collect(pending.popleft())
+                # A shared encoder may still be full with the pages of other scanners, submit blocks until a slot
+                # is free, not on the event loop
+                with self.metrics.stage('encoder_wait'):
+                    future = await loop.run_in_executor(
+                        None, encoder.submit_frame, SimpleCmdScan._encode_page_timed, im, idx,
+                        self.controller.processing)
+                pending.append(asyncio.wrap_future(future))
+                self.metrics.queue_depth('encoder', len(pending))
+                while pending and pending[0].done():
+                    yield await self._collect(pending.popleft())
+        except Exception as e:
+            log.error(f"An error occurred during scanning: {e}")
+            error = e
+
+        while pending:
+            yield await self._collect(pending.popleft())
+        if error:
+            raise error
+
+    async def _collect(self, future):
+        data, seconds = await future
+        self.metrics.observe('encode', seconds)
+        return data
+
+    async def create_pdf(self, job, suffix=""):
+        """Write the PDF of `job` without blocking the event loop. Returns its path, None without pages."""
+        return await asyncio.get_running_loop().run_in_executor(None, job.create_pdf, suffix, True)
+
+    async def close(self):
+        """Close the device, and SANE once no other device uses it."""
+        await self._call(self._close)
+        self.device_executor.shutdown()
+
+    def _close(self):
+        global _sane_users
+        controller = self.controller
+        if self.shared_encoder:
+            controller.encoder = None
+        if controller.encoder:
+            controller.encoder.shutdown()
+            controller.encoder = None
+        if controller.scanner:
+            controller._close_handle(controller.scanner)
+            controller.scanner = None
+        if controller.page_store:
+            controller.page_store.close()
+            controller.page_store = None
+        if self.temp_dir:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+        if self.sane_acquired:
+            self.sane_acquired = False
+            with _sane_lock:
+                _sane_users -= 1
+                if _sane_users == 0:
+                    controller._exit_sane()
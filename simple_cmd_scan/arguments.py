@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+The command line options, also used by the Python API to build the arguments
+of a scan from options. Kept apart from the command line entry point, which
+imports the daemon, farm and converter.
+"""
+
+import argparse
+
+from decouple import config
+from .compression import DEFAULT_PRESET, QUALITY_PRESETS
+from .device_cache import DeviceCache
+from .image_filters import BlankPageDetector, SeparatorDetector
+from .page_store import PageStore
+from .scan_controller import SimpleCmdScan
+
+
+def add_env_argument(options, env_var, *args, **kwargs):
+    env_val = config(env_var, default=None)
+    env_text = env_val is not None and f"{env_var}={env_val}" or "unset"
+    help_suffix = f"Also via env {env_var} or .env file, currently {env_text}"
+    if env_val and 'action' in kwargs and kwargs["action"] == "store_true":
+        env_val = bool(env_val)
+
+    if 'help' in kwargs:
+        kwargs['help'] += f" {help_suffix}"
+    else:
+        kwargs['help'] = help_suffix
+
+    if env_val is not None:
+        kwargs['default'] = env_val
+
+    options.add_argument(*args, **kwargs)
+
+
+def parse_arguments(argv):
+    options = argparse.ArgumentParser()
+
+    add_env_argument(
+        options, 'SCAN_ADF',
+        "-a", "--adf",
+        action="store_true",
+        help="Scan all documents from the Automated Document Feeder (ADF) instead of the flatbed scanner."
+    )
+    add_env_argument(
+        options, 'SCAN_COLOR_MODE',
+        "-c", "--color-mode",
+        nargs='?',
+        choices=['color', 'grayscale', 'bw'],
+        const='color',
+        help="Color mode. Default is color."
+    )
+    add_env_argument(
+        options, 'SCAN_COMPRESSION',
+        "--compression",
+        choices=list(QUALITY_PRESETS),
+        help="Size/quality preset for the output PDF. Black and white pages are always stored losslessly "
+        "as CCITT G4, grayscale and color pages as Flate (lossless) or JPEG (high, medium, small). "
+        f"Default is {DEFAULT_PRESET}."
+    )
+    add_env_argument(
+        options, 'SCAN_JPEG_QUALITY',
+        "--jpeg-quality",
+        type=int,
+        choices=range(1, 96),
+        metavar="[1-95]",
+        help="JPEG quality for grayscale and color pages, overrides the quality of --compression."
+    )
+    add_env_argument(
+        options, 'SCAN_DROP_BLANK',
+        "-b", "--drop-blank",
+        action="store_true",
+        help="Drop blank pages, e.g. the empty backs of a double-sided scan. Requires numpy."
+    )
+    add_env_argument(
+        options, 'SCAN_BLANK_INK_THRESHOLD',
+        "--blank-ink-threshold",
+        type=float,
+        help="Pages with less than this fraction of ink are considered blank. "
+        f"Default is {BlankPageDetector.DEFAULT_INK_THRESHOLD}."
+    )
+    add_env_argument(
+        options, 'SCAN_BLANK_STD_THRESHOLD',
+        "--blank-std-threshold",
+        type=float,
+        help="Pages with a brightness standard deviation above this are never considered blank. "
+        f"Default is {BlankPageDetector.DEFAULT_STD_THRESHOLD}."
+    )
+    add_env_argument(
+        options, 'SCAN_DESKEW',
+        "--deskew",
+        action="store_true",
+        help="Straighten pages that were fed at an angle. "
+        "Pages are then processed in worker processes. Requires numpy."
+    )
+    add_env_argument(
+        options, 'SCAN_SEPARATOR',
+        "--separator",
+        choices=SeparatorDetector.KINDS,
+        help="Split the stack of a single-sided ADF scan into documents at separator sheets: "
+        "sheets with a barcode or patch code, or blank sheets. Separator sheets are left out "
+        "and the documents are numbered. Requires numpy."
+    )
+    add_env_argument(
+        options, 'SCAN_DUPLICATES',
+        "--duplicates",
+        choices=["flag", "drop"],
+        help="Detect pages scanned twice in a session, e.g. sheets fed again after a misfeed. "
+        "`flag' warns about them, `drop' leaves them out without encoding them. Requires numpy."
+    )
+    add_env_argument(
+        options, 'SCAN_ON_JAM',
+        "--on-jam",
+        choices=["ask", "abort"],
+        default="ask",
+        help="What to do when the ADF stops with an error, e.g. a paper jam. "
+        "`ask' [default] keeps the pages scanned so far and continues the same document once the jam is "
+        "cleared and the remaining sheets are fed again, `abort' saves the partial scan and stops."
+    )
+    add_env_argument(
+        options, 'SCAN_CROP',
+        "--crop",
+        action="store_true",
+        help="Crop pages to their content. "
+        "Pages are then processed in worker processes. Requires numpy."
+    )
+    add_env_argument(
+        options, 'SCAN_DOUBLE_SIDED',
+        "-d", "--double-sided",
+        action="store_true",
+        help="Double-sided scan. Prompts the user to flip the stack, then merges pages."
+    )
+    add_env_argument(
+        options, 'SCAN_MULTIPLE_DOCUMENTS',
+        "-m", "--multidoc",
+        nargs='?',
+        choices=["join", "split"],
+        const="join",
+        help="Keep scanning documents until the user aborts."
+        "If used together with --adf, --multidoc split is used "
+        "and separate documents are created regardless of the option chosen, "
+        "without --adf the following options are available: join [default] or split. "
+        "With `join' a single document is produced from all scanned pages, "
+        "With `split' separate documents are produced from each scanned page."
+    )
+    add_env_argument(
+        options, 'SCAN_ENCODE_WORKERS',
+        "-w", "--encode-workers",
+        type=int,
+        help="Number of workers encoding pages while the ADF keeps feeding. "
+        "Default is the number of CPUs."
+    )
+    add_env_argument(
+        options, 'SCAN_ENCODE_PROCESSES',
+        "--encode-processes",
+        action="store_true",
+        help="Encode pages in worker processes instead of threads."
+    )
+    add_env_argument(
+        options, 'SCAN_MEMORY_BUDGET',
+        "--memory-budget",
+        type=int,
+        metavar="MB",
+        help="Memory for the encoded pages of a job, older pages are moved to a temporary file beyond that. "
+        f"Default is {PageStore.DEFAULT_MEMORY_BUDGET // (1024 * 1024)}."
+    )
+    add_env_argument(
+        options, 'SCAN_STREAM_PDF',
+        "--stream-pdf",
+        action="store_true",
+        help="Write each page to the output PDF as soon as it is scanned (single-sided scans). "
+        "If the scan is interrupted, the partial .pdf.part file can be completed with --recover."
+    )
+    options.add_argument(
+        "--recover",
+        nargs="+",
+        metavar="PART_FILE",
+        help="Complete partial .pdf.part files left behind by an interrupted --stream-pdf scan and exit."
+    )
+    add_env_argument(
+        options, 'SCAN_JOURNAL_DIR',
+        "--journal-dir",
+        metavar="DIR",
+        help="Keep the pages of each scan in a journal below DIR until its PDFs are created, "
+        "so an interrupted scan can be finished with --resume instead of scanned again."
+    )
+    options.add_argument(
+        "--resume",
+        nargs="+",
+        metavar="JOB_DIR",
+        help="Create the PDFs of interrupted scans from their --journal-dir job directories and exit."
+    )
+    add_env_argument(
+        options, 'SCAN_OUTPUT_DIR',
+        "-o", "--output-dir",
+        help="Output directory to store scanned documents in. "
+        "Default is the current work directory."
+    )
+    add_env_argument(
+        options, 'SCAN_OUTPUT_FILENAME',
+        "-n", "--output-filename",
+        help="Filename or filename format of files in output folder. "
+        "Do not include the .pdf ending. "
+        "A suffix _front or _incomplete is added if the scan aborts. "
+        "Default is %%Y-%%m-%%d_%%H%%M_scan."
+    )
+    add_env_argument(
+        options, 'SCAN_PAPER_FORMAT',
+        "-p", "--paper-format",
+        choices=["A4", "Letter", "Legal"],
+        help="Paper format to use. "
+        "Default is depending on your locale."
+    )
+    add_env_argument(
+        options, 'SCAN_RESOLUTION_DPI',
+        "-r", "--resolution",
+        help=f"Scan resolution in DPI Text is recommended at {SimpleCmdScan.DEFAULT_RESOLUTION_TEXT}, "
+        f"pictures at {SimpleCmdScan.DEFAULT_RESOLUTION_PICTURE}. "
+        f"Default {SimpleCmdScan.DEFAULT_RESOLUTION_TEXT} (Text). "
+        "Choices [int], text, image."
+    )
+    options.add_argument(
+        "-f",
+        "--find-scanners",
+        action="store_true",
+        help="Find and list scanners - no actual scanning (useful to set a default with .env). "
+        "Also refreshes the cached list of scanners.",
+    )
+    add_env_argument(
+        options, 'SCAN_DEVICE_CACHE_TTL',
+        "--device-cache-ttl",
+        type=int,
+        help="Seconds to reuse the scanner found by the last search when no --scanner is given, and the "
+        "options the scanner supports, 0 to disable. "
+        f"Default is {DeviceCache.DEFAULT_TTL}."
+    )
+    add_env_argument(
+        options, 'SCAN_DEVICE',
+        "-s", "--scanner",
+        help="Set the scanner to use. "
+        "Default is the first listing with --find-scanners."
+    )
+    add_env_argument(
+        options, 'LOG_LEVEL',
+        "-l", "--loglevel",
+        choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL'],
+        help="Set the log level. Default is WARN."
+    )
+    add_env_argument(
+        options, 'SCAN_METRICS_JSON',
+        "--metrics-json",
+        metavar="PATH",
+        help="Write a JSON report of the time spent per stage, queue depths and bytes written after each job."
+    )
+    add_env_argument(
+        options, 'SCAN_METRICS_PROM',
+        "--metrics-prom",
+        metavar="PATH",
+        help="Write the job metrics in the Prometheus text format, e.g. into the node exporter's "
+        "textfile collector directory as simple_cmd_scan.prom."
+    )
+    options.add_argument(
+        "--profile",
+        metavar="PREFIX",
+        help="Profile each job with cProfile and tracemalloc and write PREFIX.pstats, PREFIX.collapsed with "
+        "stacks for flame graph tools and PREFIX.alloc.txt with the top allocations per stage. "
+        "PREFIX is formatted with the date like --output-filename."
+    )
+    options.add_argument(
+        "--convert",
+        nargs="+",
+        metavar="SOURCE",
+        help="Create PDFs from existing images instead of scanning and exit. Each directory or (quoted) glob "
+        "is one document, or all of them together with --multidoc join. With --double-sided, the images "
+        "of a document are the front sides followed by the back sides as they were scanned. "
+        "Documents are built in parallel by --encode-workers processes."
+    )
+    options.add_argument(
+        "--farm",
+        nargs="*",
+        metavar="DEVICE",
+        help="Scan from the ADFs of several scanners at once, each producing its own documents. "
+        "Without a device list, all scanners found are used. "
+        "Together with --multidoc, keeps waiting for new stacks until CTRL+C."
+    )
+    options.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Run as scan daemon keeping SANE and the scanner open between jobs. "
+        "Scans started while the daemon is running are handed over to it."
+    )
+    add_env_argument(
+        options, 'SCAN_DAEMON_SOCKET',
+        "--daemon-socket",
+        help="Unix socket of the scan daemon. "
+        "Default is $XDG_RUNTIME_DIR/simple-cmd-scan.sock, or daemon.sock in a private directory "
+        "simple-cmd-scan-UID in the temp directory without XDG_RUNTIME_DIR."
+    )
+    options.add_argument(
+        "-v",
+        "--version",
+        action="store_true",
+        help="Print version and exit"
+    )
+
+    return options.parse_args(argv[1:])
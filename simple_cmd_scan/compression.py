@@ -0,0 +1,92 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+
+from .utils import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+# JPEG quality per preset, None keeps grayscale and color pages lossless (Flate)
+QUALITY_PRESETS = {
+    'lossless': None,
+    'high': 90,
+    'medium': 75,
+    'small': 50,
+}
+DEFAULT_PRESET = 'lossless'
+
+
+class CompressionProfile:
+    """
+    How scanned pages of one color mode are encoded. Pages are saved in a
+    format the PDF builder embeds without decoding: TIFF G4 (CCITT) for black
+    and white, JPEG (DCT) or PNG (Flate) for grayscale and color.
+    """
+
+    EXTENSIONS = {'G4': 'tif', 'JPEG': 'jpg', 'PNG': 'png'}
+
+    def __init__(self, format, mode=None, quality=None) -> None:
+        self.format = format
+        self.mode = mode
+        self.quality = quality
+
+    @property
+    def extension(self):
+        return CompressionProfile.EXTENSIONS[self.format]
+
+    def convert(self, im):
+        if self.format == 'G4':
+            return im.mode == '1' and im or im.convert('L').convert('1', dither=Image.Dither.NONE)
+        if self.mode and im.mode != self.mode:
+            return im.convert(self.mode)
+        if im.mode not in ('L', 'RGB'):
+            return im.convert('RGB')
+        return im
+
+    def save(self, im, fp):
+        im = self.convert(im)
+        if self.format == 'G4':
+            save_g4(im, fp)
+        elif self.format == 'JPEG':
+            im.save(fp, format='JPEG', quality=self.quality)
+        else:
+            im.save(fp, format='PNG')
+
+    def __repr__(self):
+        quality = self.quality and f" q{self.quality}" or ""
+        return f"{self.format}{quality} ({self.mode or 'any mode'})"
+
+
+def save_g4(im, fp):
+    # A single strip, so the strip data is one CCITT G4 stream for the whole page
+    params = 'dpi' in im.info and {'dpi': im.info['dpi']} or {}
+    im.save(fp, format='TIFF', compression='group4', strip_size=math.ceil(im.width / 8) * im.height, **params)
+
+
+def get_profile(color_mode=None, preset=DEFAULT_PRESET, jpeg_quality=None):
+    """
+    Compression profile for `color_mode` (color, grayscale or bw) and the
+    size/quality `preset`. `jpeg_quality` overrides the preset's quality.
+    """
+    if color_mode == 'bw':
+        return CompressionProfile('G4', '1')
+
+    mode = color_mode == 'grayscale' and 'L' or None
+    quality = jpeg_quality or QUALITY_PRESETS.get(preset)
+    if quality:
+        return CompressionProfile('JPEG', mode, quality)
+    return CompressionProfile('PNG', mode)
@@ -0,0 +1,130 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import glob
+import logging
+import os
+import re
+
+from .page_encoder import PageEncoder
+from .scan_controller import ScanJob, SimpleCmdScan
+from .utils import device_label
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif', '.webp', '.pbm', '.pgm', '.ppm', '.pnm')
+
+
+def natural_key(path):
+    """Sort key putting page_2 before page_10."""
+    return [part.isdigit() and int(part) or part.lower() for part in re.split(r"(\d+)", path)]
+
+
+def collect_images(source):
+    """The image files of a directory or glob `source` in page order, and a label for the document."""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+        label = os.path.basename(os.path.normpath(source))
+    else:
+        paths = glob.glob(source)
+        label = os.path.splitext(os.path.basename(source))[0]
+    images = [p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(p)]
+    return sorted(images, key=natural_key), device_label(label) or "images"
+
+
+def convert_document(output_dir, output_filename, parts, double_sided=False, suffix=""):
+    """
+    Create the PDF of one document from lists of image files, run in a
+    worker process. With `double_sided`, each part holds the front sides
+    followed by the back sides as they were scanned, interleaved like a
+    duplex scan. Returns the path of the PDF.
+    """
+    job = ScanJob(output_dir, output_filename, default_complete=True)
+    for images in parts:
+        if double_sided:
+            if len(images) % 2:
+                raise ValueError(f"{len(images)} images can't be split into front and back sides")
+            front = ScanJob(output_dir, output_filename)
+            back = ScanJob(output_dir, output_filename)
+            for path in images[:len(images) // 2]:
+                front.add_image(path)
+            for path in images[len(images) // 2:]:
+                back.add_image(path)
+            images = front.merge_back_images(back).images
+        for path in images:
+            job.add_image(path)
+    return job.create_pdf(suffix, quiet_mode=True)
+
+
+class ImageConverter:
+    """
+    Creates PDFs from existing image files instead of scanning, e.g. pages
+    of a failed run or of another capture station. Each directory or glob is
+    one document, or all of them together in multidoc join mode. Documents
+    are built in parallel by a pool of worker processes, each writing one
+    page at a time, so memory stays bounded by the number of workers.
+    """
+
+    def __init__(self, args) -> None:
+        self.controller = SimpleCmdScan(args)
+        self.empty_sources = []
+
+    def documents(self, sources):
+        """(suffix, parts) of the documents to create from `sources`."""
+        documents = []
+        labels = set()
+        for source in sources:
+            images, label = collect_images(source)
+            if not images:
+                self.controller.log_and_print(f"No images found in {source}", logging.WARNING)
+                self.empty_sources.append(source)
+                continue
+            unique_label = label
+            n = 1
+            while unique_label in labels:
+                n += 1
+                unique_label = f"{label}_{n}"
+            labels.add(unique_label)
+            documents.append((unique_label, [images]))
+
+        if self.controller.multidoc_mode == "join" and documents:
+            return [("", [images for _, parts in documents for images in parts])]
+        if len(documents) == 1:
+            return [("", documents[0][1])]
+        return [(f"_{label}", parts) for label, parts in documents]
+
+    def run(self, sources):
+        controller = self.controller
+        documents = self.documents(sources)
+        if not documents:
+            return SimpleCmdScan.RET_ERR
+
+        ret = self.empty_sources and SimpleCmdScan.RET_ERR or SimpleCmdScan.RET_OK
+        with PageEncoder(controller.encode_workers, use_processes=True) as pool:
+            futures = [
+                (parts, pool.submit(convert_document, controller.output_dir, controller.output_filename, parts,
+                                    bool(controller.double_sided), suffix))
+                for suffix, parts in documents
+            ]
+            for parts, future in futures:
+                try:
+                    path = future.result()
+                except Exception as e:
+                    first = parts[0][0]
+                    controller.log_and_print(f"Unable to convert the document starting with {first}: {e}",
+                                             logging.ERROR)
+                    ret = SimpleCmdScan.RET_ERR
+                    continue
+                controller.log_and_print(f"PDF ({sum(len(images) for images in parts)} images) created: {path}")
+        return ret
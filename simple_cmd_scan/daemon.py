@@ -0,0 +1,274 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import io
+import json
+import os
+import select
+import socket
+import stat
+import sys
+import tempfile
+
+from .logger import log, set_log_level
+from .scan_controller import SimpleCmdScan
+from .utils import lazy_import
+
+sane = lazy_import('sane')
+
+
+def get_default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'simple-cmd-scan.sock')
+    return os.path.join(_private_socket_dir(), 'daemon.sock')
+
+
+def _private_socket_dir():
+    # Created by the daemon with mode 0700, so other users cannot place a socket in it
+    return os.path.join(tempfile.gettempdir(), f"simple-cmd-scan-{os.getuid()}")
+
+
+def _make_private_dir(path):
+    """Create the directory `path` accessible only by this user, raises PermissionError if it exists and isn't."""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} is not a directory only this user can access")
+
+
+def _is_own_socket(path):
+    """Whether `path` is a socket of this user, not one another user put in place of the daemon's."""
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def _send(sock, **msg):
+    sock.sendall(json.dumps(msg).encode() + b"\n")
+
+
+class _SocketWriter(io.TextIOBase):
+    """Forwards everything written to it as `{key: text}` message to the client."""
+
+    def __init__(self, sock, key) -> None:
+        self.sock = sock
+        self.key = key
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if s:
+            _send(self.sock, **{self.key: s})
+        return len(s)
+
+
+class DaemonScan(SimpleCmdScan):
+    """
+    A SimpleCmdScan job run by the daemon. SANE stays initialized and device
+    handles are returned to the daemon instead of being closed.
+    """
+
+    def __init__(self, args, daemon) -> None:
+        super().__init__(args)
+        self.daemon = daemon
+
+    def _init_sane(self):
+        return True
+
+    def _open_handle(self, scanner):
+        handle = self.daemon.devices.pop(scanner, None)
+        if handle is not None:
+            log.debug(f"Reusing open device {scanner}")
+            return handle
+        return sane.open(scanner)
+
+    def _close_handle(self, handle):
+        self.daemon.devices[handle.devname] = handle
+
+    def _exit_sane(self):
+        pass
+
+
+class ScanDaemon:
+    """
+    Keeps SANE initialized and devices open between scan jobs. Jobs are
+    received one at a time over a Unix socket, the job's stdin, stdout and
+    stderr are forwarded to the connected client, so prompts work as usual.
+    """
+
+    def __init__(self, socket_path=None) -> None:
+        self.socket_path = socket_path or get_default_socket_path()
+        self.devices = {}
+        self.server = None
+
+    def start(self):
+        """Listen on the socket, raises OSError if another daemon listens on it or it cannot be taken over."""
+        if os.path.dirname(self.socket_path) == _private_socket_dir():
+            _make_private_dir(_private_socket_dir())
+        if os.path.lexists(self.socket_path):
+            if not _is_own_socket(self.socket_path):
+                raise PermissionError(f"{self.socket_path} exists and is not a socket of this user")
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                log.debug(f"Removing stale socket {self.socket_path}")
+                os.remove(self.socket_path)
+            else:
+                raise FileExistsError(f"A scan daemon is already listening on {self.socket_path}")
+            finally:
+                probe.close()
+
+        sane.init()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen()
+        log.info(f"Scan daemon listening on {self.socket_path}")
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+            os.remove(self.socket_path)
+        self.close_devices()
+        sane.exit()
+
+    def close_devices(self):
+        for name, handle in self.devices.items():
+            log.debug(f"Closing device {name}")
+            try:
+                handle.close()
+            except Exception as e:
+                log.warning(f"Error closing device {name}: {e}")
+        self.devices = {}
+
+    def serve_forever(self):
+        try:
+            self.start()
+        except OSError as e:
+            log.error(f"Unable to start the scan daemon: {e}")
+            return SimpleCmdScan.RET_ERR
+        try:
+            while True:
+                conn, _ = self.server.accept()
+                with conn:
+                    self.handle(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        return SimpleCmdScan.RET_OK
+
+    def handle(self, conn):
+        stdin = conn.makefile('r')
+        try:
+            request = json.loads(stdin.readline())
+            args = argparse.Namespace(**request['args'])
+        except (ValueError, KeyError, TypeError) as e:
+            log.error(f"Invalid daemon request: {e}")
+            return
+
+        if args.loglevel:
+            set_log_level(args.loglevel)
+
+        ret = SimpleCmdScan.RET_ERR
+        saved_stdio = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin, sys.stdout, sys.stderr = stdin, _SocketWriter(conn, 'out'), _SocketWriter(conn, 'err')
+        try:
+            ret = DaemonScan(args, self).run()
+        except Exception as e:
+            log.exception(f"Scan job failed: {e}")
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved_stdio
+
+        if ret != SimpleCmdScan.RET_OK:
+            # Start over with fresh handles in case the device is in a bad state
+            self.close_devices()
+
+        try:
+            _send(conn, exit=ret)
+        except OSError:
+            log.debug("Client disconnected before the job finished")
+
+
+def run_client(args, socket_path=None, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
+    """
+    Hand the scan job described by `args` to a running daemon and relay its
+    output and prompts. Returns the job's exit code, or None if no daemon is
+    listening on `socket_path`.
+    """
+    socket_path = socket_path or get_default_socket_path()
+    if not os.path.lexists(socket_path):
+        return None
+    if not _is_own_socket(socket_path):
+        # Prompts, input and jobs would go to whoever created it
+        log.warning(f"Not using {socket_path}, it is not a socket of this user")
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as e:
+        log.debug(f"No scan daemon at {socket_path}: {e}")
+        sock.close()
+        return None
+
+    log.debug(f"Handing scan job to daemon at {socket_path}")
+    job_args = dict(vars(args))
+    # Relative to the client, not the daemon
+    job_args['output_dir'] = os.path.abspath(args.output_dir or os.getcwd())
+    for key in ('metrics_json', 'metrics_prom', 'journal_dir', 'profile'):
+        if job_args.get(key):
+            job_args[key] = os.path.abspath(job_args[key])
+
+    with sock:
+        _send(sock, args=job_args)
+        inputs = [sock, stdin]
+        buffer = b""
+        while True:
+            readable, _, _ = select.select(inputs, [], [])
+            if stdin in readable:
+                line = stdin.readline()
+                if line:
+                    sock.sendall(line.encode())
+                else:
+                    # CTRL+D, the daemon sees the end of its stdin
+                    sock.shutdown(socket.SHUT_WR)
+                    inputs.remove(stdin)
+
+            if sock in readable:
+                data = sock.recv(65536)
+                if not data:
+                    log.error("Scan daemon closed the connection")
+                    return SimpleCmdScan.RET_ERR
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    msg = json.loads(line)
+                    if 'exit' in msg:
+                        return msg['exit']
+                    out = 'err' in msg and stderr or stdout
+                    out.write(msg.get('out', msg.get('err', '')))
+                    out.flush()
@@ -0,0 +1,117 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from .logger import log
+
+
+def get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'simple-cmd-scan')
+
+
+class DeviceCache:
+    """
+    Remembers the result of the last scanner discovery on disk, since
+    `sane.get_devices()` can take several seconds with network backends.
+
+    Entries older than `ttl` seconds are ignored, a `ttl` of 0 disables the
+    cache. Callers are expected to probe the cached device and fall back to a
+    full discovery if it cannot be opened.
+    """
+
+    DEFAULT_TTL = 24 * 60 * 60
+
+    def __init__(self, ttl=DEFAULT_TTL, path=None) -> None:
+        self.ttl = ttl
+        self.path = path or os.path.join(get_cache_dir(), 'devices.json')
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data['timestamp'], [tuple(d) for d in data['devices']]
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.debug(f"Ignoring unreadable device cache {self.path}: {e}")
+            return None, None
+
+    def age(self):
+        timestamp, _ = self._read()
+        if timestamp is None:
+            return None
+        return time.time() - timestamp
+
+    def load(self):
+        """Returns the cached devices, or None if the cache is disabled, missing or expired."""
+        if not self.enabled:
+            return None
+
+        timestamp, devices = self._read()
+        if timestamp is None or time.time() - timestamp > self.ttl:
+            return None
+        return devices
+
+    def save(self, devices):
+        if not self.enabled:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'timestamp': time.time(), 'devices': [list(d) for d in devices]}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Unable to write device cache {self.path}: {e}")
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def needs_refresh(self):
+        age = self.age()
+        return age is not None and age > self.ttl / 2
+
+    @staticmethod
+    def refresh_in_background():
+        """
+        Rediscover devices in a detached process so that it neither delays the
+        current scan nor shares its SANE session.
+        """
+        if getattr(sys, 'frozen', False):
+            cmd = [sys.executable, '--find-scanners']
+        else:
+            cmd = [sys.executable, '-m', 'simple_cmd_scan', '--find-scanners']
+
+        log.debug("Refreshing device cache in the background")
+        try:
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            log.warning(f"Unable to refresh device cache: {e}")
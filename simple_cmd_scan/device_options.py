@@ -0,0 +1,243 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+from contextlib import contextmanager
+from .device_cache import get_cache_dir
+from .logger import log
+
+# SANE option types
+TYPE_BOOL = 0
+TYPE_INT = 1
+TYPE_FIXED = 2
+TYPE_STRING = 3
+
+# SANE option capabilities
+CAP_SOFT_SELECT = 1
+CAP_INACTIVE = 32
+
+# Words in the values of string options backends use for the settings of this tool
+VALUE_ALIASES = {
+    'color': ('color', 'colour', 'rgb'),
+    'grayscale': ('gray', 'grey'),
+    'bw': ('lineart', 'binary', 'black', 'halftone'),
+    'adf': ('adf', 'feeder', 'document'),
+}
+
+
+class UnsupportedSetting(ValueError):
+    pass
+
+
+class DeviceOptions:
+    """
+    The options a scanner offers, by their python-sane attribute names, with
+    type, capabilities and constraint: a list of allowed values, a (min, max,
+    quant) range or None. Settings are checked against them and snapped to
+    the nearest supported value before they are sent to the device. Inactive
+    and read-only options are not set, python-sane refuses them.
+    """
+
+    # Order settings are applied in: the source may change the other constraints, the geometry depends on the mode
+    # and resolution on some backends
+    APPLY_ORDER = ('source', 'batch_scan', 'mode', 'resolution', 'br_x', 'br_y')
+    # Settings after which backends reload their options, with other constraints
+    SOURCE_SETTINGS = ('source', 'batch_scan')
+
+    def __init__(self, options) -> None:
+        self.options = options  # name: {'type': ..., 'cap': ..., 'constraint': ...}
+
+    @staticmethod
+    def from_device(handle):
+        """Read the option descriptors of an open python-sane device."""
+        options = {}
+        for option in handle.get_options():
+            _, name, _, _, type, _, _, cap, constraint = option
+            if not name:  # Groups
+                continue
+            if isinstance(constraint, tuple):
+                constraint = {'range': list(constraint)}
+            elif isinstance(constraint, list):
+                constraint = {'values': constraint}
+            options[name.replace('-', '_')] = {'type': type, 'cap': cap, 'constraint': constraint}
+        return DeviceOptions(options)
+
+    def __bool__(self):
+        return bool(self.options)
+
+    def is_settable(self, name):
+        """Whether option `name` is active and can be set by software."""
+        # Unknown for options cached without capabilities, python-sane then tells when setting them
+        cap = self.options[name].get('cap')
+        return cap is None or bool(cap & CAP_SOFT_SELECT) and not cap & CAP_INACTIVE
+
+    def snap(self, name, value):
+        """The supported value closest to `value` for option `name`. Raises UnsupportedSetting."""
+        option = self.options[name]
+        constraint = option['constraint'] or {}
+        if option['type'] == TYPE_BOOL:
+            return bool(value)
+
+        if 'values' in constraint:
+            allowed = constraint['values']
+            if option['type'] == TYPE_STRING:
+                return DeviceOptions._snap_string(name, value, allowed)
+            # Ties go to the higher value, e.g. a finer resolution
+            return min(allowed, key=lambda v: (abs(v - value), -v))
+
+        if 'range' in constraint and option['type'] in (TYPE_INT, TYPE_FIXED):
+            low, high, quant = constraint['range']
+            value = min(max(value, low), high)
+            if quant:
+                value = min(low + round((value - low) / quant) * quant, high)
+            return option['type'] == TYPE_INT and int(value) or value
+        return value
+
+    @staticmethod
+    def _snap_string(name, value, allowed):
+        if value in allowed:
+            return value
+        for candidate in allowed:
+            if candidate.lower() == str(value).lower():
+                return candidate
+
+        aliases = VALUE_ALIASES.get(str(value).lower(), ())
+        matches = [c for c in allowed if any(alias in c.lower() for alias in aliases)]
+        if matches:
+            # E.g. 'ADF Front' rather than 'ADF Duplex'
+            simplex = [c for c in matches if 'duplex' not in c.lower() and 'back' not in c.lower()]
+            return (simplex or matches)[0]
+        raise UnsupportedSetting(f"{name} {value} is not supported by the device, it supports: {', '.join(allowed)}")
+
+    @staticmethod
+    def ordered(settings):
+        """The (name, value) pairs of `settings` in APPLY_ORDER."""
+        order = DeviceOptions.APPLY_ORDER
+        return sorted(settings.items(), key=lambda item: order.index(item[0]) if item[0] in order else len(order))
+
+    @staticmethod
+    def split_source(settings):
+        """`settings` split into the SOURCE_SETTINGS and the others, which are checked against the source's options."""
+        source = {k: v for k, v in settings.items() if k in DeviceOptions.SOURCE_SETTINGS}
+        return source, {k: v for k, v in settings.items() if k not in source}
+
+    def resolve(self, settings):
+        """
+        The (name, value) pairs to apply for `settings`, in APPLY_ORDER, with
+        snapped values. Options the device does not have, or which are
+        inactive or read-only, are left out.
+        """
+        resolved = []
+        for name, value in DeviceOptions.ordered(settings):
+            if name not in self.options:
+                log.debug(f"Device has no option {name}, not setting it to {value}")
+                continue
+            if not self.is_settable(name):
+                log.info(f"Option {name} of the device is inactive or read-only, not setting it to {value}")
+                continue
+            snapped = self.snap(name, value)
+            if snapped != value:
+                log.info(f"Using {name} {snapped} supported by the device instead of {value}")
+            resolved.append((name, snapped))
+        return resolved
+
+    def to_json(self):
+        return self.options
+
+
+class OptionCache:
+    """
+    Keeps the DeviceOptions of scanner models on disk, so settings can be
+    checked before a device is opened. The options depend on the selected
+    source, they are kept per model and source, see `key`. Entries older
+    than `ttl` seconds are ignored, a `ttl` of 0 disables the cache.
+    """
+
+    def __init__(self, ttl, path=None) -> None:
+        self.ttl = ttl
+        self.path = path or os.path.join(get_cache_dir(), 'options.json')
+
+    @staticmethod
+    def key(model, settings):
+        return f"{model} ({settings.get('source', 'default source')})"
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.debug(f"Ignoring unreadable option cache {self.path}: {e}")
+            return {}
+
+    def load(self, key):
+        if self.ttl <= 0:
+            return None
+        entry = self._read().get(key)
+        try:
+            if time.time() - entry['timestamp'] > self.ttl:
+                return None
+            return DeviceOptions(entry['options'])
+        except (TypeError, KeyError):
+            return None
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serializes the read-modify-write of the cache file between the
+        threads of a farm and other processes, through a lock file.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _write(self, entries):
+        fd, tmp_path = tempfile.mkstemp(prefix='options_', suffix='.tmp', dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _update(self, key, entry):
+        try:
+            with self._locked():
+                entries = self._read()
+                if entry is None:
+                    if entries.pop(key, None) is None:
+                        return
+                else:
+                    entries[key] = entry
+                self._write(entries)
+        except OSError as e:
+            log.warning(f"Unable to write option cache {self.path}: {e}")
+
+    def save(self, key, options):
+        if self.ttl <= 0:
+            return
+        self._update(key, {'timestamp': time.time(), 'options': options.to_json()})
+
+    def remove(self, key):
+        self._update(key, None)
@@ -0,0 +1,130 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import tempfile
+import threading
+
+from .logger import log
+from .page_encoder import PageEncoder
+from .scan_controller import SimpleCmdScan
+from .utils import device_label
+
+
+class FarmScan(SimpleCmdScan):
+    """
+    The capture pipeline of one device in a scanner farm. SANE and the
+    encoder pool are owned by the ScanFarm and shared by all devices.
+    """
+
+    POLL_INTERVAL = 2  # Seconds to wait before checking an empty ADF again
+
+    def __init__(self, args, device, encoder) -> None:
+        super().__init__(args)
+        self.scan_device = device
+        self.encoder = encoder
+        self.adf_scan = True
+        self.output_filename = f"{self.output_filename}_{device_label(device)}"
+        self.batches = 0
+
+    def _init_sane(self):
+        return True
+
+    def _exit_sane(self):
+        pass
+
+    def close_scanner(self):
+        if self.scanner:
+            self._close_handle(self.scanner)
+            self.scanner = None
+
+    def run_batches(self, stop_event):
+        ret = self.open_scanner()
+        if ret != SimpleCmdScan.RET_OK:
+            self.log_and_print(f"Unable to open {self.scan_device}", logging.ERROR)
+            return ret
+
+        try:
+            with tempfile.TemporaryDirectory(prefix="simple_cmd_scan_") as temp_dir, self._use_page_store(temp_dir):
+                while not stop_event.is_set():
+                    job = self._run_multi_scan(stream_pdf=self.stream_pdf)
+                    if job.num_pages:
+                        self.batches += 1
+                        job.create_pdf(f"_{self.batches}{not job.complete and '_partial' or ''}")
+
+                    # Wait for the next stack unless only a single pass was requested
+                    if self.multidoc_mode is None or stop_event.wait(FarmScan.POLL_INTERVAL):
+                        break
+        finally:
+            self.close_scanner()
+
+        return SimpleCmdScan.RET_OK
+
+
+class ScanFarm:
+    """
+    Scans from the ADFs of several devices concurrently, one capture thread per
+    device. Pages of all devices are encoded by one shared pool and each device
+    writes its own output files.
+    """
+
+    def __init__(self, args, devices=None) -> None:
+        self.args = args
+        self.devices = devices
+        self.controller = SimpleCmdScan(args)
+        self.stop_event = threading.Event()
+        self.results = {}
+
+    def _run_device(self, scan):
+        try:
+            self.results[scan.scan_device] = scan.run_batches(self.stop_event)
+        except Exception as e:
+            log.exception(f"Scanning from {scan.scan_device} failed: {e}")
+            self.results[scan.scan_device] = SimpleCmdScan.RET_ERR
+
+    def run(self):
+        if not self.controller.init():
+            return SimpleCmdScan.RET_ERR
+
+        try:
+            devices = self.devices or [d[0] for d in self.controller.list_scanners()]
+            if not devices:
+                self.controller.log_and_print("No scanners found.", logging.WARNING)
+                return SimpleCmdScan.RET_NO_SCANNER
+
+            self.controller.log_and_print(f"Scanning from {len(devices)} devices: {', '.join(devices)}")
+            with PageEncoder(self.controller.encode_workers, self.controller.encode_processes) as encoder:
+                threads = [
+                    threading.Thread(target=self._run_device, args=(FarmScan(self.args, d, encoder),), name=d)
+                    for d in devices
+                ]
+                for t in threads:
+                    t.start()
+                try:
+                    for t in threads:
+                        t.join()
+                except KeyboardInterrupt:
+                    # Finish the batches in progress, then stop
+                    self.controller.log_and_print("Stopping after the current batches...")
+                    self.stop_event.set()
+                    for t in threads:
+                        t.join()
+
+        finally:
+            self.controller.close_scanner()
+
+        failed = [d for d, ret in self.results.items() if ret != SimpleCmdScan.RET_OK]
+        return failed and SimpleCmdScan.RET_ERR or SimpleCmdScan.RET_OK
@@ -0,0 +1,118 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import sys
+
+from .logger import log
+from .utils import lazy_import
+
+Image = lazy_import('PIL.Image')
+shared_memory = sys.version_info >= (3, 8) and lazy_import('multiprocessing.shared_memory') or None
+
+# Bytes per pixel of the modes a frame can be stored in a slot with
+BYTES_PER_PIXEL = {'L': 1, 'RGB': 3, 'RGBA': 4, 'CMYK': 4, 'I;16': 2, 'I': 4, 'F': 4}
+# Modes PIL can wrap around a buffer without copying. RGB is stored with 4 bytes per pixel internally,
+# so it takes one copy in the worker.
+ZERO_COPY_MODES = ('L', 'RGBA', 'CMYK', 'I;16')
+
+# Segments attached by this (worker) process, by name
+_attached = {}
+
+
+def _attach(name):
+    shm = _attached.get(name)
+    if shm is None:
+        try:
+            # The creating process owns the segment, don't let this one unlink it
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:  # Python < 3.13
+            shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    return shm
+
+
+class FrameRef:
+    """A frame stored in a slot of a FrameRing. Cheap to pickle, read where it is received."""
+
+    def __init__(self, shm_name, offset, mode, size, length, info) -> None:
+        self.shm_name = shm_name
+        self.offset = offset
+        self.mode = mode
+        self.size = size
+        self.length = length
+        self.info = info
+
+    def open(self):
+        """The frame as PIL image backed by the shared memory, without copying where the mode allows."""
+        buf = _attach(self.shm_name).buf[self.offset:self.offset + self.length]
+        if self.mode in ZERO_COPY_MODES:
+            im = Image.frombuffer(self.mode, self.size, buf, 'raw', self.mode, 0, 1)
+        else:
+            im = Image.frombytes(self.mode, self.size, buf, 'raw', self.mode)
+        im.info.update(self.info)
+        return im
+
+
+def call_with_frame(fn, ref, *args):
+    """Runs `fn(image, *args)` with the image of the FrameRef `ref`, in the worker."""
+    return fn(ref.open(), *args)
+
+
+class FrameRing:
+    """
+    A ring of fixed size slots in one shared memory segment, through which
+    the capture thread hands frames to encoder processes instead of pickling
+    them. `put` blocks while all slots are in use, `release` frees a slot once
+    its frame has been processed.
+    """
+
+    def __init__(self, slots, slot_size) -> None:
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self._free = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        log.debug(f"Frame ring with {slots} slots of {slot_size} bytes in {self.shm.name}")
+
+    @staticmethod
+    def frame_length(im):
+        """Bytes `im` takes in a slot, None if its mode cannot be stored."""
+        if im.mode == '1':
+            return (im.width + 7) // 8 * im.height
+        if im.mode not in BYTES_PER_PIXEL:
+            return None
+        return im.width * im.height * BYTES_PER_PIXEL[im.mode]
+
+    def fits(self, im):
+        length = FrameRing.frame_length(im)
+        return length is not None and length <= self.slot_size
+
+    def put(self, im):
+        """Copy `im` into a free slot, returns the slot and the FrameRef to pass to a worker."""
+        slot = self._free.get()
+        data = im.tobytes()
+        offset = slot * self.slot_size
+        self.shm.buf[offset:offset + len(data)] = data
+        return slot, FrameRef(self.shm.name, offset, im.mode, im.size, len(data), dict(im.info))
+
+    def release(self, slot):
+        self._free.put(slot)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,345 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .logger import log
+from .utils import lazy_import
+
+Image = lazy_import('PIL.Image')
+np = lazy_import('numpy', optional=True)
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("This feature requires numpy, install it with: pip install simple-cmd-scan[imaging]")
+
+
+def downsample(im, max_width):
+    """
+    Grayscale numpy view of `im`, sampled down to at most `max_width` pixels
+    wide. Nearest neighbor sampling is an order of magnitude faster than
+    averaging and keeps ink coverage and brightness statistics unbiased.
+    """
+    factor = max(1, im.width // max_width)
+    small = factor > 1 and im.resize((im.width // factor, im.height // factor), Image.NEAREST) or im
+    if small.mode != 'L':
+        small = small.convert('L')
+    return np.asarray(small)
+
+
+def histogram_stats(a):
+    """Histogram, mean and standard deviation of an 8 bit image, without sorting."""
+    hist = np.bincount(a.ravel(), minlength=256)
+    levels = np.arange(256)
+    count = hist.sum()
+    mean = (hist * levels).sum() / count
+    std = np.sqrt((hist * (levels - mean) ** 2).sum() / count)
+    return hist, mean, std
+
+
+def paper_level(hist, size):
+    """The paper color, estimated as the brightness at the 90th percentile."""
+    return int(np.searchsorted(np.cumsum(hist), 0.9 * size))
+
+
+class BlankPageDetector:
+    """
+    Detects blank pages from the ink coverage and brightness variation of a
+    downsampled copy of the page. The paper color is estimated per page, so
+    colored or recycled paper works just as well as white.
+
+    A page is considered blank if less than `ink_threshold` (fraction) of its
+    pixels are at least `ink_delta` levels darker than the paper and the
+    standard deviation of the brightness is below `std_threshold`.
+    """
+
+    DEFAULT_INK_THRESHOLD = 0.0001  # Even a lone signature is above this
+    DEFAULT_STD_THRESHOLD = 12
+    SAMPLE_WIDTH = 600  # About 75 dpi for A4 and Letter
+    MARGIN = 0.04  # Ignore ADF shadows and edges at the border of the page
+
+    def __init__(self, ink_threshold=DEFAULT_INK_THRESHOLD, std_threshold=DEFAULT_STD_THRESHOLD,
+                 ink_delta=64) -> None:
+        require_numpy()
+        self.ink_threshold = ink_threshold
+        self.std_threshold = std_threshold
+        self.ink_delta = ink_delta
+
+    def measure(self, im):
+        """Returns the ink coverage and the brightness standard deviation of `im`."""
+        a = downsample(im, BlankPageDetector.SAMPLE_WIDTH)
+        margin_y = int(a.shape[0] * BlankPageDetector.MARGIN)
+        margin_x = int(a.shape[1] * BlankPageDetector.MARGIN)
+        a = a[margin_y:a.shape[0] - margin_y, margin_x:a.shape[1] - margin_x]
+
+        hist, _, std = histogram_stats(a)
+        ink = hist[:max(0, paper_level(hist, a.size) - self.ink_delta)].sum() / a.size
+        return ink, std
+
+    def is_blank(self, im):
+        ink, std = self.measure(im)
+        return ink < self.ink_threshold and std < self.std_threshold
+
+
+class Deskewer:
+    """
+    Straightens pages fed at a slight angle and optionally crops them to their
+    content. The skew angle is the one maximizing the variance of the
+    horizontal projection profile of the ink pixels, i.e. the angle at which
+    text lines line up best. All candidate angles are scored at once on a
+    downsampled page, first coarsely, then refined around the best match.
+    """
+
+    MAX_ANGLE = 5
+    COARSE_STEP = 0.5
+    FINE_STEP = 0.05
+    SAMPLE_WIDTH = 800
+    MAX_POINTS = 50000
+    CROP_MARGIN = 0.02  # Whitespace kept around the content, relative to the page size
+
+    def __init__(self, deskew=True, crop=False, max_angle=MAX_ANGLE, ink_delta=64) -> None:
+        require_numpy()
+        self.deskew = deskew
+        self.crop = crop
+        self.max_angle = max_angle
+        self.ink_delta = ink_delta
+
+    def _ink_mask(self, a):
+        hist, _, _ = histogram_stats(a)
+        paper = paper_level(hist, a.size)
+        return a < paper - self.ink_delta, paper
+
+    @staticmethod
+    def _profile_scores(ys, xs, angles):
+        theta = np.deg2rad(angles)[:, None]
+        bins = np.rint(ys * np.cos(theta) + xs * np.sin(theta)).astype(np.int64)
+        bins -= bins.min()
+        num_bins = int(bins.max()) + 1
+        # One histogram per angle, computed in a single bincount
+        bins += np.arange(len(angles))[:, None] * num_bins
+        hist = np.bincount(bins.ravel(), minlength=len(angles) * num_bins).reshape(len(angles), num_bins)
+        return (hist.astype(np.float64) ** 2).sum(axis=1)
+
+    def estimate_angle(self, mask):
+        """Skew of the ink in `mask` in degrees, counter-clockwise."""
+        ys, xs = np.nonzero(mask)
+        if len(ys) < 2:
+            return 0.0
+        if len(ys) > Deskewer.MAX_POINTS:
+            step = len(ys) // Deskewer.MAX_POINTS + 1
+            ys, xs = ys[::step], xs[::step]
+
+        ys = ys.astype(np.float64)
+        xs = xs.astype(np.float64)
+        angles = np.arange(-self.max_angle, self.max_angle + Deskewer.COARSE_STEP / 2, Deskewer.COARSE_STEP)
+        best = angles[np.argmax(self._profile_scores(ys, xs, angles))]
+        angles = np.arange(best - Deskewer.COARSE_STEP, best + Deskewer.COARSE_STEP + Deskewer.FINE_STEP / 2,
+                           Deskewer.FINE_STEP)
+        return round(float(angles[np.argmax(self._profile_scores(ys, xs, angles))]), 2)
+
+    @staticmethod
+    def content_box(mask, margin):
+        """Bounding box (left, top, right, bottom) of the ink in `mask`, ignoring sparse noise."""
+        rows = np.nonzero(mask.sum(axis=1) > max(1, 0.002 * mask.shape[1]))[0]
+        cols = np.nonzero(mask.sum(axis=0) > max(1, 0.002 * mask.shape[0]))[0]
+        if not len(rows) or not len(cols):
+            return None
+
+        margin_y = int(mask.shape[0] * margin)
+        margin_x = int(mask.shape[1] * margin)
+        return (max(0, cols[0] - margin_x), max(0, rows[0] - margin_y),
+                min(mask.shape[1], cols[-1] + 1 + margin_x), min(mask.shape[0], rows[-1] + 1 + margin_y))
+
+    def apply(self, im):
+        small = downsample(im, Deskewer.SAMPLE_WIDTH)
+        scale = im.width / small.shape[1]
+        mask, paper = self._ink_mask(small)
+        fill = im.mode == 'RGB' and (paper,) * 3 or paper
+
+        if self.deskew:
+            angle = self.estimate_angle(mask)
+            if abs(angle) >= Deskewer.FINE_STEP:
+                log.debug(f"Deskewing page by {angle:.2f} degrees")
+                im = im.rotate(-angle, resample=Image.BILINEAR, fillcolor=fill)
+                if self.crop:
+                    rotated = Image.fromarray(small).rotate(-angle, resample=Image.NEAREST, fillcolor=paper)
+                    mask, _ = self._ink_mask(np.asarray(rotated))
+
+        if self.crop:
+            box = Deskewer.content_box(mask, Deskewer.CROP_MARGIN)
+            if box:
+                im = im.crop(tuple(min(round(v * scale), limit) for v, limit in
+                                   zip(box, (im.width, im.height, im.width, im.height))))
+        return im
+
+
+class SeparatorDetector:
+    """
+    Recognizes the separator sheets put between the documents of an ADF
+    stack. `barcode` separators carry a barcode or patch code: a group of
+    parallel dark bars, in either orientation, which makes up most of the ink
+    on the sheet. Codes are not decoded, any such sheet separates. `blank`
+    separators are the sheets `blank_detector` considers blank.
+
+    Bars are searched in bands across the page. Within a band, columns which
+    are ink over the whole band height are bar columns. A band is part of a
+    code if most of its ink is in several bars close together, and a code
+    has to span a few consecutive bands.
+    """
+
+    KINDS = ('barcode', 'blank')
+    SAMPLE_WIDTH = 800  # About 100 dpi for A4 and Letter
+    BANDS = 60  # Bands along the page, about 5 mm on A4
+    MIN_BANDS = 3
+    MIN_BARS = 3
+    BAR_INK = 0.9  # Fraction of a bar column within a band which is ink, allows for slightly skewed sheets
+    MIN_BAR_SHARE = 0.8  # Fraction of the ink of a code band which is in bars
+    MIN_FILL = 0.2  # Fraction of the code width covered by bars, e.g. the rules of a table are further apart
+    MIN_CODE_SHARE = 0.5  # Fraction of the ink of the page which is in the code
+
+    def __init__(self, kind='barcode', blank_detector=None, ink_delta=64) -> None:
+        require_numpy()
+        if kind not in SeparatorDetector.KINDS:
+            raise ValueError(f"Unknown separator sheet kind: {kind}")
+        self.kind = kind
+        self.blank_detector = blank_detector or BlankPageDetector()
+        self.ink_delta = ink_delta
+
+    def is_separator(self, im):
+        if self.kind == 'blank':
+            return self.blank_detector.is_blank(im)
+
+        a = downsample(im, SeparatorDetector.SAMPLE_WIDTH)
+        margin_y = int(a.shape[0] * BlankPageDetector.MARGIN)
+        margin_x = int(a.shape[1] * BlankPageDetector.MARGIN)
+        a = a[margin_y:a.shape[0] - margin_y, margin_x:a.shape[1] - margin_x]
+        hist, _, _ = histogram_stats(a)
+        mask = a < paper_level(hist, a.size) - self.ink_delta
+        return SeparatorDetector.has_code(mask) or SeparatorDetector.has_code(mask.T)
+
+    @staticmethod
+    def has_code(mask):
+        """Whether the ink `mask` contains a code with its bars along the first axis."""
+        total = mask.sum()
+        band = max(1, len(mask) // SeparatorDetector.BANDS)
+        num_bands = len(mask) // band
+        if not total or num_bands < SeparatorDetector.MIN_BANDS:
+            return False
+
+        # Ink per band and column
+        ink = mask[:num_bands * band].reshape(num_bands, band, -1).sum(axis=1, dtype=np.int32)
+        bar_cols = ink >= SeparatorDetector.BAR_INK * band
+        starts = np.diff(bar_cols.astype(np.int8), axis=1, prepend=0) == 1
+        bar_ink = np.where(bar_cols, ink, 0).sum(axis=1)
+        first = np.argmax(bar_cols, axis=1)
+        code_width = bar_cols.shape[1] - np.argmax(bar_cols[:, ::-1], axis=1) - first
+        in_code = ((starts.sum(axis=1) >= SeparatorDetector.MIN_BARS)
+                   & (bar_ink >= SeparatorDetector.MIN_BAR_SHARE * ink.sum(axis=1))
+                   & (bar_cols.sum(axis=1) >= SeparatorDetector.MIN_FILL * code_width))
+
+        # Runs of consecutive code bands
+        edges = np.diff(in_code.astype(np.int8), prepend=0, append=0)
+        for start, end in zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]):
+            if end - start >= SeparatorDetector.MIN_BANDS \
+                    and bar_ink[start:end].sum() >= SeparatorDetector.MIN_CODE_SHARE * total:
+                return True
+        return False
+
+
+class DuplicateDetector:
+    """
+    Recognizes pages which were scanned before, e.g. sheets fed again after a
+    misfeed. Each page is reduced to a fingerprint: a downsampled copy,
+    deskewed, cropped to its content and scaled to a fixed size, so the
+    shift and skew of a re-fed sheet hardly matter. Its perceptual hash, the
+    signs of the lowest DCT frequencies against their median, indexes the
+    pages. A page is a duplicate of an earlier one within `HASH_RADIUS` bits
+    if their fingerprints correlate by at least `threshold`. Pages with
+    hardly any ink, e.g. blank backs, are never duplicates.
+    """
+
+    DEFAULT_THRESHOLD = 0.82
+    SAMPLE_WIDTH = 400
+    SIZE = (96, 128)
+    HASH_SIZE = 8  # Frequencies per axis, 64 bit hashes
+    HASH_RADIUS = 20
+    MIN_INK = 0.002
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD) -> None:
+        require_numpy()
+        self.threshold = threshold
+        self.deskewer = Deskewer()
+        self._dct_rows = DuplicateDetector._dct_matrix(DuplicateDetector.SIZE[1])
+        self._dct_cols = DuplicateDetector._dct_matrix(DuplicateDetector.SIZE[0])
+        self.labels = []
+        self.hashes = []
+        self.fingerprints = []  # int8, scaled to the largest magnitude
+
+    @staticmethod
+    def _dct_matrix(n):
+        k = np.arange(DuplicateDetector.HASH_SIZE)[:, None]
+        return np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+
+    def fingerprint(self, im):
+        """The fingerprint of `im` (zero mean, unit length) and its hash, None for pages without content."""
+        small = downsample(im, DuplicateDetector.SAMPLE_WIDTH)
+        mask, paper = self.deskewer._ink_mask(small)
+        if mask.mean() < DuplicateDetector.MIN_INK:
+            return None
+
+        page = Image.fromarray(small)
+        angle = self.deskewer.estimate_angle(mask)
+        if abs(angle) >= Deskewer.FINE_STEP:
+            page = page.rotate(-angle, resample=Image.BILINEAR, fillcolor=int(paper))
+            mask, _ = self.deskewer._ink_mask(np.asarray(page))
+        box = Deskewer.content_box(mask, 0)
+        if box is None:
+            return None
+
+        a = np.asarray(page.crop(box).resize(DuplicateDetector.SIZE, Image.BOX), dtype=np.float32)
+        a -= a.mean()
+        norm = np.linalg.norm(a)
+        if not norm:
+            return None
+        a /= norm
+        freqs = (self._dct_rows @ a @ self._dct_cols.T).ravel()[1:]  # Without the mean
+        bits = np.packbits(freqs > np.median(freqs))
+        return a, int.from_bytes(bits.tobytes(), 'big')
+
+    def find(self, im, label):
+        """
+        The label of the earlier page `im` duplicates, or None. Pages which
+        are not duplicates are added to the index under `label`.
+        """
+        result = self.fingerprint(im)
+        if result is None:
+            return None
+        a, page_hash = result
+
+        if self.hashes:
+            distances = np.unpackbits((np.array(self.hashes, dtype=np.uint64) ^ np.uint64(page_hash))
+                                      .view(np.uint8)).reshape(len(self.hashes), -1).sum(axis=1)
+            candidates = np.nonzero(distances <= DuplicateDetector.HASH_RADIUS)[0]
+            if len(candidates):
+                stored = np.stack([self.fingerprints[i] for i in candidates]).astype(np.float32)
+                similarity = stored.reshape(len(candidates), -1) @ a.ravel() / np.linalg.norm(stored, axis=(1, 2))
+                best = int(np.argmax(similarity))
+                if similarity[best] >= self.threshold:
+                    return self.labels[candidates[best]]
+
+        self.labels.append(label)
+        self.hashes.append(page_hash)
+        self.fingerprints.append(np.round(a * (127 / np.abs(a).max())).astype(np.int8))
+        return None
@@ -0,0 +1,207 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from .logger import log
+from .pdf_builder import JPEG_SIGNATURE, PNG_SIGNATURE, TIFF_SIGNATURES
+
+
+class JournaledJob:
+    """The state of one scan job read back from a journal."""
+
+    def __init__(self, job_id) -> None:
+        self.job_id = job_id
+        self.name_suffix = ""
+        self.pages = []  # Page file paths, None for dropped blank pages
+        self.pdf = None  # Path of the PDF created from the job
+        self.merged = None  # (front, back) job ids for a merged duplex job
+
+
+class JobJournal:
+    """
+    A persistent directory with the encoded pages of a scan session and an
+    append-only manifest, so the PDFs can be finished after the process
+    died. Every page file and manifest line is synced to disk before the
+    scan goes on.
+
+    Manifest lines are JSON objects with an `event`: `start` (the settings
+    of the session), `job` (a scan job, e.g. one side of a duplex scan or
+    one document in multidoc mode), `page`, `merge` (front and back sides
+    combined into a new job), `pdf` (a PDF was created from a job) and
+    `end`.
+    """
+
+    MANIFEST = 'manifest.jsonl'
+    VERSION = 1
+
+    def __init__(self, job_dir) -> None:
+        self.job_dir = job_dir
+        self.manifest_path = os.path.join(job_dir, JobJournal.MANIFEST)
+        self.settings = {}
+        self.jobs = {}
+        self.finished = False
+        self._num_pages = 0
+        self._manifest = None
+        # PDFs may be created in the background while pages are added
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create(journal_dir, **settings):
+        """Start a journal in a new directory below `journal_dir`, `settings` are recorded for resuming."""
+        os.makedirs(journal_dir, exist_ok=True)
+        journal = JobJournal(tempfile.mkdtemp(prefix=time.strftime('scan_%Y%m%d_%H%M%S_'), dir=journal_dir))
+        journal._manifest = open(journal.manifest_path, 'a')
+        journal._append({'event': 'start', 'version': JobJournal.VERSION, **settings})
+        journal.settings = settings
+        JobJournal._sync_dir(journal_dir)
+        return journal
+
+    @staticmethod
+    def open(job_dir):
+        """
+        Read the journal in `job_dir` to resume it. A manifest line cut off by
+        a crash is ignored, later entries are appended after it.
+        """
+        journal = JobJournal(job_dir)
+        with open(journal.manifest_path) as f:
+            lines = f.read().split('\n')
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            journal._replay(entry)
+        if not journal.settings:
+            raise ValueError(f"No journal of a scan in {job_dir}")
+        journal._manifest = open(journal.manifest_path, 'a')
+        # Start on a new line in case the last one was cut off
+        journal._manifest.write('\n')
+        return journal
+
+    def _replay(self, entry):
+        event = entry.get('event')
+        if event == 'start':
+            self.settings = {k: v for k, v in entry.items() if k not in ('event', 'version')}
+        elif event == 'job':
+            job = self.jobs[entry['job']] = JournaledJob(entry['job'])
+            job.name_suffix = entry.get('suffix', "")
+        elif event == 'page':
+            page = entry['file'] and os.path.join(self.job_dir, entry['file'])
+            self.jobs[entry['job']].pages.append(page)
+            self._num_pages += 1
+        elif event == 'merge':
+            job = self.jobs[entry['job']] = JournaledJob(entry['job'])
+            job.merged = (entry['front'], entry['back'])
+        elif event == 'pdf':
+            self.jobs[entry['job']].pdf = entry['path']
+        elif event == 'end':
+            self.finished = True
+
+    @staticmethod
+    def _sync_dir(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _append(self, entry):
+        with self._lock:
+            self._manifest.write(json.dumps(entry) + '\n')
+            self._manifest.flush()
+            os.fsync(self._manifest.fileno())
+
+    def start_job(self, name_suffix=""):
+        """Record a new scan job, whose PDF gets `name_suffix` appended to its name. Returns its id."""
+        job_id = len(self.jobs) + 1
+        job = self.jobs[job_id] = JournaledJob(job_id)
+        job.name_suffix = name_suffix
+        entry = {'event': 'job', 'job': job_id}
+        if name_suffix:
+            entry['suffix'] = name_suffix
+        self._append(entry)
+        return job_id
+
+    @staticmethod
+    def _extension(data):
+        head = bytes(data[:8])
+        if head.startswith(PNG_SIGNATURE):
+            return 'png'
+        if head.startswith(JPEG_SIGNATURE):
+            return 'jpg'
+        if head[:4] in TIFF_SIGNATURES:
+            return 'tif'
+        return 'bin'
+
+    def add_page(self, job_id, data):
+        """
+        Write the encoded page `data` (None for a dropped blank page) of job
+        `job_id`. Returns the path of the page file. Pages which already are
+        files are only referenced.
+        """
+        path = None
+        name = None
+        if isinstance(data, str):
+            path = name = os.path.abspath(data)
+        elif data is not None:
+            self._num_pages += 1
+            name = f"page_{self._num_pages:06d}.{JobJournal._extension(data)}"
+            path = os.path.join(self.job_dir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            JobJournal._sync_dir(self.job_dir)
+        self.jobs[job_id].pages.append(path)
+        self._append({'event': 'page', 'job': job_id, 'file': name})
+        return path
+
+    def merge(self, front_id, back_id):
+        """Record front and back sides merged into a new job, returns its id."""
+        job_id = len(self.jobs) + 1
+        job = self.jobs[job_id] = JournaledJob(job_id)
+        job.merged = (front_id, back_id)
+        self._append({'event': 'merge', 'job': job_id, 'front': front_id, 'back': back_id})
+        return job_id
+
+    def pdf_created(self, job_id, path):
+        self.jobs[job_id].pdf = path
+        self._append({'event': 'pdf', 'job': job_id, 'path': path})
+
+    def unfinished_jobs(self):
+        """The jobs without PDF, leaving out duplex sides which were merged into another job."""
+        merged = set()
+        for job in self.jobs.values():
+            if job.merged:
+                merged.update(job.merged)
+        return [job for job in self.jobs.values() if not job.pdf and job.job_id not in merged]
+
+    def close(self, remove=False):
+        """Close the manifest, with `remove` the session is finished and the directory deleted."""
+        if self._manifest:
+            if remove:
+                self._append({'event': 'end'})
+            self._manifest.close()
+            self._manifest = None
+        if remove:
+            shutil.rmtree(self.job_dir, ignore_errors=True)
+            log.debug(f"Journal {self.job_dir} removed")
@@ -0,0 +1,173 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from .logger import log
+
+# The stages of a scan job in pipeline order
+STAGES = [
+    'device_open',  # Finding and opening the scanner, applying options
+    'acquire',  # Reading one page from SANE
+    'encoder_wait',  # Blocked handing a page to the full encoder queue
+    'encode',  # Processing and encoding one page (in the encoder)
+    'pdf_page_wait',  # Blocked handing a page to the full queue of the background PDF
+    'decode',  # Reading an encoded page for the PDF
+    'pdf_page',  # Writing the objects of one PDF page
+    'final_write',  # Writing the page tree, xref and trailer, moving the PDF in place
+]
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class JobMetrics:
+    """
+    Time spent per stage of a scan job, the maximum queue depths and counters
+    such as pages and bytes written. Updated from the capture thread and the
+    encoder callbacks, so all updates are locked.
+    """
+
+    PREFIX = 'simple_cmd_scan'
+
+    def __init__(self, device=None) -> None:
+        self.device = device
+        self.started = time.time()
+        self.finished = None
+        self.result = None
+        self.stages = {}  # name: [count, total seconds, max seconds]
+        self.queues = {}  # name: max depth
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed_iter(self, iterable, stage):
+        """Yields the items of `iterable`, recording the time each one took as `stage`."""
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.observe(stage, time.perf_counter() - start)
+            yield item
+
+    def queue_depth(self, name, depth):
+        with self.lock:
+            self.queues[name] = max(self.queues.get(name, 0), depth)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, result):
+        self.finished = time.time()
+        self.result = result
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def report(self):
+        with self.lock:
+            ordered = sorted(self.stages.items(),
+                             key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))
+            stages = {name: {'count': count, 'seconds': round(total, 6), 'max_seconds': round(maximum, 6)}
+                      for name, (count, total, maximum) in ordered}
+            pages = self.counters.get('pages', 0)
+            return {
+                'device': self.device,
+                'started': self.started,
+                'duration_seconds': round(self.duration, 6),
+                'result': self.result,
+                'pages_per_minute': round(pages / self.duration * 60, 2) if self.duration > 0 else 0,
+                'stages': stages,
+                'max_queue_depth': dict(self.queues),
+                'counters': dict(self.counters),
+            }
+
+    def prometheus_text(self):
+        """The report in the Prometheus text format, for the node exporter's textfile collector."""
+        report = self.report()
+        device = f'device="{_escape_label(report["device"] or "")}"'
+        p = JobMetrics.PREFIX
+        lines = [
+            f"# HELP {p}_stage_seconds Time spent per stage of the last scan job.",
+            f"# TYPE {p}_stage_seconds gauge",
+        ]
+        lines += [f'{p}_stage_seconds{{{device},stage="{s}"}} {v["seconds"]}' for s, v in report['stages'].items()]
+        lines += [f"# HELP {p}_stage_count Times each stage ran in the last scan job.",
+                  f"# TYPE {p}_stage_count gauge"]
+        lines += [f'{p}_stage_count{{{device},stage="{s}"}} {v["count"]}' for s, v in report['stages'].items()]
+        lines += [f"# HELP {p}_stage_max_seconds Longest single run of each stage in the last scan job.",
+                  f"# TYPE {p}_stage_max_seconds gauge"]
+        lines += [f'{p}_stage_max_seconds{{{device},stage="{s}"}} {v["max_seconds"]}'
+                  for s, v in report['stages'].items()]
+        lines += [f"# HELP {p}_queue_depth_max Maximum depth of the queues in the last scan job.",
+                  f"# TYPE {p}_queue_depth_max gauge"]
+        lines += [f'{p}_queue_depth_max{{{device},queue="{q}"}} {v}' for q, v in report['max_queue_depth'].items()]
+        for name, value in sorted(report['counters'].items()):
+            lines += [f"# TYPE {p}_{name} gauge", f"{p}_{name}{{{device}}} {value}"]
+        lines += [
+            f"# TYPE {p}_job_duration_seconds gauge",
+            f"{p}_job_duration_seconds{{{device}}} {report['duration_seconds']}",
+            f"# TYPE {p}_pages_per_minute gauge",
+            f"{p}_pages_per_minute{{{device}}} {report['pages_per_minute']}",
+            f"# TYPE {p}_job_result gauge",
+            f"{p}_job_result{{{device}}} {report['result'] if report['result'] is not None else -1}",
+            f"# TYPE {p}_job_finished_timestamp_seconds gauge",
+            f"{p}_job_finished_timestamp_seconds{{{device}}} {self.finished or time.time()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prometheus_path=None):
+        """Write the JSON report and/or the Prometheus textfile. Failures are logged, not raised."""
+        for path, render in ((json_path, lambda: json.dumps(self.report(), indent=2) + "\n"),
+                             (prometheus_path, self.prometheus_text)):
+            if not path:
+                continue
+            try:
+                _write_atomic(path, render())
+                log.debug(f"Job metrics written to {path}")
+            except (OSError, TypeError) as e:
+                log.warning(f"Unable to write job metrics to {path}: {e}")
@@ -0,0 +1,105 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# concurrent.futures imports the process pool (and multiprocessing) only when it is used
+import concurrent.futures
+import os
+import threading
+
+from .frame_ring import FrameRing, call_with_frame, shared_memory
+from .logger import log
+
+
+class PageEncoder:
+    """
+    Encodes scanned pages in a pool of workers while the scanner keeps feeding.
+
+    At most `max_pending` pages are queued or in progress at any time. `submit`
+    blocks once that limit is reached, so a fast feeder cannot pile up raw
+    frames in memory faster than they are encoded.
+
+    With worker processes, `submit_frame` hands frames over through a ring of
+    shared memory slots instead of pickling them.
+    """
+
+    def __init__(self, workers=None, use_processes=False, max_pending=None, use_shared_memory=True) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.workers
+        self.use_processes = use_processes
+        self.use_shared_memory = use_processes and use_shared_memory and shared_memory is not None
+        self.ring = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self.pending = 0
+        executor_cls = use_processes and concurrent.futures.ProcessPoolExecutor \
+            or concurrent.futures.ThreadPoolExecutor
+        self.executor = executor_cls(max_workers=self.workers)
+        log.debug(f"Page encoder started with {self.workers} "
+                  f"{use_processes and 'processes' or 'threads'}, queue size {self.max_pending}")
+
+    def submit(self, fn, *args):
+        self._slots.acquire()
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self._release_slot(None)
+            raise
+
+        future.add_done_callback(self._release_slot)
+        return future
+
+    def submit_frame(self, fn, im, *args):
+        """Like `submit(fn, im, *args)` for a scanned frame `im`."""
+        if not self.use_shared_memory:
+            return self.submit(fn, im, *args)
+
+        with self._lock:
+            if self.ring is None and FrameRing.frame_length(im):
+                # Slots sized for the first frame, the pages of a job are usually all the same size
+                self.ring = FrameRing(self.max_pending, FrameRing.frame_length(im))
+            ring = self.ring
+        if not ring or not ring.fits(im):
+            log.debug(f"Frame {im.mode} {im.size} does not fit the frame ring, pickling it")
+            return self.submit(fn, im, *args)
+
+        # There is a slot per queued page, so this waits at most for the callback of a finished page
+        slot, ref = ring.put(im)
+        try:
+            future = self.submit(call_with_frame, fn, ref, *args)
+        except Exception:
+            ring.release(slot)
+            raise
+        future.add_done_callback(lambda _future: ring.release(slot))
+        return future
+
+    def _release_slot(self, _future):
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        if self.ring:
+            self.ring.close()
+            self.ring = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -0,0 +1,126 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import threading
+import weakref
+
+from .logger import log
+
+
+class StoredPage:
+    """Handle of a page in a PageStore. The page is freed once the handle is gone."""
+
+    __slots__ = ('index', 'size', 'data', 'offset', '__weakref__')
+
+    def __init__(self, index, data) -> None:
+        self.index = index
+        self.size = len(data)
+        self.data = data
+        self.offset = None
+
+    @property
+    def spilled(self):
+        return self.data is None
+
+    def __repr__(self):
+        return f"StoredPage({self.index}, {self.size} bytes{self.spilled and ', spilled' or ''})"
+
+
+class PageStore:
+    """
+    Holds the encoded pages of a scan session. The most recent pages are kept
+    in memory up to `memory_budget` bytes, older ones are appended as they are
+    to a spill file in `spill_dir` and read back through a memory map without
+    copying. Pages are freed when their handles are no longer referenced, e.g.
+    once the document they belong to is written.
+    """
+
+    DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+    def __init__(self, spill_dir, memory_budget=DEFAULT_MEMORY_BUDGET) -> None:
+        self.spill_path = os.path.join(spill_dir, 'pages.spill')
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.spilled_bytes = 0
+        self._resident = {}  # index: weak reference, oldest first
+        self._next_index = 0
+        self._spill_file = None
+        self._map = None
+        # Reentrant, handles may be collected while the lock is held
+        self._lock = threading.RLock()
+
+    def put(self, data):
+        """Store the encoded page `data` and return its handle."""
+        with self._lock:
+            page = StoredPage(self._next_index, data)
+            self._next_index += 1
+            self._resident[page.index] = weakref.ref(page)
+            self.memory_used += page.size
+            weakref.finalize(page, self._forget, page.index, page.size)
+
+            while self.memory_used > self.memory_budget and self._resident:
+                oldest = self._resident.pop(next(iter(self._resident)))()
+                if oldest is not None:
+                    self._spill(oldest)
+        return page
+
+    def _forget(self, index, size):
+        with self._lock:
+            if self._resident.pop(index, None) is not None:
+                self.memory_used -= size
+
+    def _spill(self, page):
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_path, 'w+b')
+            log.debug(f"Memory budget of {self.memory_budget} bytes exceeded, spilling pages to {self.spill_path}")
+
+        self._spill_file.seek(0, os.SEEK_END)
+        offset = self._spill_file.tell()
+        self._spill_file.write(page.data)
+        page.offset = offset
+        page.data = None
+        self.memory_used -= page.size
+        self.spilled_bytes += page.size
+
+    def read(self, page):
+        """The encoded data of `page`, a memoryview into the spill file if it was spilled."""
+        data = page.data
+        if data is not None:
+            return data
+
+        with self._lock:
+            end = page.offset + page.size
+            if self._map is None or len(self._map) < end:
+                self._spill_file.flush()
+                # Views into a previous, shorter map keep it alive until they are released
+                self._map = mmap.mmap(self._spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._map)[page.offset:end]
+
+    def close(self):
+        with self._lock:
+            self._map = None
+            if self._spill_file:
+                self._spill_file.close()
+                self._spill_file = None
+                os.remove(self.spill_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
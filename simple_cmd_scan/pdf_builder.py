@@ -0,0 +1,531 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from .compression import save_g4
+from .logger import log
+from .metrics import JobMetrics
+from .utils import lazy_import
+
+Image = lazy_import('PIL.Image')
+features = lazy_import('PIL.features')
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8"
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*")
+DEFAULT_DPI = 72  # Same as PIL's PDF plugin when the image carries no resolution
+OBJ_HEADER = re.compile(rb"(\d+) 0 obj\n")
+STREAM_LENGTH = re.compile(rb"/Length (\d+)")
+# Comment in the header of a part file with the JSON encoded name of the PDF it becomes
+OUTPUT_NAME = re.compile(rb'%SimpleCmdScan-Output: (".*")\n')
+
+
+def _num(value):
+    """Format a number the way PDF expects it, without exponent or trailing zeros."""
+    if isinstance(value, int):
+        return str(value)
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+
+class PdfImage:
+    """
+    An image XObject ready to be embedded: its dictionary entries, the
+    (already compressed) stream data and the pixel size and resolution.
+    """
+
+    def __init__(self, width, height, entries, data, dpi=None) -> None:
+        self.width = width
+        self.height = height
+        self.entries = entries
+        self.data = data
+        # TIFF resolutions are rationals, PDF wants plain numbers
+        self.dpi = dpi and tuple(float(d) for d in dpi) or (DEFAULT_DPI, DEFAULT_DPI)
+
+    @staticmethod
+    def from_source(source):
+        """
+        Create from a file path, encoded image data (bytes or memoryview) or a
+        PIL image. PNG, JPEG and G4 TIFF data is embedded as it is (Flate with
+        PNG predictors, DCT and CCITT passthrough), anything else is decoded
+        once and compressed again.
+        """
+        if isinstance(source, Image.Image):
+            return PdfImage.from_pil(source)
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            data = source
+        else:
+            with open(source, "rb") as f:
+                data = f.read()
+
+        image = None
+        head = bytes(data[:len(PNG_SIGNATURE)])
+        if head.startswith(PNG_SIGNATURE):
+            image = PdfImage.from_png_data(data)
+        elif head.startswith(JPEG_SIGNATURE):
+            image = PdfImage.from_jpeg_data(data)
+        elif head.startswith(TIFF_SIGNATURES):
+            image = PdfImage.from_tiff_data(data)
+
+        if image is None:
+            log.debug("No passthrough possible, re-encoding")
+            with Image.open(io.BytesIO(data)) as im:
+                image = PdfImage.from_pil(im)
+        return image
+
+    @staticmethod
+    def from_pil(im):
+        dpi = im.info.get("dpi")
+        if im.mode == "1" and features.check("libtiff"):
+            tiff = io.BytesIO()
+            save_g4(im, tiff)
+            return PdfImage.from_tiff_data(tiff.getvalue())
+
+        if im.mode == "1":
+            colorspace, bpc = "/DeviceGray", 1
+        elif im.mode == "L":
+            colorspace, bpc = "/DeviceGray", 8
+        else:
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            colorspace, bpc = "/DeviceRGB", 8
+
+        entries = {
+            "ColorSpace": colorspace,
+            "BitsPerComponent": bpc,
+            "Filter": "/FlateDecode",
+        }
+        return PdfImage(im.width, im.height, entries, zlib.compress(im.tobytes(), 6), dpi)
+
+    @staticmethod
+    def from_jpeg_data(data):
+        try:
+            with Image.open(io.BytesIO(data)) as im:
+                width, height = im.size
+                mode = im.mode
+                dpi = im.info.get("dpi")
+                inverted = "adobe" in im.info
+        except Exception as e:
+            log.debug(f"Unable to parse JPEG header: {e}")
+            return None
+
+        colorspaces = {"L": "/DeviceGray", "RGB": "/DeviceRGB", "CMYK": "/DeviceCMYK"}
+        if mode not in colorspaces:
+            return None
+
+        entries = {
+            "ColorSpace": colorspaces[mode],
+            "BitsPerComponent": 8,
+            "Filter": "/DCTDecode",
+        }
+        if mode == "CMYK" and inverted:
+            entries["Decode"] = "[1 0 1 0 1 0 1 0]"
+        return PdfImage(width, height, entries, data, dpi)
+
+    @staticmethod
+    def from_tiff_data(data):
+        """
+        Reuse the CCITT G4 data of a single strip bilevel TIFF. Returns None for
+        any other kind of TIFF.
+        """
+        try:
+            with Image.open(io.BytesIO(data)) as im:
+                tags = im.tag_v2
+                compression = im.info.get("compression")
+                width, height = im.size
+                # Without resolution tags, PIL reports a placeholder of 1 dpi
+                dpi = 282 in tags and im.info.get("dpi") or None
+                offsets = tags.get(273)
+                byte_counts = tags.get(279)
+        except Exception as e:
+            log.debug(f"Unable to parse TIFF header: {e}")
+            return None
+
+        if compression != "group4" or not offsets or len(offsets) != 1:
+            return None
+
+        entries = {
+            "ColorSpace": "/DeviceGray",
+            "BitsPerComponent": 1,
+            "Filter": "/CCITTFaxDecode",
+            "DecodeParms": f"<< /K -1 /BlackIs1 true /Columns {width} /Rows {height} >>",
+        }
+        return PdfImage(width, height, entries, data[offsets[0]:offsets[0] + byte_counts[0]], dpi)
+
+    @staticmethod
+    def from_png_data(data):
+        """
+        Reuse the compressed IDAT stream of a PNG. Returns None for PNGs that
+        cannot be embedded unchanged (interlaced, alpha, transparency, 16 bit).
+        """
+        pos = len(PNG_SIGNATURE)
+        header = None
+        palette = None
+        dpi = None
+        idat = []
+        while pos + 8 <= len(data):
+            length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+            chunk = data[pos + 8:pos + 8 + length]
+            pos += 12 + length
+            if chunk_type == b"IHDR":
+                header = struct.unpack(">IIBBBBB", chunk)
+            elif chunk_type == b"PLTE":
+                palette = chunk
+            elif chunk_type == b"pHYs":
+                ppu_x, ppu_y, unit = struct.unpack(">IIB", chunk)
+                if unit == 1:  # pixels per meter
+                    dpi = (round(ppu_x * 0.0254), round(ppu_y * 0.0254))
+            elif chunk_type == b"tRNS":
+                return None
+            elif chunk_type == b"IDAT":
+                idat.append(chunk)
+            elif chunk_type == b"IEND":
+                break
+
+        if not header or not idat:
+            return None
+
+        width, height, bit_depth, color_type, _, _, interlace = header
+        if interlace or bit_depth > 8:
+            return None
+
+        if color_type == 0:
+            colorspace, colors = "/DeviceGray", 1
+        elif color_type == 2:
+            colorspace, colors = "/DeviceRGB", 3
+        elif color_type == 3 and palette:
+            colorspace = f"[/Indexed /DeviceRGB {len(palette) // 3 - 1} <{palette.hex()}>]"
+            colors = 1
+        else:
+            return None
+
+        entries = {
+            "ColorSpace": colorspace,
+            "BitsPerComponent": bit_depth,
+            "Filter": "/FlateDecode",
+            "DecodeParms": f"<< /Predictor 15 /Colors {colors} /BitsPerComponent {bit_depth} /Columns {width} >>",
+        }
+        return PdfImage(width, height, entries, b"".join(idat), dpi)
+
+
+class PdfBuilder:
+    """
+    Minimal PDF writer producing one image per page.
+
+    Objects are written to `f` as soon as a page is added, only the object
+    offsets and page references are kept in memory. The page tree, xref table
+    and trailer are written by `close`. Until then the file holds a sequence
+    of complete page objects which `recover` can pick up again.
+    """
+
+    CATALOG_REF = 1
+    PAGES_REF = 2
+
+    def __init__(self, f, pos=0, offsets=None, pages=None, comment=None) -> None:
+        self.f = f
+        self.offsets = offsets or {}
+        self.pages = pages or []
+        self.next_ref = max([PdfBuilder.PAGES_REF, *self.offsets]) + 1
+        self.pos = pos
+        if not pos:
+            self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+            if comment:
+                self._write(f"%{comment}\n".encode())
+            self._write_object(PdfBuilder.CATALOG_REF, f"<< /Type /Catalog /Pages {PdfBuilder.PAGES_REF} 0 R >>")
+
+    @staticmethod
+    def recover(f):
+        """
+        Continue an unfinished PDF opened as `f` (read/write, binary). Anything
+        after the last complete page, including a page tree and trailer of a
+        finished file, is cut off. Returns None if there is nothing to recover.
+        """
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+
+        offsets = {}
+        pages = []
+        end = 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            match = OBJ_HEADER.search(data)
+            pos = match and match.start() or len(data)
+            while True:
+                match = OBJ_HEADER.match(data, pos)
+                if not match or int(match.group(1)) == PdfBuilder.PAGES_REF:
+                    break
+                line_end = data.find(b"\n", match.end())
+                if line_end < 0:
+                    break
+                body = data[match.end():line_end]
+                obj_end = line_end + 1
+                if data[obj_end:obj_end + 7] == b"stream\n":
+                    length = STREAM_LENGTH.search(body)
+                    obj_end += 7 + int(length.group(1))
+                    if data[obj_end:obj_end + 11] != b"\nendstream\n":
+                        break
+                    obj_end += 11
+                if data[obj_end:obj_end + 7] != b"endobj\n":
+                    break
+
+                offsets[int(match.group(1))] = pos
+                pos = obj_end + 7
+                if int(match.group(1)) == PdfBuilder.CATALOG_REF or b"/Type /Page " in body:
+                    end = pos
+                    if b"/Type /Page " in body:
+                        pages.append(int(match.group(1)))
+
+        if PdfBuilder.CATALOG_REF not in offsets:
+            return None
+
+        f.truncate(end)
+        f.seek(end)
+        offsets = {ref: offset for ref, offset in offsets.items() if offset < end}
+        return PdfBuilder(f, end, offsets, pages)
+
+    @property
+    def num_pages(self):
+        return len(self.pages)
+
+    def _write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
+
+    def sync(self):
+        """Make sure everything written so far survives a crash of the process or host."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def _reserve_ref(self):
+        ref = self.next_ref
+        self.next_ref += 1
+        return ref
+
+    def _write_object(self, ref, body, stream=None):
+        self.offsets[ref] = self.pos
+        self._write(f"{ref} 0 obj\n{body}\n".encode("latin-1"))
+        if stream is not None:
+            self._write(b"stream\n")
+            self._write(stream)
+            self._write(b"\nendstream\n")
+        self._write(b"endobj\n")
+
+    def add_page(self, source):
+        """
+        Add `source` (file path, PIL image or PdfImage) as a new page sized to
+        the image at its resolution. Returns the page object reference.
+        """
+        image = source if isinstance(source, PdfImage) else PdfImage.from_source(source)
+        width_pt = image.width * 72 / image.dpi[0]
+        height_pt = image.height * 72 / image.dpi[1]
+
+        image_ref = self._reserve_ref()
+        entries = "".join(f" /{key} {value}" for key, value in image.entries.items())
+        self._write_object(
+            image_ref,
+            f"<< /Type /XObject /Subtype /Image /Width {image.width} /Height {image.height}"
+            f"{entries} /Length {len(image.data)} >>",
+            image.data)
+
+        content = f"q {_num(width_pt)} 0 0 {_num(height_pt)} 0 0 cm /Im0 Do Q".encode("latin-1")
+        content_ref = self._reserve_ref()
+        self._write_object(content_ref, f"<< /Length {len(content)} >>", content)
+
+        page_ref = self._reserve_ref()
+        self._write_object(
+            page_ref,
+            f"<< /Type /Page /Parent {PdfBuilder.PAGES_REF} 0 R "
+            f"/MediaBox [0 0 {_num(width_pt)} {_num(height_pt)}] "
+            f"/Resources << /XObject << /Im0 {image_ref} 0 R >> >> /Contents {content_ref} 0 R >>")
+        self.pages.append(page_ref)
+        return page_ref
+
+    def close(self, page_order=None):
+        """
+        Write the page tree, xref table and trailer. `page_order` optionally
+        lists the page references in the order they should appear.
+        """
+        kids = self.pages if page_order is None else page_order
+        kids_str = " ".join(f"{ref} 0 R" for ref in kids)
+        self._write_object(PdfBuilder.PAGES_REF, f"<< /Type /Pages /Kids [{kids_str}] /Count {len(kids)} >>")
+
+        xref_pos = self.pos
+        size = self.next_ref
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for ref in range(1, size):
+            if ref in self.offsets:
+                lines.append(f"{self.offsets[ref]:010d} 00000 n \n")
+            else:
+                lines.append("0000000000 65535 f \n")
+        lines.append(f"trailer\n<< /Size {size} /Root {PdfBuilder.CATALOG_REF} 0 R >>\n")
+        lines.append(f"startxref\n{xref_pos}\n%%EOF\n")
+        self._write("".join(lines).encode("latin-1"))
+
+
+class StreamingPdf:
+    """
+    A PDF written page by page to a `.part` file next to the final output.
+    Unless `sync_pages` is off, every page is synced to disk as soon as it is
+    added. `finish` completes the file and atomically renames it to the
+    output path.
+    """
+
+    PART_SUFFIX = ".pdf.part"
+
+    def __init__(self, output_dir, name_prefix, sync_pages=True) -> None:
+        fd, self.part_path = tempfile.mkstemp(prefix=f"{name_prefix}_", suffix=StreamingPdf.PART_SUFFIX, dir=output_dir)
+        self.f = os.fdopen(fd, "wb")
+        # The part file name is made unique, `recover` restores the name of the PDF from the header
+        self.builder = PdfBuilder(self.f, comment=f"SimpleCmdScan-Output: {json.dumps(name_prefix + '.pdf')}")
+        self.sync_pages = sync_pages
+        log.debug(f"Streaming PDF pages to {self.part_path}")
+
+    @property
+    def num_pages(self):
+        return self.builder.num_pages
+
+    def add_page(self, source):
+        ref = self.builder.add_page(source)
+        if self.sync_pages:
+            self.builder.sync()
+        return ref
+
+    def finish(self, output_path, page_order=None):
+        self.builder.close(page_order)
+        if self.sync_pages:
+            self.builder.sync()
+        self.f.close()
+        os.replace(self.part_path, output_path)
+
+    def discard(self):
+        self.f.close()
+        os.remove(self.part_path)
+
+    @staticmethod
+    def output_path(part_path):
+        """
+        The path of the PDF the part file at `part_path` was meant to become:
+        the name recorded in its header, in the directory of the part file.
+        Without one, the part path without its `.part` ending.
+        """
+        with open(part_path, "rb") as f:
+            match = OUTPUT_NAME.search(f.read(4096))
+        try:
+            name = match and json.loads(match.group(1))
+        except ValueError:
+            name = None
+        if not name:
+            return re.sub(r"\.part$", "", str(part_path))
+        return os.path.join(os.path.dirname(part_path), os.path.basename(name))
+
+    @staticmethod
+    def recover(part_path, output_path=None):
+        """
+        Finish the partial PDF at `part_path` with all pages that were completely
+        written. Returns the number of recovered pages, the output is written to
+        `output_path`, by default the `output_path` of the part file.
+        """
+        output_path = output_path or StreamingPdf.output_path(part_path)
+        with open(part_path, "r+b") as f:
+            builder = PdfBuilder.recover(f)
+            if not builder or not builder.num_pages:
+                return 0
+            builder.close()
+            builder.sync()
+        os.replace(part_path, output_path)
+        return builder.num_pages
+
+
+class BackgroundPdf:
+    """
+    A PDF whose page objects are built by a background thread while scanning
+    goes on. Pages may be added in any order: `add_page` returns a future of
+    the page reference, `finish` only writes the page tree in the order of
+    the given references and moves the file in place. Without `finish` the
+    partial file is removed when the context is left.
+
+    The data of queued pages is held outside the page store, `add_page`
+    blocks while `max_pending` pages are queued, so a feeder faster than the
+    writer cannot pile them up in memory.
+    """
+
+    MAX_PENDING = 8
+
+    def __init__(self, output_dir, metrics=None, max_pending=MAX_PENDING) -> None:
+        self.output_dir = output_dir
+        self.metrics = metrics or JobMetrics()
+        self.pdf = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf_pages")
+        self.futures = []
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _add_page(self, source):
+        if self.pdf is None:
+            # Not synced, like PDFs created at the end of a job. A partial file has the pages in feed order
+            # and is not worth recovering.
+            self.pdf = StreamingPdf(self.output_dir, "pages", sync_pages=False)
+        with self.metrics.stage('decode'):
+            image = PdfImage.from_source(source)
+        with self.metrics.stage('pdf_page'):
+            return self.pdf.add_page(image)
+
+    def add_page(self, source):
+        """Queue `source` (encoded data or file path) to be added as a page, returns a future of its reference."""
+        with self.metrics.stage('pdf_page_wait'):
+            self._slots.acquire()
+        try:
+            future = self.executor.submit(self._add_page, source)
+        except Exception:
+            self._slots.release()
+            raise
+        # Also released for pages cancelled by discard
+        future.add_done_callback(lambda _future: self._slots.release())
+        self.futures.append(future)
+        return future
+
+    def finish(self, output_path, pages):
+        """
+        Write the PDF with the pages of the futures `pages` in this order.
+        Raises the error of a page that could not be added.
+        """
+        page_order = [page.result() for page in pages]
+        self.executor.shutdown()
+        self.pdf.finish(output_path, page_order)
+        self.pdf = None
+
+    def discard(self):
+        # Pages not started yet are not built
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        if self.pdf:
+            self.pdf.discard()
+            self.pdf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.discard()
@@ -0,0 +1,226 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import cProfile
+import dis
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+from .logger import log
+
+# Allocations belong to the stage of the innermost frame in their traceback matching one of these
+# (stage, file names, function names or None for all functions of the files)
+STAGE_FRAMES = (
+    ('acquire', ('sane.py',), None),
+    ('save', ('scan_controller.py',), ('_encode_page', '_collect_pages', 'add_image')),
+    ('save', ('compression.py', 'image_filters.py', 'page_store.py', 'frame_ring.py', 'page_encoder.py',
+              'journal.py'), None),
+    ('create_pdf', ('scan_controller.py',), ('create_pdf', '_finish_prebuilt_pdf', '_stream_page')),
+    ('create_pdf', ('pdf_builder.py',), None),
+)
+STAGES = ('acquire', 'save', 'create_pdf', 'other')
+
+
+def classify(traceback):
+    """
+    The stage of a tracemalloc traceback, ordered from the oldest to the most
+    recent frame, and the frame it was recognized by.
+    """
+    for frame in reversed(traceback):
+        name = os.path.basename(frame.filename)
+        for stage, files, functions in STAGE_FRAMES:
+            if name.endswith(files) and (functions is None or _function_name(frame) in functions):
+                return stage, frame
+    return 'other', traceback[-1]
+
+
+# (file name, line): function name, of the files looked up by _function_name
+_functions = {}
+_indexed_files = set()
+
+
+def _function_name(frame):
+    # tracemalloc frames only know file and line, the function is looked up in the compiled source
+    if frame.filename not in _indexed_files:
+        _indexed_files.add(frame.filename)
+        try:
+            with open(frame.filename) as f:
+                _index_functions(compile(f.read(), frame.filename, 'exec'))
+        except (OSError, SyntaxError, ValueError) as e:
+            log.debug(f"Unable to look up the functions of {frame.filename}: {e}")
+    return _functions.get((frame.filename, frame.lineno))
+
+
+def _index_functions(code):
+    for _, line in dis.findlinestarts(code):
+        if line is not None:
+            _functions[(code.co_filename, line)] = code.co_name
+    # Nested code after its parent, so their lines are attributed to them
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _index_functions(const)
+
+
+def format_size(size):
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} KiB"
+    return f"{size / (1024 * 1024):.1f} MiB"
+
+
+class JobProfiler:
+    """
+    Profiles a job, from entering the context to leaving it. Writes
+    `prefix`.pstats with cProfile statistics of all threads,
+    `prefix`.collapsed with sampled stacks in the collapsed format of flame
+    graph tools, and `prefix`.alloc.txt with the top allocation sites per
+    stage at the largest snapshot of the traced memory and at the end of the
+    job. Allocations are attributed to the line of the stage they happened
+    in, e.g. the line of `_encode_page` rather than the line in PIL.
+
+    Memory is traced with tracemalloc in this process only, pages encoded by
+    worker processes are not included.
+    """
+
+    SAMPLE_INTERVAL = 0.01
+    MEMORY_INTERVAL = 0.05
+    # A new peak snapshot is taken when the traced memory grew by this factor
+    PEAK_GROWTH = 1.2
+    SNAPSHOT_SPACING = 10
+    TRACEBACK_FRAMES = 16
+    TOP = 10
+
+    def __init__(self, prefix, top=TOP) -> None:
+        self.prefix = prefix
+        self.top = top
+        self.profiles = []
+        self.stacks = collections.Counter()
+        self.peak_snapshot = None
+        self.peak_size = 0
+        self.peak_time = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        tracemalloc.start(JobProfiler.TRACEBACK_FRAMES)
+        # Started before the profilers, it is left out of the statistics
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+        if sys.version_info < (3, 12):
+            # The profiler of a thread only sees that thread, each new thread gets its own
+            threading.setprofile(self._profile_thread)
+        # From 3.12 on, this one sees all threads
+        self._profile_thread()
+        return self
+
+    def _profile_thread(self, *args):
+        profile = cProfile.Profile()
+        profile.enable()
+        with self._lock:
+            self.profiles.append(profile)
+
+    def _sample(self):
+        next_memory_check = 0
+        own_thread = threading.get_ident()
+        while not self._stop.wait(JobProfiler.SAMPLE_INTERVAL):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own_thread:
+                    self.stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+
+            now = time.monotonic()
+            if now < next_memory_check:
+                continue
+            next_memory_check = now + JobProfiler.MEMORY_INTERVAL
+            size, _ = tracemalloc.get_traced_memory()
+            if size > self.peak_size * JobProfiler.PEAK_GROWTH:
+                self.peak_snapshot = self._snapshot()
+                self.peak_size = size
+                self.peak_time = now - self._start
+                # A snapshot holds the GIL for up to seconds with many traces, keep them to a fraction of the job
+                next_memory_check = time.monotonic() + (time.monotonic() - now) * JobProfiler.SNAPSHOT_SPACING
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        names = []
+        while frame is not None:
+            names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        return ';'.join([thread_name] + names[::-1])
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._sampler.join()
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self.profiles)
+        # The profiler of this thread comes first, it is disabled before the others are collected from it
+        profiles[0].disable()
+        final_snapshot = self._snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        try:
+            self.write(profiles, final_snapshot, peak)
+        except OSError as e:
+            log.warning(f"Unable to write the profile {self.prefix}: {e}")
+
+    def write(self, profiles, final_snapshot, peak):
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(f"{self.prefix}.pstats")
+
+        with open(f"{self.prefix}.collapsed", 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+        with open(f"{self.prefix}.alloc.txt", 'w') as f:
+            f.write(f"Peak traced memory: {format_size(peak)}, worker processes are not traced\n")
+            if self.peak_snapshot:
+                f.write(f"\nAt {format_size(self.peak_size)} after {self.peak_time:.1f} s\n")
+                self._write_stages(f, self.peak_snapshot)
+            f.write("\nAt the end of the job\n")
+            self._write_stages(f, final_snapshot)
+        log.info(f"Profile written to {self.prefix}.pstats, .collapsed and .alloc.txt")
+
+    def _write_stages(self, f, snapshot):
+        sites = {stage: collections.Counter() for stage in STAGES}
+        totals = collections.Counter()
+        for stat in snapshot.statistics('traceback'):
+            stage, frame = classify(stat.traceback)
+            sites[stage][f"{frame.filename}:{frame.lineno}"] += stat.size
+            totals[stage] += stat.size
+
+        for stage in STAGES:
+            f.write(f"  {stage}: {format_size(totals[stage])}\n")
+            for site, size in sites[stage].most_common(self.top):
+                f.write(f"    {format_size(size):>10}  {site}\n")
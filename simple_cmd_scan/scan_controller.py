@@ -18,22 +18,71 @@ import io
 import logging
 import tempfile
 import os
-import sane
 import sys
+import threading
+import time
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from pypdf import PdfWriter, PdfReader
-from PIL import Image
+from .compression import QUALITY_PRESETS, DEFAULT_PRESET, get_profile
+from .device_cache import DeviceCache
+from .device_options import DeviceOptions, OptionCache, UnsupportedSetting
+from .image_filters import BlankPageDetector, Deskewer, DuplicateDetector, SeparatorDetector
+from .journal import JobJournal
 from .logger import log
-from .utils import get_default_paper_size, test_write_to_folder
+from .metrics import JobMetrics
+from .page_encoder import PageEncoder
+from .page_store import PageStore, StoredPage
+from .pdf_builder import BackgroundPdf, PdfImage, StreamingPdf
+from .profiler import JobProfiler
+from .utils import get_default_paper_size, lazy_import, test_write_to_folder
+
+sane = lazy_import('sane')
+
+
+class PageProcessing:
+    """
+    Settings for the steps a scanned page goes through before it is stored.
+    Passed to the encoder workers, so it needs to stay picklable.
+    """
+
+    def __init__(self, profile=None, blank_detector=None, deskewer=None, separator=None) -> None:
+        self.profile = profile or get_profile()
+        self.blank_detector = blank_detector
+        self.deskewer = deskewer
+        self.separator = separator
+
+
+class SeparatorPage:
+    """Encoding result of a separator sheet, which ends the current document."""
+
+
+class DuplicatePage:
+    """Stands in for the encoding result of a duplicate page which is dropped without encoding it."""
 
 
 class ScanJob:
-    def __init__(self, output_dir, output_filename, default_complete=False) -> None:
+    def __init__(self, output_dir, output_filename, default_complete=False, stream_pdf=False, metrics=None,
+                 store=None, page_writer=None, journal=None, name_suffix="") -> None:
         self.scanned_page_images = []
         self.complete = default_complete
         self.output_dir = output_dir
         self.output_filename = output_filename
+        # Appended to the file name, e.g. to number the documents split at separator sheets
+        self.name_suffix = name_suffix
+        self.stream_pdf = stream_pdf
+        self.pdf_stream = None
+        self.metrics = metrics or JobMetrics()
+        self.store = store
+        # BackgroundPdf building the page objects while scanning, with the future of each page's reference
+        self.page_writer = page_writer
+        self.page_refs = []
+        # JobJournal keeping the pages on disk until the PDF is created
+        self.journal = journal
+        self.journal_id = journal and journal.start_job(name_suffix)
+        # The sane error the feeder stopped with, the job continues if the sheets are fed again
+        self.feeder_error = None
 
     @property
     def images(self):
@@ -43,8 +92,52 @@ class ScanJob:
     def num_pages(self):
         return len(self.scanned_page_images)
 
-    def add_image(self, im):
-        self.scanned_page_images.append(im)
+    @property
+    def pages(self):
+        """The images to put into the PDF, without dropped blank pages."""
+        return [im for im in self.scanned_page_images if im is not None]
+
+    def add_image(self, im, dropped_as='blank_pages'):
+        """
+        Add a page: encoded image data, which goes to the journal or page
+        store if there is one, or a file path. None keeps the place of a
+        dropped page, counted as `dropped_as`, so duplex pairing still works.
+        """
+        page = im
+        if self.journal is not None:
+            page = self.journal.add_page(self.journal_id, im)
+        elif self.store is not None and isinstance(im, (bytes, bytearray)):
+            page = self.store.put(im)
+        self.scanned_page_images.append(page)
+        self.metrics.count(im is None and dropped_as or 'pages')
+        ref = None
+        if self.page_writer and im is not None:
+            ref = self.page_writer.add_page(self.read_page(page))
+        self.page_refs.append(ref)
+        if self.stream_pdf and im is not None:
+            self._stream_page(im)
+
+    def read_page(self, page):
+        """The source of `page` for the PDF builder: its data if it is in the page store, else `page` itself."""
+        return isinstance(page, StoredPage) and self.store.read(page) or page
+
+    def _stream_page(self, im):
+        try:
+            if not self.pdf_stream:
+                name_prefix = datetime.now().strftime(self.output_filename) + self.name_suffix
+                self.pdf_stream = StreamingPdf(self.output_dir, name_prefix)
+            with self.metrics.stage('decode'):
+                image = PdfImage.from_source(im)
+            with self.metrics.stage('pdf_page'):
+                self.pdf_stream.add_page(image)
+
+        except Exception as e:
+            # All pages are still kept in the job, the PDF is then created at the end
+            log.warning(f"Unable to stream page to PDF, creating it when the job finishes: {e}")
+            self.stream_pdf = False
+            if self.pdf_stream:
+                self.pdf_stream.discard()
+                self.pdf_stream = None
 
     def mark_complete(self, complete=True):
         self.complete = complete
@@ -53,38 +146,110 @@ class ScanJob:
         if self.num_pages != scan_back.num_pages:
             raise ValueError("Number of front and back pages needs to be the same")
 
-        combined = ScanJob(self.output_dir, self.output_filename, default_complete=True)
+        combined = ScanJob(self.output_dir, self.output_filename, default_complete=True, metrics=self.metrics,
+                           store=self.store, page_writer=self.page_writer)
         combined.scanned_page_images = [None] * (self.num_pages + scan_back.num_pages)
         combined.scanned_page_images[::2] = self.images
         combined.scanned_page_images[1::2] = scan_back.images[::-1]
+        # Pages already built in the background only need to be referenced in the new order
+        combined.page_refs = [None] * len(combined.scanned_page_images)
+        combined.page_refs[::2] = self.page_refs
+        combined.page_refs[1::2] = scan_back.page_refs[::-1]
+        if self.journal:
+            combined.journal = self.journal
+            combined.journal_id = self.journal.merge(self.journal_id, scan_back.journal_id)
         return combined
 
+    def _finish_prebuilt_pdf(self, output_path):
+        try:
+            with self.metrics.stage('final_write'):
+                self.page_writer.finish(output_path, [ref for ref in self.page_refs if ref is not None])
+            return True
+        except Exception as e:
+            log.warning(f"Unable to use the pages built during the scan, creating the PDF from the scans: {e}")
+            self.page_writer.discard()
+            return False
+
     def create_pdf(self, suffix="", quiet_mode=False):
-        if not self.scanned_page_images:
+        """Write the PDF of the pages, returns its path or None without pages."""
+        pages = self.pages
+        if not pages:
             log.debug("No scans available, not creating PDF")
             return
 
-        pdf_writer = PdfWriter()
-
-        for path in self.scanned_page_images:
-            image = Image.open(path)
-            if image.mode == "RGBA":
-                image = image.convert("RGB")
-
-            pdf_bytes = io.BytesIO()
-            image.save(pdf_bytes, format="PDF")
-            pdf_writer.append_pages_from_reader(PdfReader(pdf_bytes))
-
-        output_filename = f"{datetime.now().strftime(self.output_filename)}{suffix}.pdf"
+        output_filename = f"{datetime.now().strftime(self.output_filename)}{self.name_suffix}{suffix}.pdf"
         output_path = os.path.join(self.output_dir, output_filename)
 
-        with open(output_path, "wb") as f:
-            pdf_writer.write(f)
-
-        msg = f"PDF ({len(self.scanned_page_images)} pages) created: {output_path}"
+        if self.pdf_stream:
+            with self.metrics.stage('final_write'):
+                self.pdf_stream.finish(output_path)
+            self.pdf_stream = None
+        elif not self.page_writer or not self._finish_prebuilt_pdf(output_path):
+            # Pages are embedded one at a time, straight from the encoded scans, into a part file which is
+            # only moved in place once complete
+            pdf = StreamingPdf(self.output_dir, output_filename[:-len(".pdf")], sync_pages=False)
+            try:
+                for page in pages:
+                    with self.metrics.stage('decode'):
+                        image = PdfImage.from_source(self.read_page(page))
+                    with self.metrics.stage('pdf_page'):
+                        pdf.add_page(image)
+                with self.metrics.stage('final_write'):
+                    pdf.finish(output_path)
+            except BaseException:
+                pdf.discard()
+                raise
+
+        self.metrics.count('documents')
+        self.metrics.count('bytes_written', os.path.getsize(output_path))
+        if self.journal:
+            self.journal.pdf_created(self.journal_id, output_path)
+
+        msg = f"PDF ({len(pages)} pages) created: {output_path}"
         log.info(msg)
         if not quiet_mode:
             print(msg)
+        return output_path
+
+
+class DocumentWriter:
+    """
+    Creates the PDFs of finished jobs in a background thread, so the next
+    document can be scanned right away. `submit` blocks while `max_pending`
+    documents are waiting to be written. `close` waits for all of them and
+    then raises the error of the first one that failed.
+    """
+
+    DEFAULT_MAX_PENDING = 2
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING, quiet_mode=False) -> None:
+        self.quiet_mode = quiet_mode
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf_documents")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, job, suffix=""):
+        try:
+            self.slots.acquire()
+        except KeyboardInterrupt:
+            # The document is finished, it is still written before the writer is closed
+            self.futures.append(self.executor.submit(job.create_pdf, suffix, self.quiet_mode))
+            raise
+        self.futures.append(self.executor.submit(self._write, job, suffix))
+
+    def _write(self, job, suffix):
+        try:
+            return job.create_pdf(suffix, self.quiet_mode)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        errors = [future.exception() for future in self.futures if future.exception()]
+        self.futures = []
+        if errors:
+            log.error(f"{len(errors)} document(s) could not be written")
+            raise errors[0]
 
 
 class SimpleCmdScan:
@@ -109,6 +274,7 @@ class SimpleCmdScan:
     def __init__(self, args):
         self.quiet_mode = False
         self.scanner = None
+        self.encoder = None
         self.find_scanners = args.find_scanners
         self.scan_device = args.scanner
         self.output_dir = args.output_dir or os.getcwd()
@@ -127,13 +293,64 @@ class SimpleCmdScan:
         self.resolution_dpi = self.resolution_dpi or SimpleCmdScan.DEFAULT_RESOLUTION_TEXT
         self.double_sided = args.double_sided
         self.multidoc_mode = args.multidoc
+        self.encode_workers = args.encode_workers and int(args.encode_workers) or None
+        self.encode_processes = bool(args.encode_processes)
+        self.stream_pdf = bool(args.stream_pdf)
+        preset = args.compression in QUALITY_PRESETS and args.compression or DEFAULT_PRESET
+        jpeg_quality = args.jpeg_quality and int(args.jpeg_quality) or None
+        # 0 is a valid threshold, only unset ones get the defaults
+        blank_thresholds = (
+            BlankPageDetector.DEFAULT_INK_THRESHOLD if args.blank_ink_threshold is None
+            else float(args.blank_ink_threshold),
+            BlankPageDetector.DEFAULT_STD_THRESHOLD if args.blank_std_threshold is None
+            else float(args.blank_std_threshold))
+        blank_detector = None
+        if args.drop_blank:
+            blank_detector = BlankPageDetector(*blank_thresholds)
+        separator = None
+        if args.separator:
+            if self.adf_scan and not self.double_sided:
+                separator = SeparatorDetector(args.separator, BlankPageDetector(*blank_thresholds))
+            else:
+                log.warning("Separator sheets are only detected in single-sided ADF scans, ignoring them")
+        deskewer = None
+        if args.deskew or args.crop:
+            deskewer = Deskewer(bool(args.deskew), bool(args.crop))
+            # Rotating full resolution pages is CPU bound, spread it across cores
+            self.encode_processes = True
+        self.processing = PageProcessing(get_profile(self.color_mode, preset, jpeg_quality), blank_detector, deskewer,
+                                         separator)
+        self.separated_documents = 0
+        self.sheets_fed = 0  # In the current ADF pass, including sheets re-fed after feeder errors
+        # Pages are compared to all earlier pages of the session, i.e. of all documents in multidoc mode
+        self.duplicate_mode = args.duplicates
+        self.on_jam = args.on_jam
+        self.duplicates = self.duplicate_mode and DuplicateDetector() or None
+        # A budget of 0 keeps all pages in the temporary file
+        self.memory_budget = PageStore.DEFAULT_MEMORY_BUDGET if args.memory_budget is None \
+            else int(args.memory_budget) * 1024 * 1024
+        self.page_store = None
+        self.page_writer = None
+        self.document_writer = None
+        self.journal_dir = args.journal_dir
+        self.journal = None
+        self.metrics = JobMetrics(self.scan_device)
+        self.metrics_json = args.metrics_json
+        self.metrics_prom = args.metrics_prom
+        self.profile_prefix = args.profile
+        cache_ttl = DeviceCache.DEFAULT_TTL if args.device_cache_ttl is None else int(args.device_cache_ttl)
+        self.device_cache = DeviceCache(cache_ttl)
+        self.option_cache = OptionCache(cache_ttl)
+        self.device_models = {}  # Device name: vendor and model
 
     def init(self):
         if not test_write_to_folder(self.output_dir):
             self.log_and_print(f"No write access to output folder: {self.output_dir}", logging.ERROR)
             return False
 
-        # Initialize SANE
+        return self._init_sane()
+
+    def _init_sane(self):
         try:
             sane.init()
         except Exception as e:
@@ -149,7 +366,8 @@ class SimpleCmdScan:
             outfile = level >= logging.WARNING and sys.stderr or sys.stdout
             print(msg, file=outfile)
 
-    def set_paper_size(self, paper_format=None):
+    def paper_size_mm(self, paper_format=None):
+        """Width and height of `paper_format`, or of the default paper size of the locale."""
         paper_format = paper_format and paper_format.lower() or get_default_paper_size()
         if paper_format not in SimpleCmdScan.PAPER_SIZES_MM:
             def_paper_format = get_default_paper_size()
@@ -160,10 +378,7 @@ class SimpleCmdScan:
 
         format, width_mm, height_mm = SimpleCmdScan.PAPER_SIZES_MM[paper_format]
         log.debug(f"Using paper format {format}")
-
-        # self.scanner.unit = "UNIT_MM"
-        self.scanner.br_x = width_mm
-        self.scanner.br_y = height_mm
+        return width_mm, height_mm
 
     def list_scanners(self):
         # Format:
@@ -174,12 +389,107 @@ class SimpleCmdScan:
         log.debug("Finding scanners...")
         devices = sane.get_devices()
         log.debug(f"Available scanning devices: {devices}")
+        if devices:
+            self.device_cache.save(devices)
+            self._remember_models(devices)
         return devices
 
+    def _remember_models(self, devices):
+        for name, vendor, model, *_ in devices:
+            self.device_models[name] = f"{vendor} {model}"
+
+    def device_settings(self):
+        """The settings for the device, by python-sane option name."""
+        settings = {'resolution': self.resolution_dpi}
+        if self.color_mode:
+            settings['mode'] = self.color_mode
+        settings['br_x'], settings['br_y'] = self.paper_size_mm(self.paper_format)
+        if self.adf_scan:
+            settings['source'] = "ADF"
+            settings['batch_scan'] = True
+        return settings
+
+    def _open_device(self, scanner):
+        log.info(f"Using device {scanner}")
+        self.metrics.device = scanner
+        settings = self.device_settings()
+        # Options are cached per model where it is known from the device list
+        key = OptionCache.key(self.device_models.get(scanner, scanner), settings)
+        options = self.option_cache.load(key)
+        if options is not None:
+            # Unsupported settings fail before the device is touched
+            resolved = options.resolve(settings)
+
+        self.scanner = self._open_handle(scanner)
+        if options is not None:
+            try:
+                self._apply_settings(resolved)
+                return
+            except sane._sane.error as e:
+                # E.g. other constraints after a firmware update
+                log.info(f"Cached options of {key} are out of date, reading them from the device: {e}")
+        self._configure_from_device(key, settings)
+
+    def _configure_from_device(self, key, settings):
+        """
+        Apply the source settings, then check the others against the options
+        the device has with that source, and cache these under `key`.
+        """
+        options = DeviceOptions.from_device(self.scanner)
+        if not options:
+            # Backend without option descriptors, the settings are applied as they are
+            self._apply_settings(DeviceOptions.ordered(settings))
+            return
+
+        source, others = DeviceOptions.split_source(settings)
+        if source:
+            self._apply_settings(options.resolve(source))
+            # Backends reload their options after a source change, e.g. an ADF takes longer pages than the flatbed
+            options = DeviceOptions.from_device(self.scanner)
+        self.option_cache.save(key, options)
+        self._apply_settings(options.resolve(others))
+
+    def _apply_settings(self, settings):
+        log.debug(f"Configuring scanner: {settings}")
+        for name, value in settings:
+            try:
+                setattr(self.scanner, name, value)
+            except AttributeError as e:
+                # python-sane refuses inactive and read-only options with AttributeError, failing like the device
+                raise sane._sane.error(f"Unable to set {name} to {value}: {e}") from e
+
+    def _open_cached_device(self):
+        devices = self.device_cache.load()
+        if not devices:
+            return False
+        self._remember_models(devices)
+
+        # Opening the device doubles as probe whether the cached entry is still valid
+        try:
+            self._open_device(devices[0][0])
+        except sane._sane.error as e:
+            log.info(f"Cached device {devices[0][0]} unavailable, searching for scanners: {e}")
+            if self.scanner:
+                self.scanner.close()
+                self.scanner = None
+            self.device_cache.clear()
+            return False
+
+        if self.device_cache.needs_refresh():
+            DeviceCache.refresh_in_background()
+        return True
+
     def open_scanner(self):
+        with self.metrics.stage('device_open'):
+            return self._find_and_open_scanner()
+
+    def _find_and_open_scanner(self):
         try:
             scanner = self.scan_device
             if not scanner:
+                if self._open_cached_device():
+                    return SimpleCmdScan.RET_OK
+
                 devices = self.list_scanners()
                 if not devices:
                     self.log_and_print("No scanners found.", logging.WARNING)
@@ -187,56 +497,221 @@ class SimpleCmdScan:
                 # Use the first available scanner
                 scanner = devices[0][0]
 
-            log.info(f"Using device {scanner}")
-            self.scanner = sane.open(scanner)
-            self.scanner.resolution = self.resolution_dpi
-            if self.color_mode:
-                self.scanner.mode = self.color_mode
-            self.set_paper_size(self.paper_format)
-            if self.adf_scan:
-                log.debug("Configuring scanner for ADF...")
-                self.scanner.source = "ADF"
-                self.scanner.batch_scan = True
+            self._open_device(scanner)
 
         except sane._sane.error as e:
             log.error(f"Error opening scanner: {e}")
             return SimpleCmdScan.RET_ERR
 
+        except UnsupportedSetting as e:
+            self.log_and_print(str(e), logging.ERROR)
+            return SimpleCmdScan.RET_ERR
+
         except Exception as e:
             log.error(f"Unknown Error: {e}")
             return SimpleCmdScan.RET_ERR
 
         return SimpleCmdScan.RET_OK
 
+    def _open_handle(self, scanner):
+        return sane.open(scanner)
+
+    def _close_handle(self, handle):
+        handle.close()
+
+    def _exit_sane(self):
+        sane.exit()
+
     def close_scanner(self):
         if self.scanner:
-            self.scanner.close()
+            self._close_handle(self.scanner)
             self.scanner = None
-        sane.exit()
+        if self.encoder:
+            self.encoder.shutdown()
+            self.encoder = None
+        self._exit_sane()
+
+    def get_encoder(self):
+        if not self.encoder:
+            self.encoder = PageEncoder(self.encode_workers, self.encode_processes)
+        return self.encoder
+
+    @staticmethod
+    def _encode_page(im, idx, processing=None):
+        """
+        Process the scanned image `im` and encode it in the format it is
+        embedded into the PDF. Returns the encoded data, None for blank pages
+        and a SeparatorPage for separator sheets.
+        """
+        processing = processing or PageProcessing()
+        if processing.separator and processing.separator.is_separator(im):
+            log.info(f"Page {idx} is a separator sheet")
+            return SeparatorPage()
+
+        if processing.blank_detector and processing.blank_detector.is_blank(im):
+            log.info(f"Dropping blank page {idx}")
+            return None
+
+        if processing.deskewer:
+            im = processing.deskewer.apply(im)
+
+        data = io.BytesIO()
+        processing.profile.save(im, data)
+        log.debug(f"Scanned page {idx} encoded, {data.tell()} bytes")
+        return data.getvalue()
+
+    @staticmethod
+    def _encode_page_timed(im, idx, processing=None):
+        # Timed in the worker, so the time queued for a free worker is not included
+        start = time.perf_counter()
+        data = SimpleCmdScan._encode_page(im, idx, processing)
+        return data, time.perf_counter() - start
+
+    def _new_job(self, default_complete=False, stream_pdf=False):
+        name_suffix = ""
+        if self.processing.separator:
+            # Documents split at separator sheets are numbered, many of them are created within a minute
+            self.separated_documents += 1
+            name_suffix = f"_{self.separated_documents}"
+        return ScanJob(self.output_dir, self.output_filename, default_complete, stream_pdf, self.metrics,
+                       self.page_store, self.page_writer, self.journal, name_suffix)
+
+    def _next_document(self, job):
+        """Finish the document of `job` at a separator sheet, returns the job for the next document."""
+        self.metrics.count('separator_pages')
+        if not job.pages:
+            # Leading or repeated separator sheets
+            return job
+        self._finish_document(job)
+        return self._new_job(stream_pdf=self.stream_pdf)
+
+    def _finish_document(self, job):
+        """Create the PDF of `job`, in the background within `_write_documents_in_background`."""
+        if self.document_writer:
+            self.document_writer.submit(job)
+        else:
+            job.create_pdf(quiet_mode=self.quiet_mode)
+
+    @contextmanager
+    def _write_documents_in_background(self):
+        """
+        Documents finished within are written by a DocumentWriter, leaving the
+        context waits until all of them are written, also on errors and
+        interrupts.
+        """
+        self.document_writer = DocumentWriter(quiet_mode=self.quiet_mode)
+        try:
+            yield self.document_writer
+        finally:
+            writer, self.document_writer = self.document_writer, None
+            writer.close()
+
+    @contextmanager
+    def _use_journal(self):
+        """
+        Journal the pages of the jobs started within to a directory below
+        `journal_dir`, which is removed once the scan ends. If the scan is
+        interrupted, it is kept for `resume_jobs`.
+        """
+        if not self.journal_dir:
+            yield None
+            return
+
+        self.journal = JobJournal.create(
+            self.journal_dir, output_dir=os.path.abspath(self.output_dir), output_filename=self.output_filename,
+            double_sided=bool(self.double_sided), multidoc=self.multidoc_mode)
+        log.info(f"Journaling the scan to {self.journal.job_dir}")
+        try:
+            yield self.journal
+        except BaseException:
+            self.journal.close()
+            self.log_and_print(f"Scan interrupted, finish it with --resume {self.journal.job_dir}", logging.WARNING)
+            raise
+        else:
+            self.journal.close(remove=True)
+        finally:
+            self.journal = None
+
+    @contextmanager
+    def _use_page_store(self, spill_dir):
+        """Keep the pages of the jobs started within in one page store, spilling to `spill_dir`."""
+        with PageStore(spill_dir, self.memory_budget) as self.page_store:
+            try:
+                yield self.page_store
+            finally:
+                self.metrics.count('spilled_bytes', self.page_store.spilled_bytes)
+                self.page_store = None
+
+    @contextmanager
+    def _prebuild_pages(self):
+        """
+        Build the PDF page objects of the jobs started within in the
+        background, as their pages are scanned. Only one PDF can be created
+        from them, see `_stop_prebuilding`.
+        """
+        with BackgroundPdf(self.output_dir, self.metrics) as self.page_writer:
+            try:
+                yield self.page_writer
+            finally:
+                self.page_writer = None
 
     @staticmethod
-    def _save_single_page(im, idx, temp_dir):
-        file_name = f"scan_{idx}.png"
-        file_path = os.path.join(temp_dir, file_name)
-        im.save(file_path)
-        log.debug(f"Scanned image saved to {file_path}")
-        return file_path
+    def _stop_prebuilding(*jobs):
+        # For separate PDFs from the jobs, created from their scans
+        for job in jobs:
+            if job.page_writer:
+                job.page_writer.discard()
+                job.page_writer = None
 
     def _handle_sane_error(self, e, job):
         job.mark_complete(False)
         msg = f"An error occurred during scanning: {e}"
         self.log_and_print(msg, logging.ERROR)
 
-    def _run_one_sided_scan(self, temp_dir, idx_offset=0, job=None):
+    def _run_adf_scan(self, idx_offset=0, stream_pdf=False, job=None):
+        """
+        Scan the stack in the feeder into a new job, or add it to `job`, e.g.
+        the document of multidoc join mode. When the feeder fails, e.g. on a
+        paper jam, the operator can clear it and re-feed the sheets not
+        scanned yet, which are added to the same job.
+        """
+        self.sheets_fed = 0
+        if job is not None:
+            idx_offset += job.num_pages
+        job = self._run_multi_scan(idx_offset, stream_pdf, job)
+        while job.feeder_error is not None and self._refeed_after_jam(job):
+            job = self._run_multi_scan(idx_offset, stream_pdf, job)
+        return job
+
+    def _refeed_after_jam(self, job):
+        """Ask the operator to re-feed after a feeder error, returns False to stop scanning."""
+        self.metrics.count('feeder_errors')
+        if self.on_jam != 'ask':
+            return False
+        try:
+            input(f"The feeder stopped after {self.sheets_fed} sheets. Clear the jam, put the sheets from sheet "
+                  f"{self.sheets_fed + 1} on back into the feeder and press Enter to continue or CTRL+D to stop...")
+        except EOFError:
+            return False
+        log.info(f"Continuing the scan after a feeder error with {job.num_pages} pages")
+        return True
+
+    def _run_one_sided_scan(self, idx_offset=0, job=None, stream_pdf=False):
         if self.adf_scan:
-            return self._run_multi_scan(temp_dir, idx_offset)
+            return self._run_adf_scan(idx_offset, stream_pdf, job)
 
         try:
             log.debug("Scanning page...")
-            job = job or ScanJob(self.output_dir, self.output_filename, default_complete=True)
-            im = self.scanner.scan()
-            file_path = SimpleCmdScan._save_single_page(im, job.num_pages + idx_offset + 1, temp_dir)
-            job.add_image(file_path)
+            job = job or self._new_job(default_complete=True, stream_pdf=stream_pdf)
+            idx = job.num_pages + idx_offset + 1
+            with self.metrics.stage('acquire'):
+                im = self.scanner.scan()
+            if self._is_dropped_duplicate(im, idx):
+                job.add_image(None, dropped_as='duplicate_pages')
+                return job
+            with self.metrics.stage('encode'):
+                data = SimpleCmdScan._encode_page(im, idx, self.processing)
+            job.add_image(data)
 
         except sane._sane.error as e:
             self._handle_sane_error(e, job)
@@ -250,20 +725,93 @@ class SimpleCmdScan:
 
         return job
 
-    def _run_multi_scan(self, temp_dir, idx_offset=0):
-        job = ScanJob(self.output_dir, self.output_filename)
+    def _is_dropped_duplicate(self, im, idx):
+        """
+        Check whether `im` was scanned before in this session, before it is
+        encoded. Returns True if it is to be dropped.
+        """
+        if not self.duplicates:
+            return False
+        separator = self.processing.separator
+        if separator and separator.is_separator(im):
+            # Separator sheets all look alike
+            return False
+
+        with self.metrics.stage('duplicate_check'):
+            earlier = self.duplicates.find(im, idx)
+        if earlier is None:
+            return False
+        if self.duplicate_mode == 'drop':
+            log.info(f"Dropping page {idx}, a duplicate of page {earlier}")
+            return True
+        self.metrics.count('duplicate_pages')
+        self.log_and_print(f"Page {idx} looks like a duplicate of page {earlier}", logging.WARNING)
+        return False
+
+    def _collect_pages(self, job, pending, wait=True):
+        """Add the encoded pages to `job`, returns the job later pages go to after separator sheets."""
+        # Pages are added in feed order, regardless of which worker finished first
+        while pending and (wait or pending[0].done()):
+            future = pending.pop(0)
+            try:
+                data, seconds = future.result()
+                if isinstance(data, DuplicatePage):
+                    job.add_image(None, dropped_as='duplicate_pages')
+                    continue
+                self.metrics.observe('encode', seconds)
+                if isinstance(data, SeparatorPage):
+                    job = self._next_document(job)
+                else:
+                    job.add_image(data)
+            except Exception as e:
+                job.mark_complete(False)
+                log.exception(f"An error occurred while saving a page: {e}")
+        return job
+
+    def _run_multi_scan(self, idx_offset=0, stream_pdf=False, job=None):
+        """Scan the stack in the feeder into a new job, or continue `job`, e.g. after a feeder error."""
+        if job is None:
+            job = self._new_job(stream_pdf=stream_pdf)
+        else:
+            # Page numbers continue with the re-fed sheets
+            idx_offset += self.sheets_fed
+            job.feeder_error = None
+        encoder = self.get_encoder()
+        pending = []
+        feeder_error = None
         try:
-            for i, im in enumerate(self.scanner.multi_scan()):
-                file_path = SimpleCmdScan._save_single_page(im, idx_offset + i, temp_dir)
-                job.add_image(file_path)
+            # The feeder only hands frames over, encoding happens in the pool
+            for i, im in enumerate(self.metrics.timed_iter(self.scanner.multi_scan(), 'acquire')):
+                self.sheets_fed += 1
+                if self._is_dropped_duplicate(im, idx_offset + i):
+                    # Kept in line with the other pages, to be added in feed order
+                    future = Future()
+                    future.set_result((DuplicatePage(), 0))
+                    pending.append(future)
+                    continue
+                with self.metrics.stage('encoder_wait'):
+                    pending.append(
+                        encoder.submit_frame(SimpleCmdScan._encode_page_timed, im, idx_offset + i, self.processing))
+                self.metrics.queue_depth('encoder', encoder.pending)
+                job = self._collect_pages(job, pending, wait=False)
+                self.metrics.queue_depth('uncollected', len(pending))
             job.mark_complete()
 
         except sane._sane.error as e:
             self._handle_sane_error(e, job)
+            feeder_error = e
 
         except Exception as e:
             log.exception(f"An error occurred during scanning: {e}")
 
+        finally:
+            job = self._collect_pages(job, pending)
+
+        if feeder_error is not None:
+            # Pages after a separator sheet went to a new job, which is the one to continue
+            job.mark_complete(False)
+            job.feeder_error = feeder_error
+
         return job
 
     def scan_single_sided(self):
@@ -271,19 +819,21 @@ class SimpleCmdScan:
         if ret != SimpleCmdScan.RET_OK:
             return ret
 
-        with tempfile.TemporaryDirectory(prefix="scan") as temp_dir:
+        with tempfile.TemporaryDirectory(prefix="scan") as temp_dir, self._use_page_store(temp_dir), \
+                self._use_journal(), self._write_documents_in_background():
             job = None
             if self.multidoc_mode == "join":
-                job = ScanJob(self.output_dir, self.output_filename, default_complete=True)
+                job = self._new_job(default_complete=True, stream_pdf=self.stream_pdf)
 
             try:
                 for _ in range(SimpleCmdScan.MAX_SCANS):
-                    job = self._run_one_sided_scan(temp_dir, job=job)
+                    job = self._run_one_sided_scan(job=job, stream_pdf=self.stream_pdf)
                     if self.multidoc_mode is None:
                         break
                     else:
                         if self.multidoc_mode == "split":
-                            job.create_pdf()
+                            # Written while the next document is fed
+                            self._finish_document(job)
                             job = None
 
                         input(
@@ -297,7 +847,7 @@ class SimpleCmdScan:
             finally:
                 self.close_scanner()
                 if job is not None:
-                    job.create_pdf()
+                    self._finish_document(job)
 
         return SimpleCmdScan.RET_OK
 
@@ -306,10 +856,13 @@ class SimpleCmdScan:
         if ret != SimpleCmdScan.RET_OK:
             return ret
 
-        with tempfile.TemporaryDirectory(prefix="simple_cmd_scan_") as temp_dir:
+        # Page objects are built while the stack is flipped and the back sides are scanned,
+        # the merged PDF then only needs its page tree in the interleaved order
+        with tempfile.TemporaryDirectory(prefix="simple_cmd_scan_") as temp_dir, self._use_page_store(temp_dir), \
+                self._use_journal(), self._prebuild_pages():
             try:
                 # Scan the front sides
-                scan_front = self._run_one_sided_scan(temp_dir)
+                scan_front = self._run_one_sided_scan()
                 if not scan_front.complete:
                     log.error(
                         "Error while scanning, aborting double-sided scan. Saving partial scan."
@@ -325,11 +878,12 @@ class SimpleCmdScan:
                     return SimpleCmdScan.RET_ERR
 
                 # Scan the back sides
-                scan_back = self._run_one_sided_scan(temp_dir, scan_front.num_pages)
+                scan_back = self._run_one_sided_scan(scan_front.num_pages)
                 if not scan_back.complete:
                     log.error(
                         "Error while scanning, aborting double-sided scan. Saving partial scans."
                     )
+                    SimpleCmdScan._stop_prebuilding(scan_front, scan_back)
                     scan_front.create_pdf("_front")
                     scan_back.create_pdf("_back_partial")
                     return SimpleCmdScan.RET_ERR
@@ -341,6 +895,7 @@ class SimpleCmdScan:
                 log.error(
                     "Mismatch in the number of front and back pages. Creating separate output files."
                 )
+                SimpleCmdScan._stop_prebuilding(scan_front, scan_back)
                 scan_front.create_pdf("_front")
                 scan_back.create_pdf("_back")
                 return SimpleCmdScan.RET_ERR
@@ -353,7 +908,92 @@ class SimpleCmdScan:
 
         return SimpleCmdScan.RET_OK
 
+    def resume_jobs(self, job_dirs):
+        """Create the PDFs of the scans journaled in `job_dirs` which were interrupted."""
+        ret = SimpleCmdScan.RET_OK
+        for job_dir in job_dirs:
+            try:
+                journal = JobJournal.open(job_dir)
+            except (OSError, ValueError) as e:
+                self.log_and_print(f"Unable to resume {job_dir}: {e}", logging.ERROR)
+                ret = SimpleCmdScan.RET_ERR
+                continue
+
+            try:
+                self._resume_journal(journal)
+            except Exception as e:
+                self.log_and_print(f"Unable to resume {job_dir}: {e}", logging.ERROR)
+                journal.close()
+                ret = SimpleCmdScan.RET_ERR
+                continue
+            journal.close(remove=True)
+        return ret
+
+    def _resume_journal(self, journal):
+        settings = journal.settings
+        output_dir = settings.get('output_dir') or self.output_dir
+        output_filename = settings.get('output_filename') or SimpleCmdScan.DEFAULT_OUTPUT_FILENAME
+
+        def rebuild(journaled):
+            job = ScanJob(output_dir, output_filename, default_complete=True, metrics=self.metrics,
+                          name_suffix=journaled.name_suffix)
+            job.scanned_page_images = list(journaled.pages)
+            job.page_refs = [None] * job.num_pages
+            job.journal = journal
+            job.journal_id = journaled.job_id
+            return job
+
+        jobs = journal.unfinished_jobs()
+        if not jobs:
+            self.log_and_print(f"All documents of {journal.job_dir} were already created")
+            return
+
+        sides = [job for job in jobs if not job.merged]
+        if settings.get('double_sided') and len(sides) == 2 and len(sides[0].pages) == len(sides[1].pages):
+            # Interrupted after the back sides were scanned, before they were merged
+            front, back = rebuild(sides[0]), rebuild(sides[1])
+            front.merge_back_images(back).create_pdf(quiet_mode=self.quiet_mode)
+            return
+
+        for journaled in jobs:
+            if journaled.merged:
+                front, back = (rebuild(journal.jobs[job_id]) for job_id in journaled.merged)
+                job = front.merge_back_images(back)
+                job.journal_id = journaled.job_id
+                job.create_pdf(quiet_mode=self.quiet_mode)
+            else:
+                suffix = ""
+                if settings.get('double_sided'):
+                    # Sides of a duplex scan with missing back sides are saved separately
+                    suffix = journaled is sides[0] and "_front" or "_back"
+                rebuild(journaled).create_pdf(suffix, quiet_mode=self.quiet_mode)
+
+    def recover_pdfs(self, part_paths):
+        ret = SimpleCmdScan.RET_OK
+        for part_path in part_paths:
+            try:
+                output_path = StreamingPdf.output_path(part_path)
+                num_pages = StreamingPdf.recover(part_path, output_path)
+            except OSError as e:
+                self.log_and_print(f"Unable to recover {part_path}: {e}", logging.ERROR)
+                ret = SimpleCmdScan.RET_ERR
+                continue
+
+            if num_pages:
+                self.log_and_print(f"Recovered {num_pages} pages from {part_path} to {output_path}")
+            else:
+                self.log_and_print(f"No complete pages found in {part_path}", logging.WARNING)
+                ret = SimpleCmdScan.RET_ERR
+        return ret
+
     def run(self):
+        if not self.profile_prefix:
+            return self._run()
+        # Formatted like the file names, so each job of a daemon gets its own profile
+        with JobProfiler(datetime.now().strftime(self.profile_prefix)):
+            return self._run()
+
+    def _run(self):
         if not self.init():
             return SimpleCmdScan.RET_ERR
 
@@ -369,10 +1009,15 @@ class SimpleCmdScan:
                 or SimpleCmdScan.RET_OK
             )
 
-        ret = SimpleCmdScan.RET_OK
-        if self.double_sided:
-            ret = self.scan_double_sided()
-        else:
-            ret = self.scan_single_sided()
+        ret = SimpleCmdScan.RET_ERR
+        try:
+            if self.double_sided:
+                ret = self.scan_double_sided()
+            else:
+                ret = self.scan_single_sided()
+        finally:
+            self.metrics.finish(ret)
+            self.metrics.write(self.metrics_json, self.metrics_prom)
+            log.debug(f"Job metrics: {self.metrics.report()}")
 
         return ret
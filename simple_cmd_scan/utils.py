@@ -14,12 +14,62 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import importlib
+import importlib.util
 import locale
 import os
+import re
+import threading
 
 from .logger import log
 
 
+class LazyModule:
+    """
+    Stands in for a module which is only imported when one of its attributes
+    is first used, so commands which don't need it (--help, --version) start
+    quickly. Safe to use from several threads.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, name) -> None:
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with LazyModule._lock:
+                module = self.__dict__['_module'] or importlib.import_module(self.__dict__['_name'])
+                self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return f"<lazy module {self.__dict__['_name']}>"
+
+
+def lazy_import(name, optional=False):
+    """
+    `name` as LazyModule. With `optional`, None is returned if the module is
+    not installed, like a failed import of an optional dependency.
+    """
+    if optional and importlib.util.find_spec(name.split('.')[0]) is None:
+        return None
+    return LazyModule(name)
+
+
+def device_label(device):
+    """A file name friendly version of a SANE device name."""
+    return re.sub(r"[^A-Za-z0-9]+", "_", device).strip("_")
+
+
 def get_default_paper_size():
     # Check LC_PAPER environment variable
     loc = os.environ.get('LC_PAPER')
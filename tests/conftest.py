@@ -0,0 +1,46 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+import fake_sane
+from simple_cmd_scan import scan_controller
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path, monkeypatch):
+    """Keep the device cache of the user running the tests untouched."""
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture
+def fake_scan(mocker, tmp_path):
+    """
+    `fake_scan(*options, **backend)`: a SimpleCmdScan of the command line
+    `options`, scanning at 75 DPI to `tmp_path`/scan.pdf from the fake
+    scanner, configured with the FakeBackend arguments `backend`.
+    """
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+
+    def make(*options, **backend):
+        fake_sane.configure(**backend)
+        return SimpleCmdScan(AppStarter.parse_arguments(
+            ['simple-cmd-scan', '-r', '75', '-s', 'fake:scanner0', '-o', str(tmp_path), '-n', 'scan', *options]))
+    return make
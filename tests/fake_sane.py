@@ -0,0 +1,352 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+A stand-in for the `sane` module (python-sane) with virtual scanners
+producing synthetic pages, for tests and benchmarks without hardware.
+
+Install it before simple_cmd_scan imports `sane`:
+
+    import fake_sane
+    fake_sane.install(pages_per_minute=60, stack_size=20)
+"""
+
+import random
+import sys
+import threading
+import time
+import types
+
+from PIL import Image, ImageDraw
+
+MM_PER_INCH = 25.4
+CAP_SOFT_SELECT = 1
+CAP_SOFT_DETECT = 4
+CAP_INACTIVE = 32
+OUT_OF_DOCUMENTS = 'Document feeder out of documents'
+
+# (name, type, unit, constraint[, cap]) following the SANE option type, unit and capability numbers, in
+# FakeBackend.options
+FAKE_OPTIONS = [
+    ('resolution', 1, 4, [75, 150, 200, 300, 600]),
+    ('mode', 3, 0, ['color', 'grayscale', 'bw']),
+    ('source', 3, 0, ['Flatbed', 'ADF']),
+    ('batch_scan', 0, 0, None),
+    ('tl_x', 2, 3, (0.0, 215.9, 0.0)),
+    ('tl_y', 2, 3, (0.0, 355.6, 0.0)),
+    ('br_x', 2, 3, (0.0, 215.9, 0.0)),
+    ('br_y', 2, 3, (0.0, 355.6, 0.0)),
+]
+
+
+class error(Exception):
+    pass
+
+
+# python-sane raises errors of the C extension as sane._sane.error
+_sane = types.SimpleNamespace(error=error)
+
+
+class FakeBackend:
+    """
+    Settings of the virtual scanners. `pages_per_minute` emulates the feed rate,
+    `stack_size` the number of sheets in the ADF for each `multi_scan`,
+    `discovery_delay` the time `get_devices` takes. `jam_after` makes the ADF
+    fail once after this many pages of a stack, the next `multi_scan` then
+    feeds the sheets not scanned yet, as re-fed after clearing the jam, and
+    numbers them on from the jammed one. Each sheet has text of its own,
+    `refed_sheets` maps sheet numbers of a stack (from 1) to the earlier one
+    they are a copy of, like a sheet fed twice. The sheets of a stack numbered in
+    `separator_sheets` (from 1) are separator sheets with a patch code.
+    `options` replaces the option descriptors of FAKE_OPTIONS, values outside
+    their constraints are rejected like by real devices. `source_options`
+    maps source names to descriptors replacing those of `options` while the
+    source is selected, e.g. the page sizes of the ADF.
+    """
+
+    def __init__(self, devices=None, pages_per_minute=0, stack_size=10, discovery_delay=0,
+                 jam_after=None, separator_sheets=(), refed_sheets=None, options=None, source_options=None) -> None:
+        self.devices = devices or [('fake:scanner0', 'Fake', 'Virtual ADF Scanner', 'flatbed scanner')]
+        self.pages_per_minute = pages_per_minute
+        self.stack_size = stack_size
+        self.discovery_delay = discovery_delay
+        self.jam_after = jam_after
+        self.separator_sheets = separator_sheets
+        self.refed_sheets = refed_sheets or {}
+        self.options = options or FAKE_OPTIONS
+        self.source_options = source_options or {}
+        self.initialized = False
+        self.option_reads = 0  # get_options calls
+        self.options_set = 0
+        self.pages_scanned = 0
+        self.jams = 0
+        self.stacks = 0  # multi_scan calls feeding a new stack, the text of a sheet depends on its stack and number
+        self.refeed = 0  # Sheets left in the feeder by a jam, fed by the next multi_scan
+        self.delivered = []  # time.monotonic() at which each page was handed over
+        self.lock = threading.Lock()
+
+
+backend = FakeBackend()
+
+
+def configure(**kwargs):
+    """Replace the settings of the virtual scanners, see FakeBackend."""
+    global backend
+    backend = FakeBackend(**kwargs)
+    return backend
+
+
+def install(**kwargs):
+    """Make `import sane` resolve to this module and configure it."""
+    sys.modules['sane'] = sys.modules[__name__]
+    return configure(**kwargs)
+
+
+class FakeOption:
+    def __init__(self, index, name, type, unit, constraint, cap=CAP_SOFT_SELECT | CAP_SOFT_DETECT) -> None:
+        self.index = index
+        self.name = name
+        self.py_name = name.replace('-', '_')
+        self.title = name
+        self.desc = name
+        self.type = type
+        self.unit = unit
+        self.size = 4
+        self.cap = cap
+        self.constraint = constraint
+
+    def is_active(self):
+        return not self.cap & CAP_INACTIVE
+
+    def is_settable(self):
+        return bool(self.cap & CAP_SOFT_SELECT)
+
+
+class FakeDevice:
+    """A virtual scanner behaving like python-sane's SaneDev."""
+
+    _templates = {}
+
+    def __init__(self, devname) -> None:
+        self.__dict__.update({
+            'devname': devname,
+            'opt': {},
+            'values': {'resolution': 150, 'mode': 'color', 'source': 'Flatbed', 'batch_scan': False,
+                       'tl_x': 0.0, 'tl_y': 0.0, 'br_x': 210.0, 'br_y': 297.0},
+            'closed': False,
+            'remaining': 0,
+        })
+        self._load_options()
+
+    def _load_options(self):
+        # Like SANE backends, the descriptors are reloaded when the source changes
+        replaced = {o[0]: o for o in backend.source_options.get(self.values['source'], ())}
+        options = [replaced.get(o[0], o) for o in backend.options]
+        self.__dict__['opt'] = {name: FakeOption(i, name, *rest) for i, (name, *rest) in enumerate(options, 1)}
+
+    def __setattr__(self, key, value):
+        if key in self.opt:
+            # Refused by python-sane itself, before the backend is asked
+            if not self.opt[key].is_active():
+                raise AttributeError(f"Inactive option: {key}")
+            if not self.opt[key].is_settable():
+                raise AttributeError(f"Option can't be set by software: {key}")
+            constraint = self.opt[key].constraint
+            if isinstance(constraint, list) and value not in constraint \
+                    or isinstance(constraint, tuple) and not constraint[0] <= value <= constraint[1]:
+                raise error('Invalid argument')
+            with backend.lock:
+                backend.options_set += 1
+            self.values[key] = value
+            if key == 'source':
+                self._load_options()
+        else:
+            self.__dict__[key] = value
+
+    def __getattr__(self, key):
+        values = self.__dict__.get('values', {})
+        if key in values:
+            return values[key]
+        raise AttributeError(f"No such attribute: {key}")
+
+    def __getitem__(self, key):
+        return self.opt[key]
+
+    @property
+    def optlist(self):
+        return list(self.opt)
+
+    def get_options(self):
+        with backend.lock:
+            backend.option_reads += 1
+        return [(o.index, o.name, o.title, o.desc, o.type, o.unit, o.size, o.cap, o.constraint)
+                for o in self.opt.values()]
+
+    def get_parameters(self):
+        width, height = self._page_size()
+        mode = self._image_mode()
+        bytes_per_line = width * (mode == 'RGB' and 3 or 1)
+        return (mode == 'RGB' and 'color' or 'grey', True, (width, height), 8, bytes_per_line)
+
+    def _page_size(self):
+        dots_per_mm = self.values['resolution'] / MM_PER_INCH
+        return (round((self.values['br_x'] - self.values['tl_x']) * dots_per_mm),
+                round((self.values['br_y'] - self.values['tl_y']) * dots_per_mm))
+
+    def _mode(self):
+        # Backends name the modes differently, e.g. 'Gray' and 'Lineart'
+        mode = self.values['mode'].lower()
+        return {'gray': 'grayscale', 'lineart': 'bw'}.get(mode, mode)
+
+    def _adf(self):
+        return 'adf' in self.values['source'].lower()
+
+    def _image_mode(self):
+        return self._mode() == 'color' and 'RGB' or 'L'
+
+    def _render(self, sheet, separator=False):
+        """The page of `sheet`, text laid out by it, separator sheets all look the same."""
+        size, mode = self._page_size(), self._mode()
+        key = (size, mode, separator)
+        if key not in FakeDevice._templates:
+            make_page = separator and FakeDevice._make_separator or FakeDevice._make_paper
+            FakeDevice._templates[key] = make_page(size, mode)
+        im = FakeDevice._templates[key].copy()
+        if not separator:
+            FakeDevice._write_text(im, mode == 'bw' and 0 or 30, sheet)
+        return im
+
+    @staticmethod
+    def _make_separator(size, mode):
+        """A separator sheet with a patch code, four long bars of two widths."""
+        im = Image.new('L', size, 235)
+        draw = ImageDraw.Draw(im)
+        bar = max(2, size[0] // 100)
+        for i, width in enumerate((2, 1, 2, 1)):
+            x = size[0] * 4 // 10 + i * 3 * bar
+            draw.rectangle((x, size[1] // 4, x + width * bar - 1, size[1] * 3 // 4), fill=0)
+        return mode == 'color' and im.convert('RGB') or im
+
+    @staticmethod
+    def _make_paper(size, mode):
+        """Paper-colored background with a little noise."""
+        if mode == 'bw':
+            return Image.new('L', size, 255)
+        im = Image.blend(Image.new('L', size, 235), Image.effect_noise(size, 6), 0.05)
+        return mode == 'color' and im.convert('RGB') or im
+
+    @staticmethod
+    def _write_text(im, ink, sheet):
+        """Text-like lines of words, their lengths and the paragraph breaks chosen by `sheet`."""
+        rng = random.Random(str(sheet))
+        draw = ImageDraw.Draw(im)
+        width, height = im.size
+        line_height = max(4, height // 60)
+        word_width = max(6, width // 25)
+        fill = im.mode == 'RGB' and (ink,) * 3 or ink
+        for y in range(height // 10, height * 8 // 10, line_height * 2):
+            if rng.random() < 0.15:
+                continue  # Paragraph break
+            x, line_end = width // 10, width // 10 + rng.uniform(0.3, 0.8) * width
+            while x < line_end:
+                word = rng.randint(word_width // 3, word_width * 3 // 2)
+                draw.rectangle((x, y, x + word, y + line_height), fill=fill)
+                x += word + line_height
+
+    def start(self):
+        if self.closed:
+            raise error('Invalid argument')
+        if self._adf() and self.remaining <= 0:
+            raise error(OUT_OF_DOCUMENTS)
+
+    @staticmethod
+    def _next_sheet():
+        # Sheets put on the flatbed one by one, numbered by the pages scanned before
+        with backend.lock:
+            return ('flatbed', backend.pages_scanned + 1)
+
+    @staticmethod
+    def _count_delivery():
+        with backend.lock:
+            backend.pages_scanned += 1
+            backend.delivered.append(time.monotonic())
+
+    def snap(self, no_cancel=False, progress=None):
+        if backend.pages_per_minute:
+            # Sleeping releases the GIL, just like python-sane while reading
+            time.sleep(60 / backend.pages_per_minute)
+        if self._adf():
+            with backend.lock:
+                fed = backend.stack_size - self.remaining
+                if backend.jam_after is not None and fed >= backend.jam_after and not backend.jams:
+                    backend.jams += 1
+                    backend.refeed = self.remaining
+                    self.remaining = 0
+                    raise error('Error during device I/O')
+                self.remaining -= 1
+            sheet = backend.refed_sheets.get(fed + 1, fed + 1)
+            im = self._render((backend.stacks, sheet), fed + 1 in backend.separator_sheets)
+        else:
+            im = self._render(self._next_sheet())
+        if progress:
+            progress(im.height, im.height)
+        self._count_delivery()
+        return im
+
+    def scan(self, progress=None):
+        self.start()
+        return self.snap(progress=progress)
+
+    def multi_scan(self):
+        with backend.lock:
+            if not backend.refeed:
+                backend.stacks += 1
+            self.remaining, backend.refeed = backend.refeed or backend.stack_size, 0
+        while True:
+            try:
+                self.start()
+            except error as e:
+                if str(e) == OUT_OF_DOCUMENTS:
+                    return
+                raise
+            yield self.snap(True)
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def init():
+    backend.initialized = True
+    return (1, 1, 0, 0)
+
+
+def exit():
+    backend.initialized = False
+
+
+def get_devices(localOnly=False):
+    if backend.discovery_delay:
+        time.sleep(backend.discovery_delay)
+    return list(backend.devices)
+
+
+def open(devname):
+    if devname not in [d[0] for d in backend.devices]:
+        raise error('Invalid argument')
+    return FakeDevice(devname)
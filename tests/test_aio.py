@@ -0,0 +1,126 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+import pytest
+
+import fake_sane
+from pypdf import PdfReader
+from simple_cmd_scan import scan_controller
+from simple_cmd_scan.aio import AsyncScanner, ScanError
+from simple_cmd_scan.page_encoder import PageEncoder
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+DEVICES = [('fake:scanner0', 'Fake', 'ADF', 'sheetfed scanner'), ('fake:scanner1', 'Fake', 'ADF', 'sheetfed scanner')]
+
+
+@pytest.fixture(autouse=True)
+def backend(mocker):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    return fake_sane.configure(devices=DEVICES, stack_size=3)
+
+
+def options(tmp_path, device='fake:scanner0', *extra):
+    return ['-a', '-r', '75', '-c', 'grayscale', '-s', device, '-o', str(tmp_path), '-n', device[-1] + '_scan',
+            '--device-cache-ttl', '0', *extra]
+
+
+async def scan_document(tmp_path, device='fake:scanner0'):
+    scanner = await AsyncScanner.open(options(tmp_path, device))
+    try:
+        job = scanner.new_job()
+        async for data in scanner.pages():
+            job.add_image(data)
+        return await scanner.create_pdf(job)
+    finally:
+        await scanner.close()
+
+
+def test_scan_document(tmp_path, backend):
+    path = asyncio.run(scan_document(tmp_path))
+    assert path == str(tmp_path / '0_scan.pdf')
+    assert len(PdfReader(path).pages) == 3
+    assert not backend.initialized
+
+
+def test_devices_share_one_loop(tmp_path, backend):
+    async def main():
+        return await asyncio.gather(scan_document(tmp_path, 'fake:scanner0'), scan_document(tmp_path, 'fake:scanner1'))
+
+    paths = asyncio.run(main())
+    assert [len(PdfReader(path).pages) for path in paths] == [3, 3]
+    assert backend.pages_scanned == 6
+    assert not backend.initialized, "SANE not closed with the last device"
+
+
+def test_shared_encoder_keeps_loop_responsive(tmp_path, backend, mocker):
+    encode_page_timed = SimpleCmdScan._encode_page_timed
+
+    def slow_encode(im, idx, processing=None):
+        time.sleep(0.2)
+        return encode_page_timed(im, idx, processing)
+
+    mocker.patch.object(SimpleCmdScan, '_encode_page_timed', staticmethod(slow_encode))
+
+    async def scan(encoder, device):
+        scanner = await AsyncScanner.open(options(tmp_path, device), encoder)
+        try:
+            return [data async for data in scanner.pages()]
+        finally:
+            await scanner.close()
+
+    async def main():
+        gaps = []
+
+        async def heartbeat():
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - before)
+
+        ticking = asyncio.ensure_future(heartbeat())
+        with PageEncoder(workers=1, max_pending=1) as encoder:
+            pages = await asyncio.gather(scan(encoder, 'fake:scanner0'), scan(encoder, 'fake:scanner1'))
+        ticking.cancel()
+        return pages, max(gaps)
+
+    pages, longest_gap = asyncio.run(main())
+    assert [len(p) for p in pages] == [3, 3]
+    assert longest_gap < 0.15, "Event loop blocked while waiting for the shared encoder"
+
+
+def test_pages_before_jam(tmp_path):
+    fake_sane.configure(devices=DEVICES, stack_size=3, jam_after=2)
+
+    async def main():
+        scanner = await AsyncScanner.open(options(tmp_path))
+        pages = []
+        try:
+            with pytest.raises(fake_sane.error):
+                async for data in scanner.pages():
+                    pages.append(data)
+        finally:
+            await scanner.close()
+        return pages
+
+    assert len(asyncio.run(main())) == 2
+
+
+def test_unknown_device(tmp_path, backend):
+    with pytest.raises(ScanError):
+        asyncio.run(AsyncScanner.open(options(tmp_path, 'fake:missing')))
+    assert not backend.initialized
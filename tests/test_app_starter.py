@@ -52,3 +52,14 @@ def test_args_resolution(mock_sane, monkeypatch):
 
     scs = SimpleCmdScan(args)
     assert scs.resolution_dpi == SimpleCmdScan.DEFAULT_RESOLUTION_PICTURE, "Resolution argument not properly converted"
+
+
+def test_args_zero_thresholds(mock_sane, monkeypatch):
+    args = AppStarter.parse_arguments(['simple-cmd-scan', '-b', '--blank-ink-threshold', '0', '--memory-budget', '0'])
+    scs = SimpleCmdScan(args)
+    assert scs.processing.blank_detector.ink_threshold == 0, "Explicit threshold 0 replaced by the default"
+    assert scs.memory_budget == 0, "Explicit memory budget 0 replaced by the default"
+
+    monkeypatch.setenv('SCAN_BLANK_STD_THRESHOLD', '0')
+    scs = SimpleCmdScan(AppStarter.parse_arguments(['simple-cmd-scan', '-b']))
+    assert scs.processing.blank_detector.std_threshold == 0, "Threshold 0 from env replaced by the default"
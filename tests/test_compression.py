@@ -0,0 +1,76 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import pytest
+
+from PIL import Image, ImageDraw
+from pypdf import PdfReader
+from simple_cmd_scan.compression import get_profile
+from simple_cmd_scan.pdf_builder import PdfBuilder, PdfImage
+
+
+def make_page(mode='L'):
+    im = Image.new(mode, (200, 100), 'white')
+    ImageDraw.Draw(im).rectangle((10, 10, 80, 50), fill='black')
+    return im
+
+
+class TestCompressionProfiles:
+    @pytest.mark.parametrize('color_mode, preset, expected', [
+        ('bw', 'small', ('G4', None)),
+        ('grayscale', 'lossless', ('PNG', None)),
+        ('grayscale', 'medium', ('JPEG', 75)),
+        ('color', 'high', ('JPEG', 90)),
+        (None, 'lossless', ('PNG', None)),
+    ])
+    def test_get_profile(self, color_mode, preset, expected):
+        profile = get_profile(color_mode, preset)
+        assert (profile.format, profile.quality) == expected
+
+    def test_jpeg_quality_override(self):
+        assert get_profile('color', 'lossless', jpeg_quality=60).quality == 60
+
+    def test_grayscale_converts_color_scans(self):
+        out = io.BytesIO()
+        get_profile('grayscale', 'medium').save(make_page('RGB'), out)
+        out.seek(0)
+        assert Image.open(out).mode == 'L'
+
+    @pytest.mark.parametrize('color_mode, pdf_filter', [
+        ('bw', '/CCITTFaxDecode'),
+        ('grayscale', '/FlateDecode'),
+        ('color', '/FlateDecode'),
+    ])
+    def test_lossless_roundtrip(self, tmp_path, color_mode, pdf_filter):
+        profile = get_profile(color_mode)
+        path = str(tmp_path / f"page.{profile.extension}")
+        profile.save(make_page(), path)
+        assert PdfImage.from_source(path).entries['Filter'] == pdf_filter
+
+        out = io.BytesIO()
+        pdf = PdfBuilder(out)
+        pdf.add_page(path)
+        pdf.close()
+        out.seek(0)
+        image = PdfReader(out).pages[0].images[0].image
+        assert image.convert('L').tobytes() == make_page().tobytes()
+
+    def test_bw_smaller_than_png(self):
+        png, g4 = io.BytesIO(), io.BytesIO()
+        get_profile('color').save(make_page(), png)
+        get_profile('bw').save(make_page(), g4)
+        assert len(PdfImage.from_tiff_data(g4.getvalue()).data) < len(png.getvalue())
@@ -0,0 +1,73 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from PIL import Image
+from pypdf import PdfReader
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.convert import collect_images, natural_key
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+
+def make_images(folder, widths, ext='png'):
+    folder.mkdir()
+    for i, width in enumerate(widths, 1):
+        Image.new('L', (width, 20), 'white').save(folder / f"page_{i}.{ext}")
+    (folder / 'notes.txt').write_text('not an image')
+    return folder
+
+
+def page_widths(path):
+    return [page.images[0].image.width for page in PdfReader(path).pages]
+
+
+def convert(tmp_path, *options):
+    return AppStarter().run(['simple-cmd-scan', '-o', str(tmp_path / 'out'), '-n', 'doc', '-w', '2', *options])
+
+
+def test_natural_order(tmp_path):
+    make_images(tmp_path / 'scan', range(10, 22))
+    images, label = collect_images(str(tmp_path / 'scan'))
+    assert [natural_key(p)[-2] for p in images] == list(range(1, 13))
+    assert label == 'scan'
+
+
+def test_documents_per_source(tmp_path):
+    (tmp_path / 'out').mkdir()
+    make_images(tmp_path / 'a', [10, 11, 12])
+    make_images(tmp_path / 'b', [20, 21], ext='jpg')
+
+    assert convert(tmp_path, '--convert', str(tmp_path / 'a'), str(tmp_path / 'b' / 'page_*.jpg')) \
+        == SimpleCmdScan.RET_OK
+    assert page_widths(tmp_path / 'out' / 'doc_a.pdf') == [10, 11, 12]
+    assert page_widths(tmp_path / 'out' / 'doc_page.pdf') == [20, 21]
+
+
+def test_duplex_interleaved(tmp_path):
+    (tmp_path / 'out').mkdir()
+    # Fronts 1, 3, 5 followed by the backs in the order the flipped stack was fed: 6, 4, 2
+    make_images(tmp_path / 'a', [1, 3, 5, 6, 4, 2])
+    make_images(tmp_path / 'b', [7, 8])
+
+    assert convert(tmp_path, '-d', '-m', 'join', '--convert', str(tmp_path / 'a'), str(tmp_path / 'b')) \
+        == SimpleCmdScan.RET_OK
+    assert page_widths(tmp_path / 'out' / 'doc.pdf') == [1, 2, 3, 4, 5, 6, 7, 8]
+
+
+def test_odd_duplex_fails(tmp_path):
+    (tmp_path / 'out').mkdir()
+    make_images(tmp_path / 'a', [1, 2, 3])
+    assert convert(tmp_path, '-d', '--convert', str(tmp_path / 'a')) == SimpleCmdScan.RET_ERR
+    assert not list((tmp_path / 'out').iterdir())
@@ -0,0 +1,141 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import pytest
+import socket
+import stat
+import tempfile
+import threading
+
+from unittest.mock import MagicMock
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.daemon import ScanDaemon, get_default_socket_path, run_client
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+
+@pytest.fixture
+def mock_sane(mocker):
+    mocks = {name: mocker.patch(f"sane.{name}") for name in ('init', 'exit', 'open')}
+    mocker.patch('sane.get_devices', return_value=[('device1', 'manufacturer', 'model', 'type')])
+    mocks['open'].return_value = MagicMock(devname='device1')
+    return mocks
+
+
+@pytest.fixture
+def daemon(tmp_path, mock_sane):
+    daemon = ScanDaemon(str(tmp_path / 'daemon.sock'))
+    daemon.start()
+
+    def serve(jobs):
+        for _ in range(jobs):
+            conn, _ = daemon.server.accept()
+            with conn:
+                daemon.handle(conn)
+
+    yield daemon, serve
+    daemon.stop()
+
+
+def run_job(daemon, serve, argv, stdin_text=""):
+    server = threading.Thread(target=serve, args=(1,))
+    server.start()
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, stdin_text.encode())
+    os.close(write_fd)
+    stdout = io.StringIO()
+    with os.fdopen(read_fd) as stdin:
+        ret = run_client(AppStarter.parse_arguments(argv), daemon.socket_path, stdin, stdout, io.StringIO())
+    server.join()
+    return ret, stdout.getvalue()
+
+
+class TestScanDaemon:
+    def test_no_daemon(self, tmp_path):
+        args = AppStarter.parse_arguments(['simple-cmd-scan'])
+        assert run_client(args, str(tmp_path / 'missing.sock')) is None
+
+    def test_device_kept_open_between_jobs(self, tmp_path, daemon, mock_sane, mocker):
+        mocker.patch('simple_cmd_scan.scan_controller.ScanJob.create_pdf')
+        argv = ['simple-cmd-scan', '-o', str(tmp_path)]
+        for _ in range(2):
+            ret, _ = run_job(*daemon, argv)
+            assert ret == SimpleCmdScan.RET_OK
+
+        mock_sane['init'].assert_called_once()
+        mock_sane['open'].assert_called_once_with('device1')
+        mock_sane['exit'].assert_not_called()
+        assert mock_sane['open'].return_value.scan.call_count == 2
+
+    def test_prompts_forwarded(self, tmp_path, daemon, mock_sane, mocker):
+        create_pdf = mocker.patch('simple_cmd_scan.scan_controller.ScanJob.create_pdf')
+        argv = ['simple-cmd-scan', '-o', str(tmp_path), '-m', 'split']
+        # Enter once, then CTRL+D
+        ret, out = run_job(*daemon, argv, stdin_text="\n")
+
+        assert ret == SimpleCmdScan.RET_OK
+        assert out.count("Please feed the next document") == 2
+        assert create_pdf.call_count == 2
+
+
+class TestDaemonSocket:
+    def test_private_fallback_dir(self, tmp_path, mock_sane, monkeypatch):
+        monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        daemon = ScanDaemon()
+        daemon.start()
+        try:
+            socket_dir = os.path.dirname(get_default_socket_path())
+            assert daemon.socket_path == get_default_socket_path()
+            assert stat.S_IMODE(os.stat(socket_dir).st_mode) == 0o700
+        finally:
+            daemon.stop()
+
+    def test_fallback_dir_of_other_user_refused(self, tmp_path, mock_sane, monkeypatch):
+        monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        socket_dir = os.path.dirname(get_default_socket_path())
+        os.mkdir(socket_dir, 0o777)
+        os.chmod(socket_dir, 0o777)
+
+        assert ScanDaemon().serve_forever() == SimpleCmdScan.RET_ERR
+        mock_sane['init'].assert_not_called()
+
+    def test_second_daemon_refused(self, daemon, mock_sane):
+        assert ScanDaemon(daemon[0].socket_path).serve_forever() == SimpleCmdScan.RET_ERR
+        assert mock_sane['init'].call_count == 1
+        # The first one still listens
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(daemon[0].socket_path)
+
+    def test_stale_socket_replaced(self, tmp_path, mock_sane):
+        socket_path = str(tmp_path / 'daemon.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as crashed:
+            crashed.bind(socket_path)
+        daemon = ScanDaemon(socket_path)
+        daemon.start()
+        daemon.stop()
+
+    def test_client_ignores_other_users_socket(self, tmp_path, daemon, mocker):
+        mocker.patch('os.getuid', return_value=os.getuid() + 1)
+        args = AppStarter.parse_arguments(['simple-cmd-scan'])
+        assert run_client(args, daemon[0].socket_path) is None
+
+    def test_client_ignores_file_in_place_of_socket(self, tmp_path):
+        (tmp_path / 'daemon.sock').write_text("")
+        args = AppStarter.parse_arguments(['simple-cmd-scan'])
+        assert run_client(args, str(tmp_path / 'daemon.sock')) is None
@@ -0,0 +1,51 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from simple_cmd_scan.device_cache import DeviceCache
+
+DEVICES = [('escl:http://192.168.1.40:8080', 'HP', 'ENVY 7640 series', 'platen,adf scanner')]
+
+
+class TestDeviceCache:
+    def test_save_and_load(self, isolated_cache_dir):
+        cache = DeviceCache()
+        assert cache.load() is None, "Empty cache returned devices"
+        cache.save(DEVICES)
+        assert cache.load() == DEVICES
+        assert cache.path.startswith(str(isolated_cache_dir))
+
+    def test_expired(self, mocker):
+        cache = DeviceCache(ttl=60)
+        cache.save(DEVICES)
+        mocker.patch('time.time', return_value=time.time() + 31)
+        assert cache.load() == DEVICES
+        assert cache.needs_refresh(), "Cache older than half its TTL not refreshed"
+        mocker.patch('time.time', return_value=time.time() + 61)
+        assert cache.load() is None, "Expired cache returned devices"
+
+    def test_disabled(self):
+        cache = DeviceCache(ttl=0)
+        cache.save(DEVICES)
+        assert cache.load() is None
+
+    def test_corrupt_file(self):
+        cache = DeviceCache()
+        cache.save(DEVICES)
+        with open(cache.path, 'w') as f:
+            f.write('{not json')
+        assert cache.load() is None
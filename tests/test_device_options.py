@@ -0,0 +1,164 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import pytest
+
+import fake_sane
+from simple_cmd_scan import scan_controller
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.device_options import DeviceOptions, OptionCache, UnsupportedSetting
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+# An eSCL-like scanner, naming its modes and sources differently from this tool
+ESCL_OPTIONS = [
+    ('resolution', 1, 4, [100, 200, 300]),
+    ('mode', 3, 0, ['Color', 'Gray']),
+    ('source', 3, 0, ['Flatbed', 'ADF Duplex', 'ADF Front']),
+    ('tl_x', 2, 3, (0.0, 215.9, 0.0)),
+    ('tl_y', 2, 3, (0.0, 297.0, 0.0)),
+    ('br_x', 2, 3, (0.0, 215.9, 0.0)),
+    ('br_y', 2, 3, (0.0, 297.0, 0.0)),
+]
+
+
+@pytest.fixture
+def backend(mocker):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    return fake_sane.configure(stack_size=2, options=ESCL_OPTIONS)
+
+
+def escl_options():
+    fake_sane.configure(options=ESCL_OPTIONS)
+    return DeviceOptions.from_device(fake_sane.open('fake:scanner0'))
+
+
+class TestDeviceOptions:
+    def test_resolve(self):
+        settings = {'resolution': 150, 'mode': 'grayscale', 'br_x': 215.9, 'br_y': 355.6, 'source': 'ADF',
+                    'batch_scan': True}
+        assert escl_options().resolve(settings) == [
+            ('source', 'ADF Front'), ('mode', 'Gray'), ('resolution', 200), ('br_x', 215.9), ('br_y', 297.0)]
+
+    def test_range_quantization(self):
+        options = DeviceOptions({'resolution': {'type': 1, 'constraint': {'range': [50, 1200, 25]}}})
+        assert options.snap('resolution', 160) == 150
+        assert options.snap('resolution', 2400) == 1200
+
+    def test_inactive_option_left_out(self):
+        options = DeviceOptions({'resolution': {'type': 1, 'cap': 5, 'constraint': None},
+                                 'batch_scan': {'type': 0, 'cap': 5 | 32, 'constraint': None}})
+        assert options.resolve({'resolution': 150, 'batch_scan': True}) == [('resolution', 150)]
+
+    def test_unsupported_value(self):
+        with pytest.raises(UnsupportedSetting):
+            escl_options().snap('mode', 'bw')
+
+    def test_cache(self, mocker):
+        cache = OptionCache(ttl=60)
+        assert cache.load('HP ENVY') is None
+        cache.save('HP ENVY', escl_options())
+        assert cache.load('HP ENVY').options == escl_options().options
+        mocker.patch('time.time', return_value=time.time() + 61)
+        assert cache.load('HP ENVY') is None, "Expired options returned"
+
+
+def scan_args(tmp_path, *args):
+    return AppStarter.parse_arguments(['simple-cmd-scan', '-a', '-s', 'fake:scanner0', '-o', str(tmp_path),
+                                       '-n', 'scan', *args])
+
+
+def test_settings_snapped_and_cached(backend, tmp_path):
+    assert SimpleCmdScan(scan_args(tmp_path, '-r', '75', '-c', 'grayscale')).run() == SimpleCmdScan.RET_OK
+    # Read again after selecting the source
+    assert backend.option_reads == 2
+
+    scanner_app = SimpleCmdScan(scan_args(tmp_path, '-r', '75', '-c', 'grayscale'))
+    scanner_app.open_scanner()
+    assert backend.option_reads == 2, "Cached options not used"
+    assert (scanner_app.scanner.resolution, scanner_app.scanner.mode, scanner_app.scanner.source) == \
+        (100, 'Gray', 'ADF Front')
+    scanner_app.close_scanner()
+
+
+def test_unsupported_setting_fails_before_opening(backend, tmp_path, mocker):
+    assert SimpleCmdScan(scan_args(tmp_path)).run() == SimpleCmdScan.RET_OK
+    open_device = mocker.spy(fake_sane, 'open')
+
+    assert SimpleCmdScan(scan_args(tmp_path, '-c', 'bw')).run() == SimpleCmdScan.RET_ERR
+    open_device.assert_not_called()
+
+
+def test_outdated_cache_refreshed(backend, tmp_path):
+    key = OptionCache.key('fake:scanner0', {'source': 'ADF'})
+    OptionCache(60).save(key, DeviceOptions({'resolution': {'type': 1, 'constraint': {'values': [75]}}}))
+
+    assert SimpleCmdScan(scan_args(tmp_path, '-r', '75')).run() == SimpleCmdScan.RET_OK
+    assert backend.option_reads == 2
+    assert OptionCache(60).load(key).options['resolution']['constraint'] == {'values': [100, 200, 300]}
+
+
+def test_settings_checked_against_source_options(mocker, tmp_path):
+    # Legal size fits the ADF only, the flatbed takes up to A4
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    fake_sane.configure(stack_size=1, options=ESCL_OPTIONS,
+                        source_options={'ADF Front': [('br_y', 2, 3, (0.0, 355.6, 0.0))]})
+
+    for _ in range(2):  # Options read from the device, then from the cache
+        scanner_app = SimpleCmdScan(scan_args(tmp_path, '-p', 'Legal'))
+        scanner_app.open_scanner()
+        assert (scanner_app.scanner.source, scanner_app.scanner.br_y) == ('ADF Front', 355.6)
+        scanner_app.close_scanner()
+
+    flatbed_app = SimpleCmdScan(AppStarter.parse_arguments(
+        ['simple-cmd-scan', '-s', 'fake:scanner0', '-o', str(tmp_path), '-p', 'Legal']))
+    flatbed_app.open_scanner()
+    assert flatbed_app.scanner.br_y == 297.0
+    flatbed_app.close_scanner()
+    assert OptionCache(60).load(OptionCache.key('fake:scanner0', {'source': 'ADF'})).options['br_y'] != \
+        OptionCache(60).load(OptionCache.key('fake:scanner0', {})).options['br_y']
+
+
+def test_concurrent_cache_writes_kept(tmp_path):
+    def save(i):
+        OptionCache(60).save(f'scanner{i}', DeviceOptions({'resolution': {'type': 1, 'constraint': None}}))
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert all(OptionCache(60).load(f'scanner{i}') for i in range(8)), "Entries of concurrent writers lost"
+    assert not list((tmp_path / 'cache').glob('**/*.tmp'))
+
+
+def test_inactive_option_not_set(mocker, tmp_path):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    # Cached without capabilities, python-sane refuses to set it
+    key = OptionCache.key('fake:scanner0', {'source': 'ADF'})
+    cached = escl_options()
+    cached.options['batch_scan'] = {'type': 0, 'constraint': None}
+    for option in cached.options.values():
+        option.pop('cap', None)
+    OptionCache(60).save(key, cached)
+    # An ADF without batch scans
+    fake_sane.configure(stack_size=1, options=ESCL_OPTIONS + [('batch_scan', 0, 0, None, 5 | 32)])
+
+    assert SimpleCmdScan(scan_args(tmp_path)).run() == SimpleCmdScan.RET_OK
+    assert OptionCache(60).load(key).options['batch_scan']['cap'] == 5 | 32, "Cache not refreshed"
+    assert SimpleCmdScan(scan_args(tmp_path)).run() == SimpleCmdScan.RET_OK
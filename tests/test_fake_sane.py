@@ -0,0 +1,74 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+import fake_sane
+
+
+@pytest.fixture
+def backend():
+    return fake_sane.configure(stack_size=3)
+
+
+def test_page_size_follows_resolution(backend):
+    dev = fake_sane.open('fake:scanner0')
+    dev.resolution = 75
+    dev.mode = 'grayscale'
+    im = dev.scan()
+    assert im.mode == 'L'
+    assert im.size == (620, 877)
+
+
+def test_multi_scan_empties_the_feeder(backend):
+    dev = fake_sane.open('fake:scanner0')
+    dev.resolution = 75
+    dev.source = 'ADF'
+    assert len(list(dev.multi_scan())) == 3
+    assert len(backend.delivered) == 3
+
+
+def test_jam_raises_sane_error():
+    fake_sane.configure(stack_size=3, jam_after=1)
+    dev = fake_sane.open('fake:scanner0')
+    dev.resolution = 75
+    dev.source = 'ADF'
+    pages = dev.multi_scan()
+    next(pages)
+    with pytest.raises(fake_sane._sane.error):
+        next(pages)
+
+
+def test_unknown_device(backend):
+    with pytest.raises(fake_sane._sane.error):
+        fake_sane.open('fake:missing')
+
+
+def test_sheets_differ(backend):
+    dev = fake_sane.open('fake:scanner0')
+    dev.resolution = 75
+    dev.source = 'ADF'
+    first, second, third = dev.multi_scan()
+    assert first.tobytes() != second.tobytes() != third.tobytes()
+
+
+def test_refed_sheet_repeats_earlier_one():
+    fake_sane.configure(stack_size=3, refed_sheets={3: 1})
+    dev = fake_sane.open('fake:scanner0')
+    dev.resolution = 75
+    dev.source = 'ADF'
+    first, second, third = dev.multi_scan()
+    assert third.tobytes() == first.tobytes() != second.tobytes()
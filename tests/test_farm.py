@@ -0,0 +1,61 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from unittest.mock import MagicMock
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.farm import ScanFarm
+from simple_cmd_scan.scan_controller import ScanJob, SimpleCmdScan
+from simple_cmd_scan.utils import device_label
+
+DEVICES = {
+    'escl:http://10.0.0.1:8080': ['a1', 'a2', 'a3'],
+    'escl:http://10.0.0.2:8080': ['b1', 'b2'],
+}
+
+
+@pytest.fixture
+def mock_sane(mocker):
+    mocker.patch('sane.init')
+    mocker.patch('sane.exit')
+    mocker.patch('sane.get_devices', return_value=[(d, 'HP', 'model', 'scanner') for d in DEVICES])
+
+    def open_device(name):
+        return MagicMock(devname=name, multi_scan=MagicMock(return_value=iter(DEVICES[name])))
+
+    return mocker.patch('sane.open', side_effect=open_device)
+
+
+def test_device_label():
+    assert device_label('escl:http://10.0.0.1:8080') == 'escl_http_10_0_0_1_8080'
+
+
+def test_farm_scans_all_devices(tmp_path, mock_sane, mocker):
+    mocker.patch.object(SimpleCmdScan, '_encode_page', side_effect=lambda im, idx, processing: im)
+    created = {}
+
+    def create_pdf(job, suffix=""):
+        created[job.output_filename + suffix] = list(job.images)
+
+    mocker.patch.object(ScanJob, 'create_pdf', autospec=True, side_effect=create_pdf)
+    args = AppStarter.parse_arguments(['simple-cmd-scan', '--farm', '-o', str(tmp_path), '-n', 'scan'])
+
+    assert ScanFarm(args).run() == SimpleCmdScan.RET_OK
+    assert created == {
+        'scan_escl_http_10_0_0_1_8080_1': DEVICES['escl:http://10.0.0.1:8080'],
+        'scan_escl_http_10_0_0_2_8080_1': DEVICES['escl:http://10.0.0.2:8080'],
+    }
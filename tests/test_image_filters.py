@@ -0,0 +1,175 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from PIL import Image, ImageDraw
+from simple_cmd_scan.image_filters import BlankPageDetector, Deskewer, DuplicateDetector, SeparatorDetector, downsample
+
+PAGE_SIZE = (1240, 1754)  # A4 at 150 dpi
+
+
+def paper(mode='RGB', level=235, noise=4, seed=0):
+    rng = np.random.default_rng(seed)
+    a = np.clip(rng.normal(level, noise, PAGE_SIZE[::-1]), 0, 255).astype('uint8')
+    return Image.fromarray(a).convert(mode)
+
+
+class TestBlankPageDetector:
+    @pytest.mark.parametrize('mode', ['RGB', 'L'])
+    def test_blank(self, mode):
+        assert BlankPageDetector().is_blank(paper(mode))
+
+    def test_colored_paper(self):
+        assert BlankPageDetector().is_blank(paper(level=190))
+
+    def test_border_shadow_ignored(self):
+        im = paper()
+        ImageDraw.Draw(im).rectangle((0, 0, 30, PAGE_SIZE[1]), fill='black')
+        assert BlankPageDetector().is_blank(im)
+
+    def test_text(self):
+        im = paper()
+        draw = ImageDraw.Draw(im)
+        for y in range(150, 600, 30):
+            draw.rectangle((120, y, 1100, y + 12), fill=(30, 30, 30))
+        assert not BlankPageDetector().is_blank(im)
+
+    def test_signature_only(self):
+        im = paper()
+        draw = ImageDraw.Draw(im)
+        for x in range(750, 950, 6):
+            draw.line((x, 1500, x + 4, 1520), fill=(20, 20, 20), width=1)
+        assert not BlankPageDetector().is_blank(im)
+
+
+def text_page(angle=0):
+    im = Image.new('L', PAGE_SIZE, 235)
+    draw = ImageDraw.Draw(im)
+    for y in range(300, 1300, 25):
+        for x in range(200, 1000, 20):
+            draw.rectangle((x, y, x + 14, y + 11), fill=20)
+    return im.rotate(angle, resample=Image.BILINEAR, fillcolor=235)
+
+
+class TestDeskewer:
+    @pytest.mark.parametrize('angle', [-3.2, -0.6, 0, 1.5, 4.5])
+    def test_estimate_angle(self, angle):
+        deskewer = Deskewer()
+        mask, _ = deskewer._ink_mask(downsample(text_page(angle), Deskewer.SAMPLE_WIDTH))
+        assert deskewer.estimate_angle(mask) == pytest.approx(angle, abs=0.15)
+
+    def test_deskew(self):
+        deskewer = Deskewer()
+        im = deskewer.apply(text_page(2.5).convert('RGB'))
+        assert im.size == PAGE_SIZE
+        mask, _ = deskewer._ink_mask(downsample(im, Deskewer.SAMPLE_WIDTH))
+        assert deskewer.estimate_angle(mask) == pytest.approx(0, abs=0.15)
+
+    def test_crop(self):
+        im = Deskewer(deskew=False, crop=True).apply(text_page())
+        # Content spans 200..994 x 300..1286 plus a margin of 2% of the page
+        assert im.size[0] == pytest.approx(795 + 2 * 0.02 * PAGE_SIZE[0], abs=10)
+        assert im.size[1] == pytest.approx(987 + 2 * 0.02 * PAGE_SIZE[1], abs=10)
+
+    def test_crop_blank_page(self):
+        assert Deskewer(crop=True).apply(paper('L')).size == PAGE_SIZE
+
+
+def patch_code_page():
+    im = paper('L')
+    draw = ImageDraw.Draw(im)
+    for i, width in enumerate((24, 12, 24, 12)):
+        x = 500 + i * 36
+        draw.rectangle((x, 400, x + width, 1400), fill=20)
+    draw.text((500, 1420), "PATCH 2", fill=20)
+    return im
+
+
+class TestSeparatorDetector:
+    @pytest.mark.parametrize('angle', [0, 90, 1.5])
+    def test_patch_code(self, angle):
+        im = patch_code_page().rotate(angle, expand=angle == 90, fillcolor=235)
+        assert SeparatorDetector().is_separator(im.convert('RGB'))
+
+    def test_barcode(self):
+        im = paper('L')
+        draw = ImageDraw.Draw(im)
+        rng = np.random.default_rng(1)
+        x = 400
+        while x < 800:
+            width = int(rng.integers(1, 4)) * 2
+            draw.rectangle((x, 800, x + width - 1, 950), fill=20)
+            x += width + int(rng.integers(1, 4)) * 2
+        assert SeparatorDetector().is_separator(im)
+
+    def test_documents(self):
+        detector = SeparatorDetector()
+        assert not detector.is_separator(text_page())
+        assert not detector.is_separator(paper())
+
+        table = paper('L')
+        draw = ImageDraw.Draw(table)
+        for x in range(100, 1150, 200):
+            draw.line((x, 200, x, 1500), fill=20, width=2)
+        for y in range(200, 1500, 40):
+            draw.line((100, y, 1100, y), fill=20, width=2)
+        assert not detector.is_separator(table)
+
+    def test_document_with_barcode(self):
+        im = text_page()
+        draw = ImageDraw.Draw(im)
+        for x in range(900, 1100, 6):
+            draw.rectangle((x, 1500, x + 2, 1600), fill=20)
+        assert not SeparatorDetector().is_separator(im)
+
+    def test_blank_separators(self):
+        detector = SeparatorDetector('blank')
+        assert detector.is_separator(paper())
+        assert not detector.is_separator(patch_code_page())
+
+
+def letter_page(seed):
+    """Pages with the same layout, different words and paragraph ends."""
+    rng = np.random.default_rng(seed)
+    im = paper('L', seed=seed)
+    draw = ImageDraw.Draw(im)
+    for y in range(150, 1600, 30):
+        end = rng.random() > 0.1 and 1120 or int(rng.integers(300, 1100))
+        x = 120
+        while x < end:
+            width = int(rng.integers(20, 90))
+            draw.rectangle((x, y, x + width, y + 12), fill=30)
+            x += width + 14
+    return im
+
+
+class TestDuplicateDetector:
+    def test_refed_sheets(self):
+        detector = DuplicateDetector()
+        pages = [letter_page(seed) for seed in range(6)]
+        assert [detector.find(page, i) for i, page in enumerate(pages)] == [None] * 6
+
+        # Fed again with a different skew and offset
+        refed = [page.rotate(1.2 - i * 0.4, translate=(15 - i * 6, 10 - i * 4), fillcolor=235)
+                 for i, page in enumerate(pages)]
+        assert [detector.find(page, 10 + i) for i, page in enumerate(refed)] == list(range(6))
+
+    def test_blank_pages_are_not_duplicates(self):
+        detector = DuplicateDetector()
+        assert detector.find(paper(), 0) is None
+        assert detector.find(paper(seed=1), 1) is None
@@ -0,0 +1,127 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+import fake_sane
+from pypdf import PdfReader
+from simple_cmd_scan import scan_controller
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.journal import JobJournal
+from simple_cmd_scan.scan_controller import ScanJob, SimpleCmdScan
+
+PNG = b"\x89PNG\r\n\x1a\n..."
+
+
+class TestJobJournal:
+    def test_replay(self, tmp_path):
+        journal = JobJournal.create(str(tmp_path), output_dir=str(tmp_path), double_sided=True)
+        front = journal.start_job()
+        journal.add_page(front, PNG)
+        journal.add_page(front, None)
+        back = journal.start_job("_2")
+        journal.add_page(back, PNG)
+        journal.close()
+        # A crash while writing the next line
+        with open(journal.manifest_path, 'a') as f:
+            f.write('{"event": "page", "jo')
+
+        resumed = JobJournal.open(journal.job_dir)
+        assert resumed.settings == {'output_dir': str(tmp_path), 'double_sided': True}
+        assert [job.job_id for job in resumed.unfinished_jobs()] == [front, back]
+        assert resumed.jobs[front].pages[0].endswith('page_000001.png')
+        assert resumed.jobs[front].pages[1] is None
+        assert (resumed.jobs[front].name_suffix, resumed.jobs[back].name_suffix) == ("", "_2")
+
+        merged = resumed.merge(front, back)
+        resumed.pdf_created(merged, 'scan.pdf')
+        resumed.close()
+        assert not JobJournal.open(journal.job_dir).unfinished_jobs()
+
+    def test_removed_when_finished(self, tmp_path):
+        journal = JobJournal.create(str(tmp_path))
+        journal.add_page(journal.start_job(), PNG)
+        journal.close(remove=True)
+        assert not list(tmp_path.iterdir())
+
+    def test_not_a_journal(self, tmp_path):
+        with pytest.raises(OSError):
+            JobJournal.open(str(tmp_path))
+
+
+@pytest.fixture
+def scanner(mocker, tmp_path):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    fake_sane.configure(stack_size=3)
+
+    def create(*options):
+        args = AppStarter.parse_arguments(['simple-cmd-scan', '-a', '-r', '75', '-c', 'grayscale',
+                                           '-s', 'fake:scanner0', '-o', str(tmp_path), '-n', 'scan',
+                                           '--journal-dir', str(tmp_path / 'journal'), *options])
+        return SimpleCmdScan(args)
+    return create
+
+
+def test_resume_interrupted_scan(scanner, tmp_path, mocker):
+    snap = fake_sane.FakeDevice.snap
+
+    def snap_until_power_loss(self, *args):
+        if fake_sane.backend.pages_scanned == 2:
+            raise KeyboardInterrupt
+        return snap(self, *args)
+    mocker.patch.object(fake_sane.FakeDevice, 'snap', snap_until_power_loss)
+
+    with pytest.raises(KeyboardInterrupt):
+        scanner().run()
+    assert not (tmp_path / 'scan.pdf').exists()
+    job_dirs = list((tmp_path / 'journal').iterdir())
+    assert len(job_dirs) == 1
+
+    assert scanner().resume_jobs([str(job_dirs[0])]) == SimpleCmdScan.RET_OK
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 2
+    assert not list((tmp_path / 'journal').iterdir()), "Journal of the finished scan left behind"
+
+
+def test_resume_duplex_before_merge(scanner, tmp_path, mocker):
+    mocker.patch('builtins.input', return_value='')
+    mocker.patch.object(ScanJob, 'merge_back_images', side_effect=KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        scanner('-d').run()
+    mocker.stopall()
+
+    job_dir, = (tmp_path / 'journal').iterdir()
+    assert scanner().resume_jobs([str(job_dir)]) == SimpleCmdScan.RET_OK
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 6
+
+
+def test_journal_removed_after_scan(scanner, tmp_path):
+    assert scanner().run() == SimpleCmdScan.RET_OK
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 3
+    assert not list((tmp_path / 'journal').iterdir())
+
+
+def test_journal_dir_as_path(tmp_path, mocker):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    fake_sane.configure(stack_size=2)
+    create = mocker.spy(JobJournal, 'create')
+    args = AppStarter.parse_arguments(['simple-cmd-scan', '-a', '-r', '75', '-s', 'fake:scanner0', '-o', str(tmp_path),
+                                       '-n', 'scan'])
+    # As passed by API callers
+    args.journal_dir = tmp_path / 'journal'
+
+    assert SimpleCmdScan(args).run() == SimpleCmdScan.RET_OK
+    assert create.call_args[0][0] == tmp_path / 'journal'
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 2
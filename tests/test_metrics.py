@@ -0,0 +1,81 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+
+import fake_sane
+from simple_cmd_scan import scan_controller
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.metrics import JobMetrics
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+
+def test_stages_and_counters():
+    metrics = JobMetrics('escl:http://10.0.0.1')
+    metrics.observe('encode', 0.5)
+    metrics.observe('encode', 1.5)
+    with metrics.stage('device_open'):
+        pass
+    assert list(metrics.timed_iter(['a', 'b'], 'acquire')) == ['a', 'b']
+    metrics.queue_depth('encoder', 3)
+    metrics.queue_depth('encoder', 1)
+    metrics.count('pages', 2)
+    metrics.finish(0)
+
+    report = metrics.report()
+    assert list(report['stages']) == ['device_open', 'acquire', 'encode']
+    assert report['stages']['encode'] == {'count': 2, 'seconds': 2.0, 'max_seconds': 1.5}
+    assert report['stages']['acquire']['count'] == 2
+    assert report['max_queue_depth'] == {'encoder': 3}
+    assert report['counters'] == {'pages': 2}
+    assert report['result'] == 0
+
+
+def test_prometheus_text():
+    metrics = JobMetrics('dev"1')
+    metrics.observe('acquire', 0.25)
+    metrics.count('bytes_written', 1024)
+    text = metrics.prometheus_text()
+    assert 'simple_cmd_scan_stage_seconds{device="dev\\"1",stage="acquire"} 0.25\n' in text
+    assert 'simple_cmd_scan_bytes_written{device="dev\\"1"} 1024\n' in text
+    assert 'simple_cmd_scan_job_result{device="dev\\"1"} -1\n' in text
+
+
+def test_write_failure_is_not_fatal(tmp_path):
+    JobMetrics().write(str(tmp_path / 'missing' / 'report.json'))
+
+
+def test_scan_job_report(tmp_path, mocker):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    fake_sane.configure(stack_size=4)
+    json_path = tmp_path / 'report.json'
+    prom_path = tmp_path / 'scan.prom'
+    args = AppStarter.parse_arguments(['simple-cmd-scan', '-a', '-r', '75', '-s', 'fake:scanner0', '-o', str(tmp_path),
+                                       '--metrics-json', str(json_path), '--metrics-prom', str(prom_path)])
+
+    assert SimpleCmdScan(args).run() == SimpleCmdScan.RET_OK
+    report = json.loads(json_path.read_text())
+    assert report['device'] == 'fake:scanner0'
+    assert report['result'] == 0
+    assert report['counters']['pages'] == 4
+    assert report['counters']['documents'] == 1
+    assert report['counters']['bytes_written'] > 0
+    for stage in ('acquire', 'encode', 'decode', 'pdf_page'):
+        assert report['stages'][stage]['count'] == 4
+    assert report['stages']['device_open']['count'] == 1
+    assert report['stages']['final_write']['count'] == 1
+    assert report['max_queue_depth']['encoder'] >= 1
+    assert 'simple_cmd_scan_pages{device="fake:scanner0"} 4' in prom_path.read_text()
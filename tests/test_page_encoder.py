@@ -0,0 +1,70 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import threading
+
+from PIL import Image
+from simple_cmd_scan.page_encoder import PageEncoder
+
+
+def frame_digest(im, tag):
+    return tag, im.mode, im.size, im.info.get('dpi'), hashlib.sha1(im.tobytes()).hexdigest()
+
+
+class TestPageEncoder:
+    def test_results_in_submit_order(self):
+        with PageEncoder(workers=4) as encoder:
+            futures = [encoder.submit(pow, i, 2) for i in range(20)]
+            assert [f.result() for f in futures] == [i * i for i in range(20)]
+
+    def test_submit_blocks_when_queue_full(self):
+        release = threading.Event()
+        encoder = PageEncoder(workers=1, max_pending=2)
+        encoder.submit(release.wait)
+        encoder.submit(release.wait)
+
+        submitted = threading.Event()
+
+        def feed():
+            encoder.submit(int)
+            submitted.set()
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        assert not submitted.wait(0.2), "submit did not block on a full queue"
+
+        release.set()
+        assert submitted.wait(5), "submit did not resume after the queue drained"
+        feeder.join()
+        encoder.shutdown()
+
+    def test_frames_through_shared_memory(self):
+        frames = [Image.effect_noise((64, 48), 40).convert(mode) for mode in ('L', 'RGB', 'L', '1')]
+        frames[0].info['dpi'] = (300, 300)
+        expected = [frame_digest(im, i) for i, im in enumerate(frames)]
+        with PageEncoder(workers=2, use_processes=True, max_pending=2) as encoder:
+            futures = [encoder.submit_frame(frame_digest, im, i) for i, im in enumerate(frames)]
+            assert [f.result() for f in futures] == expected
+            assert encoder.ring is not None, "Frames were not passed through shared memory"
+            assert encoder.ring.slots == 2
+
+    def test_large_frame_falls_back_to_pickling(self):
+        with PageEncoder(workers=1, use_processes=True) as encoder:
+            small = Image.new('L', (10, 10))
+            large = Image.new('RGB', (20, 20), 'red')
+            assert encoder.submit_frame(frame_digest, small, 0).result() == frame_digest(small, 0)
+            assert encoder.submit_frame(frame_digest, large, 1).result() == frame_digest(large, 1)
@@ -0,0 +1,64 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gc
+
+import fake_sane
+from pypdf import PdfReader
+from simple_cmd_scan import scan_controller
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.page_store import PageStore
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+
+class TestPageStore:
+    def test_spills_oldest_pages_over_budget(self, tmp_path):
+        with PageStore(str(tmp_path), memory_budget=250) as store:
+            pages = [store.put(bytes([i]) * 100) for i in range(4)]
+            assert [p.spilled for p in pages] == [True, True, False, False]
+            assert store.memory_used == 200
+            assert store.spilled_bytes == 200
+
+            for i, page in enumerate(pages):
+                data = store.read(page)
+                assert bytes(data) == bytes([i]) * 100
+            assert isinstance(store.read(pages[0]), memoryview), "Spilled pages are read from the memory map"
+            del data
+        assert not (tmp_path / 'pages.spill').exists()
+
+    def test_released_pages_free_the_budget(self, tmp_path):
+        with PageStore(str(tmp_path), memory_budget=250) as store:
+            first = store.put(b'a' * 100)
+            store.put(b'b' * 100)  # Handle dropped right away
+            gc.collect()
+            assert store.memory_used == 100
+
+            store.put(b'c' * 100)
+            assert not first.spilled
+            assert not (tmp_path / 'pages.spill').exists()
+
+
+def test_pages_spilled_during_scan(tmp_path, mocker):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    fake_sane.configure(stack_size=5)
+    mocker.patch.object(PageStore, 'DEFAULT_MEMORY_BUDGET', 1)
+    args = AppStarter.parse_arguments(['simple-cmd-scan', '-a', '-r', '75', '-s', 'fake:scanner0', '-o', str(tmp_path),
+                                       '-n', 'scan'])
+    scanner_app = SimpleCmdScan(args)
+
+    assert scanner_app.run() == SimpleCmdScan.RET_OK
+    assert scanner_app.metrics.counters['spilled_bytes'] > 0
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 5
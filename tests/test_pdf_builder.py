@@ -0,0 +1,177 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import pytest
+import threading
+
+from PIL import Image, ImageDraw
+from pypdf import PdfReader
+from simple_cmd_scan.pdf_builder import BackgroundPdf, PdfBuilder, PdfImage, StreamingPdf
+
+
+def make_image(mode, size=(64, 48)):
+    im = Image.new(mode, size, "white" if mode != "P" else 0)
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((8, 8, 40, 30), fill="black" if mode != "P" else 1)
+    return im
+
+
+def png_data(size=(64, 48)):
+    out = io.BytesIO()
+    make_image("L", size).save(out, format="PNG")
+    return out.getvalue()
+
+
+def build(sources, page_order=None):
+    out = io.BytesIO()
+    pdf = PdfBuilder(out)
+    refs = [pdf.add_page(s) for s in sources]
+    pdf.close(page_order and [refs[i] for i in page_order])
+    out.seek(0)
+    return PdfReader(out)
+
+
+def embedded_image(reader, page_idx=0):
+    return reader.pages[page_idx].images[0].image
+
+
+class TestPdfBuilder:
+    @pytest.mark.parametrize("mode", ["RGB", "L", "P"])
+    def test_png_passthrough(self, tmp_path, mode):
+        im = make_image(mode)
+        path = tmp_path / "page.png"
+        im.save(path)
+
+        pdf_image = PdfImage.from_source(str(path))
+        assert pdf_image.entries["Filter"] == "/FlateDecode"
+        assert "DecodeParms" in pdf_image.entries, "PNG data was re-encoded instead of passed through"
+
+        reader = build([str(path)])
+        assert embedded_image(reader).convert("RGB").tobytes() == im.convert("RGB").tobytes()
+
+    def test_jpeg_passthrough(self, tmp_path):
+        path = tmp_path / "page.jpg"
+        make_image("RGB").save(path, quality=80)
+
+        pdf_image = PdfImage.from_source(str(path))
+        assert pdf_image.entries["Filter"] == "/DCTDecode"
+        assert pdf_image.data == path.read_bytes(), "JPEG data was not passed through unchanged"
+        assert len(build([str(path)]).pages) == 1
+
+    def test_pil_bw_image(self):
+        im = make_image("1")
+        reader = build([im])
+        assert embedded_image(reader).convert("L").tobytes() == im.convert("L").tobytes()
+
+    def test_page_size_from_dpi(self, tmp_path):
+        path = tmp_path / "page.png"
+        make_image("L", (300, 600)).save(path, dpi=(150, 150))
+        box = build([str(path)]).pages[0].mediabox
+        assert (float(box.width), float(box.height)) == pytest.approx((144, 288), abs=0.1)
+
+    def test_page_order(self):
+        sources = [make_image("L", (10 + i, 10)) for i in range(3)]
+        reader = build(sources, page_order=[2, 0, 1])
+        assert [embedded_image(reader, i).width for i in range(3)] == [12, 10, 11]
+
+
+class TestStreamingPdf:
+    def test_finish_renames_part_file(self, tmp_path):
+        stream = StreamingPdf(str(tmp_path), "scan")
+        for i in range(3):
+            stream.add_page(make_image("L"))
+        output_path = tmp_path / "scan.pdf"
+        stream.finish(str(output_path))
+
+        assert not list(tmp_path.glob("*.part")), "Part file left behind"
+        assert len(PdfReader(str(output_path)).pages) == 3
+
+    def test_recover_truncated_file(self, tmp_path):
+        stream = StreamingPdf(str(tmp_path), "scan")
+        for i in range(3):
+            stream.add_page(make_image("L", (20 + i, 20)))
+        stream.f.close()
+
+        # Simulate a crash in the middle of writing the last page
+        part_path = stream.part_path
+        with open(part_path, "r+b") as f:
+            f.truncate(stream.builder.offsets[stream.builder.pages[-1]] - 10)
+
+        assert StreamingPdf.recover(part_path) == 2
+        # Under the name the PDF was meant to get, without the unique part of the part file name
+        assert [path.name for path in tmp_path.iterdir()] == ["scan.pdf"]
+        reader = PdfReader(str(tmp_path / "scan.pdf"))
+        assert [embedded_image(reader, i).width for i in range(2)] == [20, 21]
+
+    def test_recover_finished_file(self, tmp_path):
+        part_path = tmp_path / "scan.pdf.part"
+        with open(part_path, "wb") as f:
+            pdf = PdfBuilder(f)
+            pdf.add_page(make_image("L"))
+            pdf.close()
+
+        assert StreamingPdf.recover(str(part_path)) == 1
+        assert len(PdfReader(str(tmp_path / "scan.pdf")).pages) == 1
+
+    def test_recover_empty_file(self, tmp_path):
+        part_path = tmp_path / "scan.pdf.part"
+        part_path.write_bytes(b"")
+        assert StreamingPdf.recover(str(part_path)) == 0
+
+
+class TestBackgroundPdf:
+    def test_pages_in_given_order(self, tmp_path):
+        with BackgroundPdf(str(tmp_path)) as pdf:
+            refs = [pdf.add_page(png_data((10 + i, 10))) for i in range(3)]
+            pdf.finish(str(tmp_path / "scan.pdf"), [refs[2], refs[0]])
+
+        reader = PdfReader(str(tmp_path / "scan.pdf"))
+        assert [embedded_image(reader, i).width for i in range(2)] == [12, 10]
+        assert not list(tmp_path.glob("*.part")), "Part file left behind"
+
+    def test_add_page_blocks_while_queue_full(self, tmp_path, mocker):
+        release = threading.Event()
+        add_page = BackgroundPdf._add_page
+
+        def slow_add_page(pdf, source):
+            release.wait()
+            return add_page(pdf, source)
+
+        mocker.patch.object(BackgroundPdf, '_add_page', slow_add_page)
+        with BackgroundPdf(str(tmp_path), max_pending=2) as pdf:
+            refs = [pdf.add_page(png_data()) for _ in range(2)]
+            third = threading.Thread(target=lambda: refs.append(pdf.add_page(png_data())))
+            third.start()
+            third.join(0.2)
+            assert third.is_alive(), "Page queued beyond max_pending"
+            release.set()
+            third.join()
+            pdf.finish(str(tmp_path / "scan.pdf"), refs)
+
+        assert len(PdfReader(str(tmp_path / "scan.pdf")).pages) == 3
+
+    def test_discarded_without_finish(self, tmp_path):
+        with BackgroundPdf(str(tmp_path)) as pdf:
+            pdf.add_page(png_data()).result()
+            assert len(list(tmp_path.glob("*.part"))) == 1
+        assert not list(tmp_path.iterdir())
+
+    def test_page_error_raised_on_finish(self, tmp_path):
+        with BackgroundPdf(str(tmp_path)) as pdf:
+            ref = pdf.add_page(str(tmp_path / "missing.png"))
+            with pytest.raises(OSError):
+                pdf.finish(str(tmp_path / "scan.pdf"), [ref])
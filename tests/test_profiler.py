@@ -0,0 +1,65 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import dis
+import pstats
+import re
+import tracemalloc
+
+import fake_sane
+from simple_cmd_scan import profiler, scan_controller
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.scan_controller import SimpleCmdScan
+
+
+def traceback(*frames):
+    return [tracemalloc.Frame(frame) for frame in frames]
+
+
+def last_line(function):
+    return max(line for _, line in dis.findlinestarts(function.__code__) if line)
+
+
+def test_classify_by_most_recent_known_frame():
+    controller = scan_controller.__file__
+    encode = (controller, last_line(SimpleCmdScan._encode_page))
+    run = (controller, last_line(SimpleCmdScan._run))
+    # Oldest frame first
+    assert profiler.classify(traceback(run, encode, ('PIL/Image.py', 10))) == ('save', tracemalloc.Frame(encode))
+    assert profiler.classify(traceback(encode, ('/lib/fake_sane.py', 300)))[0] == 'acquire'
+    assert profiler.classify(traceback(run, ('PIL/Image.py', 10))) == ('other', tracemalloc.Frame(('PIL/Image.py', 10)))
+
+
+def test_profiled_job(tmp_path, mocker):
+    mocker.patch.object(scan_controller, 'sane', fake_sane)
+    fake_sane.configure(stack_size=3, pages_per_minute=600)
+    prefix = tmp_path / 'profile-%Y'
+    args = AppStarter.parse_arguments(['simple-cmd-scan', '-a', '-r', '75', '-s', 'fake:scanner0', '-o', str(tmp_path),
+                                       '--profile', str(prefix)])
+
+    assert SimpleCmdScan(args).run() == SimpleCmdScan.RET_OK
+    assert not tracemalloc.is_tracing()
+    [pstats_path] = tmp_path.glob('profile-2*.pstats')
+    functions = {name for _, _, name in pstats.Stats(str(pstats_path)).stats}
+    assert {'_run_multi_scan', 'create_pdf'} <= functions
+
+    collapsed = pstats_path.with_suffix('.collapsed').read_text().splitlines()
+    assert collapsed and all(re.fullmatch(r'[^ ;]+(;[^;]+:[^;]+)+ \d+', line) for line in collapsed)
+    assert any(line.startswith('MainThread;') for line in collapsed)
+
+    report = pstats_path.with_suffix('.alloc.txt').read_text()
+    for stage in profiler.STAGES:
+        assert f"  {stage}: " in report
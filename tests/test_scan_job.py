@@ -14,7 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from simple_cmd_scan.scan_controller import ScanJob
+import threading
+
+import pytest
+
+from PIL import Image
+from pypdf import PdfReader
+from simple_cmd_scan.__main__ import AppStarter
+from simple_cmd_scan.pdf_builder import BackgroundPdf
+from simple_cmd_scan.scan_controller import DocumentWriter, ScanJob, SimpleCmdScan
 
 
 class TestScanJob:
@@ -41,3 +49,107 @@ class TestScanJob:
         assert imgs[3] == back[1]
         assert imgs[4] == front[2]
         assert imgs[5] == back[0]
+
+    def test_stream_pdf(self, tmp_path):
+        job = ScanJob(str(tmp_path), 'scan', default_complete=True, stream_pdf=True)
+        for i in range(2):
+            path = tmp_path / f"page_{i}.png"
+            Image.new('L', (30, 40), 'white').save(path)
+            job.add_image(str(path))
+            assert len(list(tmp_path.glob('scan_*.pdf.part'))) == 1, "Page not streamed to a part file"
+
+        job.create_pdf(quiet_mode=True)
+        assert not list(tmp_path.glob('*.part')), "Part file left behind"
+        assert len(PdfReader(str(tmp_path / 'scan.pdf')).pages) == 2
+
+    def test_recover_interrupted_stream(self, tmp_path):
+        job = ScanJob(str(tmp_path), 'scan', stream_pdf=True, name_suffix="_2")
+        path = tmp_path / 'page.png'
+        Image.new('L', (30, 40), 'white').save(path)
+        job.add_image(str(path))
+        job.pdf_stream.f.close()  # Interrupted before create_pdf
+        part_path, = tmp_path.glob('*.pdf.part')
+
+        scanner_app = SimpleCmdScan(AppStarter.parse_arguments(['simple-cmd-scan', '--recover', str(part_path)]))
+        assert scanner_app.recover_pdfs([str(part_path)]) == SimpleCmdScan.RET_OK
+        assert len(PdfReader(str(tmp_path / 'scan_2.pdf')).pages) == 1
+        assert not list(tmp_path.glob('*.part'))
+
+    def test_blank_pages_dropped(self, tmp_path):
+        path = tmp_path / 'page.png'
+        Image.new('L', (30, 40), 'white').save(path)
+
+        front_job = ScanJob(str(tmp_path), 'scan')
+        back_job = ScanJob(str(tmp_path), 'scan')
+        for _ in range(2):
+            front_job.add_image(str(path))
+            back_job.add_image(None)
+
+        combined = front_job.merge_back_images(back_job)
+        assert combined.num_pages == 4, "Blank pages must keep their place for duplex pairing"
+        assert combined.pages == [str(path)] * 2
+
+        combined.create_pdf(quiet_mode=True)
+        assert len(PdfReader(str(tmp_path / 'scan.pdf')).pages) == 2
+
+    def test_merge_prebuilt_pages(self, tmp_path):
+        with BackgroundPdf(str(tmp_path)) as writer:
+            front_job = ScanJob(str(tmp_path), 'scan', page_writer=writer)
+            back_job = ScanJob(str(tmp_path), 'scan', page_writer=writer)
+            # Page widths: fronts 1, 3, 5, backs fed in reverse order 6, 4 and a blank page
+            for job, widths in ((front_job, [1, 3, 5]), (back_job, [6, 4, None])):
+                for width in widths:
+                    path = None
+                    if width:
+                        path = tmp_path / f"page_{width}.png"
+                        Image.new('L', (10 * width, 40), 'white').save(path)
+                        path = str(path)
+                    job.add_image(path)
+
+            combined = front_job.merge_back_images(back_job)
+            combined.create_pdf(quiet_mode=True)
+
+        assert not list(tmp_path.glob('*.part')), "Part file left behind"
+        pages = PdfReader(str(tmp_path / 'scan.pdf')).pages
+        assert [p.images[0].image.width // 10 for p in pages] == [1, 3, 4, 5, 6]
+
+
+class SlowJob:
+    def __init__(self, written, error=None) -> None:
+        self.written = written
+        self.error = error
+        self.created = False
+
+    def create_pdf(self, suffix="", quiet_mode=False):
+        self.written.wait(5)
+        if self.error:
+            raise self.error
+        self.created = True
+
+
+class TestDocumentWriter:
+    def test_pending_documents_bounded(self):
+        written = threading.Event()
+        jobs = [SlowJob(written), SlowJob(written)]
+        writer = DocumentWriter(max_pending=1)
+        writer.submit(jobs[0])
+        submit = threading.Thread(target=writer.submit, args=(jobs[1],))
+        submit.start()
+        submit.join(0.2)
+        assert submit.is_alive(), "Second document queued while the first is pending"
+
+        written.set()
+        submit.join(5)
+        writer.close()
+        assert all(job.created for job in jobs)
+
+    def test_close_waits_for_all_and_raises(self):
+        written = threading.Event()
+        written.set()
+        jobs = [SlowJob(written, OSError("disk full")), SlowJob(written)]
+        writer = DocumentWriter()
+        for job in jobs:
+            writer.submit(job)
+        with pytest.raises(OSError):
+            writer.close()
+        assert jobs[1].created
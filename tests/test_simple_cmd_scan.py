@@ -15,10 +15,21 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import pytest
-from simple_cmd_scan.scan_controller import SimpleCmdScan
+import sane
+import threading
+import fake_sane
+from pypdf import PdfReader
+from simple_cmd_scan.device_cache import DeviceCache
+from simple_cmd_scan.scan_controller import ScanJob, SimpleCmdScan
 from unittest.mock import patch, MagicMock
 
 
+def scan_args(**kwargs):
+    """Mocked arguments for SimpleCmdScan: `kwargs`, and off for the options which must not be mocks."""
+    defaults = {'journal_dir': None, 'profile': None, 'separator': None, 'duplicates': None, 'on_jam': 'ask'}
+    return MagicMock(**{**defaults, **kwargs})
+
+
 @pytest.fixture
 def mock_sane(mocker):
     mocker.patch('sane.init')
@@ -48,7 +59,7 @@ class TestSimpleCmdScan:
         cls.mock_temp_dir_patch.stop()
 
     def test_list_scanners(self, mock_test_write_to_folder, mock_sane):
-        args = MagicMock(find_scanners=True)
+        args = scan_args(find_scanners=True)
         scanner_app = SimpleCmdScan(args)
         ret = scanner_app.run()
         assert ret == SimpleCmdScan.RET_OK, "ret is not RET_OK"
@@ -57,13 +68,13 @@ class TestSimpleCmdScan:
     def test_list_scanners_no_devices(self, mock_test_write_to_folder, mocker):
         # Override the mock_sane fixture for this test
         mocker.patch('sane.get_devices', return_value=[])
-        args = MagicMock(find_scanners=True)
+        args = scan_args(find_scanners=True)
         scanner_app = SimpleCmdScan(args)
         ret = scanner_app.run()
         assert ret == SimpleCmdScan.RET_NO_SCANNER, "List of devices is not empty or wrong return value"
 
     def test_scan_single_sided(self, mock_test_write_to_folder, mock_sane, mock_create_pdf):
-        args = MagicMock(adf=False, double_sided=False, multidoc=None)
+        args = scan_args(adf=False, double_sided=False, multidoc=None)
         scanner_app = SimpleCmdScan(args)
         with patch('builtins.input', return_value=''):
             ret = scanner_app.scan_single_sided()
@@ -72,7 +83,7 @@ class TestSimpleCmdScan:
         mock_create_pdf.assert_called_once()
 
     def test_scan_adf_double_sided(self, mock_test_write_to_folder, mock_sane, mock_create_pdf):
-        args = MagicMock(adf=True, double_sided=True)
+        args = scan_args(adf=True, double_sided=True)
         scanner_app = SimpleCmdScan(args)
         # # Two pages in the ADF, flip, two pages
         # side_effect = [MagicMock(), MagicMock(), MagicMock(), MagicMock()]
@@ -84,7 +95,7 @@ class TestSimpleCmdScan:
         mock_create_pdf.assert_called_once()
 
     def test_multidoc_mode_split(self, mock_test_write_to_folder, mock_sane, mock_create_pdf):
-        args = MagicMock(adf=False, double_sided=False, multidoc='split')
+        args = scan_args(adf=False, double_sided=False, multidoc='split')
         scanner_app = SimpleCmdScan(args)
 
         # Simulate pressing Enter to proceed with scanning and then stop
@@ -95,7 +106,7 @@ class TestSimpleCmdScan:
         assert mock_create_pdf.call_count == 2, "create_pdf() call count is not 2"
 
     def test_multidoc_mode_join(self, mock_test_write_to_folder, mock_sane, mock_create_pdf):
-        args = MagicMock(adf=False, double_sided=False, multidoc='join')
+        args = scan_args(adf=False, double_sided=False, multidoc='join')
         scanner_app = SimpleCmdScan(args)
 
         # Simulate pressing Enter to proceed with scanning and then stop
@@ -104,3 +115,124 @@ class TestSimpleCmdScan:
 
         assert ret == SimpleCmdScan.RET_OK, "ret is not RET_OK"
         mock_create_pdf.assert_called_once()
+
+    def test_adf_pages_encoded_in_feed_order(self, mock_test_write_to_folder, mock_sane, mock_create_pdf, mocker):
+        mock_sane.return_value.multi_scan.return_value = iter(['p0', 'p1', 'p2', 'p3'])
+        mocker.patch.object(SimpleCmdScan, '_encode_page', side_effect=lambda im, idx, processing: f"{im}_{idx}")
+        args = scan_args(adf=True, encode_workers=3, encode_processes=False, drop_blank=False, deskew=False, crop=False)
+        scanner_app = SimpleCmdScan(args)
+        scanner_app.open_scanner()
+
+        job = scanner_app._run_multi_scan()
+        scanner_app.close_scanner()
+
+        assert job.complete, "ADF job not marked complete"
+        assert job.images == ['p0_0', 'p1_1', 'p2_2', 'p3_3'], "Pages are not in feed order"
+
+    def test_open_scanner_uses_device_cache(self, mock_test_write_to_folder, mock_sane, mocker):
+        get_devices = mocker.patch('sane.get_devices')
+        DeviceCache().save([('cached_device', 'manufacturer', 'model', 'type')])
+        scanner_app = SimpleCmdScan(scan_args(scanner=None, device_cache_ttl=60))
+
+        assert scanner_app.open_scanner() == SimpleCmdScan.RET_OK
+        mock_sane.assert_called_once_with('cached_device')
+        get_devices.assert_not_called()
+
+    def test_open_scanner_stale_device_cache(self, mock_test_write_to_folder, mock_sane):
+        DeviceCache().save([('gone_device', 'manufacturer', 'model', 'type')])
+        mock_sane.side_effect = [sane._sane.error('Invalid argument'), MagicMock()]
+        scanner_app = SimpleCmdScan(scan_args(scanner=None, device_cache_ttl=60))
+
+        assert scanner_app.open_scanner() == SimpleCmdScan.RET_OK
+        assert mock_sane.call_args_list[-1].args == ('device1',), "No fallback to a full device search"
+        assert DeviceCache().load()[0][0] == 'device1', "Device cache not updated"
+
+
+def test_double_sided_adf_scan(fake_scan, tmp_path, mocker):
+    mocker.patch('builtins.input', return_value='')
+    scanner_app = fake_scan('-a', '-d', '-c', 'bw', stack_size=3)
+
+    assert scanner_app.run() == SimpleCmdScan.RET_OK
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 6
+    assert not fake_sane.backend.initialized
+
+
+@pytest.mark.parametrize('options', [[], ['--stream-pdf']])
+def test_adf_stacks_joined(fake_scan, tmp_path, mocker, options):
+    # Three stacks, the third one ended with CTRL+D
+    mocker.patch('builtins.input', side_effect=['', '', EOFError])
+    scanner_app = fake_scan('-a', '-m', 'join', *options, stack_size=2)
+
+    assert scanner_app.run() == SimpleCmdScan.RET_OK
+    assert [path.name for path in tmp_path.glob('scan*')] == ['scan.pdf']
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 6
+
+
+def test_separator_sheets_split_documents(fake_scan, tmp_path):
+    scanner_app = fake_scan('-a', '--separator', 'barcode', stack_size=8, separator_sheets=(1, 4, 5))
+
+    assert scanner_app.run() == SimpleCmdScan.RET_OK
+    assert sorted(path.name for path in tmp_path.glob('*.pdf')) == ['scan_1.pdf', 'scan_2.pdf']
+    assert len(PdfReader(tmp_path / 'scan_1.pdf').pages) == 2
+    assert len(PdfReader(tmp_path / 'scan_2.pdf').pages) == 3
+    assert fake_sane.backend.pages_scanned == 8
+
+
+def test_multidoc_split_written_in_background(fake_scan, tmp_path, mocker):
+    mocker.patch('builtins.input', side_effect=['', KeyboardInterrupt])
+    threads = []
+    create_pdf = ScanJob.create_pdf
+
+    def record_thread(job, *args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return create_pdf(job, *args, **kwargs)
+
+    mocker.patch.object(ScanJob, 'create_pdf', record_thread)
+    scanner_app = fake_scan('-a', '-m', 'split', '-n', 'scan_%S%f', stack_size=3)
+
+    with pytest.raises(KeyboardInterrupt):
+        scanner_app.run()
+    # Both documents scanned before CTRL+C are written
+    assert len(list(tmp_path.glob('scan_*.pdf'))) == 2
+    assert not list(tmp_path.glob('*.part'))
+    assert all(name.startswith('pdf_documents') for name in threads)
+
+
+@pytest.mark.parametrize('mode, pages', [('flag', 5), ('drop', 3)])
+def test_duplicate_pages(fake_scan, tmp_path, mode, pages):
+    # Sheets 1 and 3 fed twice
+    scanner_app = fake_scan('-a', '--duplicates', mode, stack_size=5, refed_sheets={2: 1, 5: 3})
+
+    assert scanner_app.run() == SimpleCmdScan.RET_OK
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == pages
+    assert scanner_app.metrics.counters['duplicate_pages'] == 2
+    assert scanner_app.metrics.stages['encode'][0] == pages
+
+
+def test_adf_scan_continues_after_jam(fake_scan, tmp_path, mocker):
+    prompt = mocker.patch('builtins.input', return_value='')
+    scanner_app = fake_scan('-a', stack_size=5, jam_after=2)
+
+    assert scanner_app.run() == SimpleCmdScan.RET_OK
+    assert 'from sheet 3 on' in prompt.call_args[0][0]
+    assert [path.name for path in tmp_path.glob('*.pdf')] == ['scan.pdf']
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 5
+    assert fake_sane.backend.pages_scanned == 5
+
+
+def test_double_sided_pairing_kept_after_jam(fake_scan, tmp_path, mocker):
+    # Re-feed after the jam, then flip the stack
+    mocker.patch('builtins.input', side_effect=['', ''])
+    scanner_app = fake_scan('-a', '-d', '-c', 'bw', stack_size=3, jam_after=1)
+
+    assert scanner_app.run() == SimpleCmdScan.RET_OK
+    assert len(PdfReader(tmp_path / 'scan.pdf').pages) == 6
+
+
+@pytest.mark.parametrize('on_jam, answers', [('abort', []), ('ask', [EOFError])])
+def test_partial_scan_saved_after_jam(fake_scan, tmp_path, mocker, on_jam, answers):
+    mocker.patch('builtins.input', side_effect=answers)
+    scanner_app = fake_scan('-a', '-d', '-c', 'bw', '--on-jam', on_jam, stack_size=3, jam_after=2)
+
+    assert scanner_app.run() == SimpleCmdScan.RET_ERR
+    assert len(PdfReader(tmp_path / 'scan_front_partial.pdf').pages) == 2
@@ -0,0 +1,60 @@
+# SimpleCmdScan - A simple command line scanning tool
+# Copyright (C) 2024, bitcreed LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import sys
+
+# Modules only needed once a scan or conversion actually runs
+HEAVY_MODULES = ('sane', 'PIL.Image', 'numpy', 'pypdf', 'concurrent.futures.process', 'multiprocessing')
+# Cumulative import time of the command line module, generous for slow CI machines
+IMPORT_BUDGET_MS = 150
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(statement):
+    """Cumulative import time in ms per module imported by `statement`, from -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def test_cli_import_is_light():
+    times = import_times('import simple_cmd_scan.__main__')
+    assert not [m for m in HEAVY_MODULES if m in times], "Heavy modules imported at startup"
+    assert times['simple_cmd_scan.__main__'] < IMPORT_BUDGET_MS
+
+
+def test_api_import_skips_cli():
+    times = import_times('import simple_cmd_scan.aio')
+    cli_modules = ('simple_cmd_scan.__main__', 'simple_cmd_scan.daemon', 'simple_cmd_scan.farm',
+                   'simple_cmd_scan.convert')
+    assert not [m for m in cli_modules if m in times], "Command line modules imported by the API"
+
+
+def test_version_and_help():
+    # Only scanning needs python-sane, these also work where it is not installed
+    env = dict(os.environ, PYTHONPATH='')
+    for option in ('--version', '--help'):
+        subprocess.run([sys.executable, '-m', 'simple_cmd_scan', option], cwd=REPO_DIR, env=env,
+                       capture_output=True, check=True)